@@ -6,3 +6,6 @@ Back-end interfaces to real devices.
 
 from serial_port import SerialPortBackEnd
 from emulator    import EmulatorBackEnd
+from sockets     import SocketBackEnd
+from recording   import RecordingBackEnd, ReplayBackEnd
+from metrics     import MeteredBackEnd
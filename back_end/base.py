@@ -4,10 +4,20 @@
 An implementation of a KMD Comms Protocol master.
 
 Spec: http://www.cs.manchester.ac.uk/resources/software/komodo/comms.html
+
+Commands are implemented as generators decorated with @command (see batch.py)
+so that they can either be executed one at a time or queued up in a Batch and
+sent to the device together.
 """
 
-from exceptions     import *
-from util.num_utils import *
+import struct
+
+from collections import deque
+from contextlib  import contextmanager
+
+from exceptions import *
+from batch      import command, Batch
+from codec      import *
 
 
 class BackEnd(object):
@@ -87,12 +97,28 @@ class BackEnd(object):
 	# Length of a peripheral download packet
 	PACKET_LENGTH = 256
 	
+	# Default number of peripheral download packets which may be sent before
+	# their acknowledgements are received (1 = stop-and-wait)
+	DOWNLOAD_WINDOW = 1
+	
+	# Largest download window used. A command sent part-way through a download
+	# must wait for the packets in flight to be acknowledged so this bounds the
+	# time it waits to this many packet times.
+	MAX_DOWNLOAD_WINDOW = 4
+	
+	# Maximum number of elements in a single memory transfer command
+	MAX_TRANSFER_LENGTH = (1<<16) - 1
+	
 	
 	def __init__(self):
 		"""
 		Create a protocol implementation.
 		"""
 		self.name = None
+		
+		# Number of download packets to keep in flight (see periph_download_). Only
+		# increase this for devices which can buffer this many packets.
+		self.download_window = BackEnd.DOWNLOAD_WINDOW
 	
 	
 	def read(self, length):
@@ -124,6 +150,55 @@ class BackEnd(object):
 		raise NotImplementedError("BackEnd must implement close!")
 	
 	
+	def run_command(self, cmd):
+		"""
+		Send a command generator (see batch.command) to the device on its own and
+		return its response.
+		"""
+		cmd.next()
+		self.flush()
+		return next(cmd, None)
+	
+	
+	def batch(self):
+		"""
+		Create a Batch which sends a number of commands to the device with a single
+		flush rather than waiting for each response in turn.
+		"""
+		return Batch(self)
+	
+	
+	def memory_buffer(self, memory_num):
+		"""
+		Optional capability: get direct access to the given memory as a writable
+		array.array of words indexed by address or None if the memory can only be
+		accessed using the protocol (the default).
+		
+		Back-ends whose target lives in the same process (or in shared memory) can
+		provide this so that memory is accessed without encoding any commands. The
+		buffer must only be accessed within direct_access().
+		"""
+		return None
+	
+	
+	def register_file(self):
+		"""
+		Optional capability: as memory_buffer but gives an array.array of the
+		registers indexed by address (or None if not supported).
+		"""
+		return None
+	
+	
+	@contextmanager
+	def direct_access(self, written = False):
+		"""
+		A context manager within which the buffers given by memory_buffer and
+		register_file may be accessed. If written is True, the target is told that
+		they have been changed when the context is left.
+		"""
+		yield
+	
+	
 	def read_exactly(self, length):
 		"""
 		Read the exactly specified number of bytes from the device. Raises exception
@@ -138,28 +213,40 @@ class BackEnd(object):
 		return data
 	
 	
+	def read_into(self, buf):
+		"""
+		Read exactly enough data to fill the given writable buffer (e.g. a
+		memoryview). Raises exception on failure. Back-ends may override this to
+		read directly into the buffer.
+		"""
+		buf[:] = self.read_exactly(len(buf))
+	
+	
 	def ignore(self, length):
 		"""
-		Ignores up-to a certain number if incomming bytes.
+		Ignores up-to a certain number if incomming bytes. Returns the bytes
+		ignored.
 		"""
-		self.read(length)
+		return self.read(length)
 	
 	
+	@command
 	def nop(self):
 		"""
 		Perform a NOP
 		"""
-		self.write(byte(BackEnd.NOP))
-		self.flush()
+		self.write(COMMAND.pack(BackEnd.NOP))
+		yield
 	
 	
+	@command
 	def ping(self):
 		"""
 		Ping the board. Returns the software version or raises a
 		MalformedPingResponseException if the response is invalid.
 		"""
-		self.write(byte(BackEnd.PING))
-		self.flush()
+		self.write(COMMAND.pack(BackEnd.PING))
+		yield
 		
 		# Expect back in form OK%02d
 		response = self.read_exactly(4)
@@ -174,146 +261,145 @@ class BackEnd(object):
 		except ValueError:
 			raise MalformedPingResponseException(response)
 		
-		return version
+		yield version
 	
 	
+	@command
 	def get_board_definition(self):
 		"""
 		Get the details of the device's type. Returns a tuple
 		((cpu_type, cpu_sub_type), features (a.k.a. peripherals), segments) or a
 		MalformedResponseError if the length of the response is incorrect.
 		"""
-		self.write(byte(BackEnd.GET_BOARD_DEFINITION))
-		self.flush()
+		self.write(COMMAND.pack(BackEnd.GET_BOARD_DEFINITION))
+		yield
 		
-		# Get the message length
-		msg_length = b2i(self.read_exactly(2))
+		# Get the message length and then the whole message in one go
+		msg_length, = BOARD_DEFINITION_LENGTH.read(self)
+		data = self.read_exactly(msg_length)
 		actual_length = 0
 		
-		# Get CPU info
-		cpu_type       = b2i(self.read_exactly(1))
-		cpu_sub_type   = b2i(self.read_exactly(2))
-		actual_length += 3
-		
-		# Get features (a.k.a. peripherals)
-		feature_count  = b2i(self.read_exactly(1))
-		actual_length += 1
-		
-		features = []
-		for feature_num in range(feature_count):
-			feature_id     = b2i(self.read_exactly(1))
-			feature_sub_id = b2i(self.read_exactly(2))
-			actual_length += 3
+		try:
+			# Get CPU info and the number of features (a.k.a. peripherals)
+			cpu_type, cpu_sub_type, feature_count = \
+				BOARD_DEFINITION_CPU.unpack_from(data, actual_length)
+			actual_length += BOARD_DEFINITION_CPU.size
 			
-			features.append((feature_id, feature_sub_id))
-		
-		# Get memory segments
-		segment_count  = b2i(self.read_exactly(1))
-		actual_length += 1
-		
-		segments = []
-		for segment_num in range(segment_count):
-			segment_addr   = b2i(self.read_exactly(4))
-			segment_length = b2i(self.read_exactly(4))
-			actual_length += 8
+			# Get features
+			features = BOARD_DEFINITION_FEATURE.unpack_array_from(data, feature_count,
+			                                                      actual_length)
+			actual_length += BOARD_DEFINITION_FEATURE.size * feature_count
 			
-			segments.append((segment_addr, segment_length))
-		
+			# Get memory segments
+			segment_count, = BOARD_DEFINITION_SEGMENT_COUNT.unpack_from(data,
+			                                                            actual_length)
+			actual_length += BOARD_DEFINITION_SEGMENT_COUNT.size
+			
+			segments = BOARD_DEFINITION_SEGMENT.unpack_array_from(data, segment_count,
+			                                                      actual_length)
+			actual_length += BOARD_DEFINITION_SEGMENT.size * segment_count
+		except struct.error:
+			raise MalformedResponseError("Got message of length %d, too short."%(
+			                             msg_length))
 		
 		# Check message length was correct
 		if msg_length != actual_length:
 			raise MalformedResponseError("Got message of length %d, expected %d."%(
 			                             actual_length, msg_length))
 		
-		return ((cpu_type, cpu_sub_type), features, segments)
+		yield ((cpu_type, cpu_sub_type), features, segments)
 	
 	
+	@command
 	def reset(self):
 		"""
 		Reset the device.
 		"""
 		
-		self.write(byte(BackEnd.RESET))
-		self.flush()
+		self.write(COMMAND.pack(BackEnd.RESET))
+		yield
 	
 	
+	@command
 	def periph_get_status(self, num):
 		"""
 		Get the status of a peripheral (feature)
 		"""
-		self.write(byte(BackEnd.PERIPH_GET_STATUS))
-		self.write(byte(num))
-		self.flush()
+		self.write(PERIPH_REQUEST.pack(BackEnd.PERIPH_GET_STATUS, num))
+		yield
 		
-		return b2i(self.read_exactly(4))
+		status, = WORD_RESPONSE.read(self)
+		yield status
 	
 	
+	@command
 	def periph_set_status(self, num, status):
 		"""
 		Set the status of a peripheral (feature)
 		"""
-		self.write(byte(BackEnd.PERIPH_SET_STATUS))
-		self.write(byte(num))
-		self.write(word(status))
-		self.flush()
+		self.write(PERIPH_STATUS_REQUEST.pack(BackEnd.PERIPH_SET_STATUS,
+		                                      num, status))
+		yield
 	
 	
+	@command
 	def periph_send_message(self, num, message):
 		"""
 		Send a message to a peripheral. Returns the number of bytes accepted.
 		"""
 		assert(len(message) <= 255)
 		
-		self.write(byte(BackEnd.PERIPH_SEND_MESSAGE))
-		self.write(byte(num))
-		self.write(byte(len(message)))
+		self.write(PERIPH_MESSAGE_REQUEST.pack(BackEnd.PERIPH_SEND_MESSAGE, num,
+		                                       len(message)))
 		self.write(message)
-		self.flush()
+		yield
 		
-		return b2i(self.read_exactly(1))
+		accepted, = BYTE_RESPONSE.read(self)
+		yield accepted
 	
 	
+	@command
 	def periph_get_message(self, num, max_length = 255):
 		"""
 		Get a message from a peripheral of up to max_length bytes. Returns the
 		message received.
 		"""
-		self.write(byte(BackEnd.PERIPH_GET_MESSAGE))
-		self.write(byte(num))
-		self.write(byte(max_length))
-		self.flush()
+		self.write(PERIPH_MESSAGE_REQUEST.pack(BackEnd.PERIPH_GET_MESSAGE, num,
+		                                       max_length))
+		yield
 		
-		length  = b2i(self.read_exactly(1))
+		length, = BYTE_RESPONSE.read(self)
 		message = self.read_exactly(length)
 		
 		if length > max_length:
 			raise PeriphMessageOverflow("Expected length <= %d, got %d"%(
 			                            max_length, length))
 		
-		return message
+		yield message
 	
 	
+	@command
 	def periph_download_header(self, num, length):
 		"""
 		Sends a header to the peripheral indicating how long (in bytes) the sequence
 		of packets about to be sent is. Raises a PeriphDownloadError if not
 		accepted.
 		"""
-		self.write(byte(BackEnd.PERIPH_DOWNLOAD_HEADER))
-		self.write(byte(num))
-		self.write(word(length))
-		self.flush()
+		self.write(PERIPH_DOWNLOAD_HEADER_REQUEST.pack(
+			BackEnd.PERIPH_DOWNLOAD_HEADER, num, length))
+		yield
 		
 		response = self.read_exactly(1)
 		
 		if response == "A":
-			return
+			yield
 		elif response == "N":
 			raise PeriphDownloadError("Header requesting length %d rejected."%length)
 		else:
 			raise MalformedResponseError("Expected 'A' or 'N', got '%s'"%response)
 	
 	
+	@command
 	def periph_download_packet(self, num, data):
 		"""
 		Sends a packet of data to the peripheral. Raises a PeriphDownloadError if
@@ -322,16 +408,15 @@ class BackEnd(object):
 		"""
 		assert(len(data) <= 255)
 		
-		self.write(byte(BackEnd.PERIPH_DOWNLOAD_PACKET))
-		self.write(byte(num))
-		self.write(byte(len(data)))
+		self.write(PERIPH_MESSAGE_REQUEST.pack(BackEnd.PERIPH_DOWNLOAD_PACKET, num,
+		                                       len(data)))
 		self.write(data)
-		self.flush()
+		yield
 		
 		response = self.read_exactly(1)
 		
 		if response == "A":
-			return
+			yield
 		elif response == "N":
 			raise PeriphDownloadError("Packet %s of length %d rejected."%(
 			                          repr(data), len(data)))
@@ -339,43 +424,43 @@ class BackEnd(object):
 			raise MalformedResponseError("Expected 'A' or 'N', got '%s'"%response)
 	
 	
+	@command
 	def get_status(self):
 		"""
 		Get the status of the board. Returns a tuple
 		(status, steps_remaining, steps_since_reset).
 		"""
-		self.write(byte(BackEnd.GET_STATUS))
-		self.flush()
-		
-		status            = b2i(self.read_exactly(1))
-		steps_remaining   = b2i(self.read_exactly(4))
-		steps_since_reset = b2i(self.read_exactly(4))
+		self.write(COMMAND.pack(BackEnd.GET_STATUS))
+		yield
 		
-		return (status, steps_remaining, steps_since_reset)
+		yield STATUS_RESPONSE.read(self)
 	
 	
+	@command
 	def stop_execution(self):
 		"""
 		Stop the processor.
 		"""
-		self.write(byte(BackEnd.STOP_EXECUTION))
-		self.flush()
+		self.write(COMMAND.pack(BackEnd.STOP_EXECUTION))
+		yield
 	
 	
+	@command
 	def pause_execution(self):
 		"""
 		Pause the processor without resetting the steps-remaining counter.
 		"""
-		self.write(byte(BackEnd.PAUSE_EXECUTION))
-		self.flush()
+		self.write(COMMAND.pack(BackEnd.PAUSE_EXECUTION))
+		yield
 	
 	
+	@command
 	def continue_execution(self):
 		"""
 		Start the processor running for however many steps remain.
 		"""
-		self.write(byte(BackEnd.CONTINUE_EXECUTION))
-		self.flush()
+		self.write(COMMAND.pack(BackEnd.CONTINUE_EXECUTION))
+		yield
 	
 	
 	def set_runtime_flags(self, flags):
@@ -386,6 +471,7 @@ class BackEnd(object):
 		raise NotImplementedError("RTF not currently supported.")
 	
 	
+	@command
 	def trap_define(self, trap_type, num,
 	                sizes,
 	                addr_a, addr_b,
@@ -402,9 +488,6 @@ class BackEnd(object):
 		addr_condition = addr_condition or BackEnd.CONDITION_IN_RANGE
 		data_condition = data_condition or BackEnd.CONDITION_IN_RANGE
 		
-		self.write(byte(BackEnd.TRAP_DEFINE | trap_type))
-		self.write(byte(num))
-		
 		# Trap condition field
 		conditions  = 0
 		conditions |= int(bool(bool(in_user)))        << 7
@@ -413,38 +496,30 @@ class BackEnd(object):
 		conditions |= int(bool(bool(on_write)))       << 4
 		conditions |= addr_condition                  << 2
 		conditions |= data_condition                  << 0
-		self.write(byte(conditions))
-		
-		self.write(byte(sizes))
 		
-		self.write(word(addr_a))
-		self.write(word(addr_b))
-		
-		self.write(word(data_a))
-		self.write(word(data_b))
-		
-		self.flush()
+		self.write(TRAP_DEFINE_REQUEST.pack(BackEnd.TRAP_DEFINE | trap_type, num,
+		                                    conditions, sizes,
+		                                    addr_a, addr_b,
+		                                    data_a, data_b))
+		yield
 	
 	
+	@command
 	def trap_read(self, trap_type, num):
 		"""
 		Read a trap's definition returning a dict with the same elements as the
 		arguments to trap_define so that the following is a nop.
 		
-		  trap_define(BackEnd.TRAP_WATCHPOINT, 0, **trap_read(BackEnd.TRAP_WATCHPOINT, 0))
+		  trap_define(BackEnd.TRAP_WATCHPOINT, 0,
+		              **trap_read(BackEnd.TRAP_WATCHPOINT, 0))
 		"""
 		assert(0 <= num < 32)
 		
-		self.write(byte(BackEnd.TRAP_READ | trap_type))
-		self.write(byte(num))
-		self.flush()
+		self.write(TRAP_READ_REQUEST.pack(BackEnd.TRAP_READ | trap_type, num))
+		yield
 		
-		conditions = b2i(self.read_exactly(1))
-		sizes      = b2i(self.read_exactly(1))
-		addr_a     = b2i(self.read_exactly(4))
-		addr_b     = b2i(self.read_exactly(4))
-		data_a     = b2i(self.read_exactly(4))
-		data_b     = b2i(self.read_exactly(4))
+		conditions, sizes, addr_a, addr_b, data_a, data_b = \
+			TRAP_READ_RESPONSE.read(self)
 		
 		in_user        = bool(conditions & (1<<7))
 		in_priviledged = bool(conditions & (1<<6))
@@ -453,7 +528,7 @@ class BackEnd(object):
 		addr_condition = (conditions   & (0b11<<2)) >> 2
 		data_condition = (conditions   & (0b11<<0)) >> 0
 		
-		return {
+		yield {
 			"sizes":          sizes,
 			"addr_a":         addr_a,
 			"addr_b":         addr_b,
@@ -468,6 +543,7 @@ class BackEnd(object):
 		}
 	
 	
+	@command
 	def trap_set_status(self, changes):
 		"""
 		Apply changes to all traps. Changes is {trap_num: op} where op is one of
@@ -483,23 +559,24 @@ class BackEnd(object):
 					bitmasks[bitmask] |= changes[trap_num][bitmask] << trap_num
 		
 		# Send the masks
-		self.write(byte(BackEnd.TRAP_SET_STATUS))
-		for bitmask in bitmasks[::-1]:
-			self.write(word(bitmask))
-		self.flush()
+		self.write(TRAP_SET_STATUS_REQUEST.pack(BackEnd.TRAP_SET_STATUS,
+		                                        *bitmasks[::-1]))
+		yield
 	
 	
+	@command
 	def trap_read_status(self):
 		"""
-		Apply changes to all traps. Returned is {trap_num: state} where state is one of
-		BackEnd.TRAP_NOT_IMPLEMENTED, TRAP_NOT_DEFINED, TRAP_INACTIVE, TRAP_ACTIVE
+		Apply changes to all traps. Returned is {trap_num: state} where state is
+		one of BackEnd.TRAP_NOT_IMPLEMENTED, TRAP_NOT_DEFINED, TRAP_INACTIVE,
+		TRAP_ACTIVE
 		"""
 		# Request the masks
-		self.write(byte(BackEnd.TRAP_READ_STATUS))
-		self.flush()
+		self.write(COMMAND.pack(BackEnd.TRAP_READ_STATUS))
+		yield
 		
 		# Read the masks
-		bitmasks = [b2i(self.read_exactly(4)) for _ in range(2)][::-1]
+		bitmasks = TRAP_STATUS_RESPONSE.read(self)[::-1]
 		
 		# Divide into each trap
 		statuses = {}
@@ -507,104 +584,201 @@ class BackEnd(object):
 			statuses[bit] = tuple(int(bool(bitmasks[mask] & (1<<bit)))
 			                      for mask in range(len(bitmasks)))
 		
-		return statuses
+		yield statuses
 	
 	
-	def memory_write(self, memory_num, element_size, address, data):
+	@command
+	def memory_write(self, memory_num, element_size, address, data,
+	                 address_step = None):
 		"""
 		Write elements of size element_size to the specified memory starting at
 		address for length elements. The element_size is given in bytes.
+		
+		The address_step is the number of addresses occupied by each element and
+		defaults to the element_size (i.e. a byte-addressed memory). Transfers of
+		any length are split into as many commands as required.
 		"""
 		# Only one bank is supported at present
 		assert(memory_num == 0)
 		
-		self._memory_write(BackEnd.MEMORY_MEMORY, element_size, address, data)
+		return self._memory_write.command(self, BackEnd.MEMORY_MEMORY,
+		                                  element_size, address, data,
+		                                  address_step or element_size)
 	
 	
+	@command
 	def register_write(self, element_size, address, data):
 		"""
 		Write elements of size element_size to the registers starting at address for
 		length elements. The element_size is given in bytes.
 		"""
-		self._memory_write(BackEnd.MEMORY_REGISTER, element_size, address, data)
+		return self._memory_write.command(self, BackEnd.MEMORY_REGISTER,
+		                                  element_size, address, data, 1)
 	
 	
-	def memory_read(self, memory_num, element_size, address, length):
+	@command
+	def memory_read(self, memory_num, element_size, address, length,
+	                address_step = None):
 		"""
 		Read elements of size element_size from memory starting at address for
-		length elements. The element_size is given in bytes.
+		length elements. The element_size is given in bytes. Returns a bytearray.
+		
+		The address_step is the number of addresses occupied by each element and
+		defaults to the element_size (i.e. a byte-addressed memory). Transfers of
+		any length are split into as many commands as required.
 		"""
 		# Only one bank is supported at present
 		assert(memory_num == 0)
 		
-		return self._memory_read(BackEnd.MEMORY_MEMORY, element_size, address, length)
+		return self._memory_read.command(self, BackEnd.MEMORY_MEMORY,
+		                                 element_size, address, length,
+		                                 address_step or element_size)
 	
 	
+	@command
 	def register_read(self, element_size, address, length):
 		"""
 		Read elements of size element_size from registers starting at address for
-		length elements. The element_size is given in bytes.
+		length elements. The element_size is given in bytes. Returns a bytearray.
 		"""
-		return self._memory_read(BackEnd.MEMORY_REGISTER, element_size, address, length)
+		return self._memory_read.command(self, BackEnd.MEMORY_REGISTER,
+		                                 element_size, address, length, 1)
 	
 	
-	def _memory_write(self, memory_type, element_size, address, data):
+	def memory_write_(self, memory_num, element_size, address, data,
+	                  address_step = None):
 		"""
-		Internal Use: reg/mem writing function. Will presumably be replaced if/when
-		multiple memory support is added.
+		As memory_write but sends the data one chunk at a time, yielding the number
+		of elements written so far after each chunk.
+		"""
+		# Only one bank is supported at present
+		assert(memory_num == 0)
 		
-		Write elements of size element_size to memory/registers starting at address
-		for length elements. The element_size is given in bytes. The memory type is
-		one of BackEnd.MEMORY_MEMORY or MEMORY_REGISTER.
+		address_step = address_step or element_size
+		length       = len(data) / element_size
+		
+		for chunk_address, offset, chunk_length in \
+		    self._get_chunks(address, length, address_step):
+			chunk = data[offset*element_size : (offset+chunk_length)*element_size]
+			self.run_command(self._memory_write.command(self, BackEnd.MEMORY_MEMORY,
+			                                            element_size, chunk_address,
+			                                            chunk, address_step))
+			yield offset + chunk_length
+	
+	
+	def memory_read_(self, memory_num, element_size, address, buf,
+	                 address_step = None):
+		"""
+		As memory_read but reads into buf (a writable buffer such as a bytearray
+		whose length is a multiple of element_size) one chunk at a time, yielding
+		the number of elements read so far after each chunk.
+		"""
+		# Only one bank is supported at present
+		assert(memory_num == 0)
+		
+		address_step = address_step or element_size
+		length       = len(buf) / element_size
+		view         = memoryview(buf)
+		
+		for chunk_address, offset, chunk_length in \
+		    self._get_chunks(address, length, address_step):
+			chunk = view[offset*element_size : (offset+chunk_length)*element_size]
+			self.run_command(self._memory_read.command(self, BackEnd.MEMORY_MEMORY,
+			                                           element_size, chunk_address,
+			                                           chunk_length, address_step,
+			                                           chunk))
+			yield offset + chunk_length
+	
+	
+	def _get_chunks(self, address, length, address_step):
+		"""
+		Internal Use: split a transfer of length elements starting at address into
+		chunks small enough for a single command. Returns a list of (address,
+		offset, length) for each chunk where offset is the index of the chunk's
+		first element.
+		"""
+		return [(address + (offset * address_step),
+		         offset,
+		         min(BackEnd.MAX_TRANSFER_LENGTH, length - offset))
+		        for offset in range(0, length, BackEnd.MAX_TRANSFER_LENGTH)]
+	
+	
+	def _get_element_size_field(self, element_size):
+		"""
+		Internal Use: get the element size field of a memory transfer command.
 		"""
-		length = (len(data) / element_size)
 		assert(element_size in (1, 2, 4, 8))
-		assert(length < (1<<16))
 		
-		element_size_field = {
+		return {
 			1 : 0b000,
 			2 : 0b001,
 			4 : 0b010,
 			8 : 0b011,
 		}[element_size]
+	
+	
+	@command
+	def _memory_write(self, memory_type, element_size, address, data,
+	                  address_step):
+		"""
+		Internal Use: reg/mem writing function. Will presumably be replaced if/when
+		multiple memory support is added.
 		
-		self.write(byte(BackEnd.MEMORY_WRITE | memory_type | element_size_field))
-		self.write(word(address))
-		self.write(half(length))
-		self.write(data)
-		self.flush()
+		Write elements of size element_size to memory/registers starting at address
+		for length elements. The element_size is given in bytes. The memory type is
+		one of BackEnd.MEMORY_MEMORY or MEMORY_REGISTER. The address_step is the
+		number of addresses each element occupies.
+		"""
+		length  = (len(data) / element_size)
+		command = BackEnd.MEMORY_WRITE | memory_type \
+		          | self._get_element_size_field(element_size)
+		
+		for chunk_address, offset, chunk_length in \
+		    self._get_chunks(address, length, address_step):
+			self.write(MEMORY_REQUEST.pack(command, chunk_address, chunk_length))
+			self.write(data[offset*element_size : (offset+chunk_length)*element_size])
+		yield
 	
 	
-	def _memory_read(self, memory_type, element_size, address, length):
+	@command
+	def _memory_read(self, memory_type, element_size, address, length,
+	                 address_step, buf = None):
 		"""
 		Internal Use: reg/mem writing function. Will presumably be replaced if/when
 		multiple memory support is added.
 		
 		Read elements of size element_size from memory/registers starting at address
 		for length elements. The element_size is given in bytes. The memory type is
-		one of BackEnd.MEMORY_MEMORY or MEMORY_REGISTER.
+		one of BackEnd.MEMORY_MEMORY or MEMORY_REGISTER. The address_step is the
+		number of addresses each element occupies.
+		
+		The data is read into buf (a writable buffer) if given or otherwise into a
+		new bytearray which is returned.
 		"""
-		assert(element_size in (1, 2, 4, 8))
-		assert(length < (1<<16))
+		command = BackEnd.MEMORY_READ | memory_type \
+		          | self._get_element_size_field(element_size)
+		chunks  = self._get_chunks(address, length, address_step)
 		
-		element_size_field = {
-			1 : 0b000,
-			2 : 0b001,
-			4 : 0b010,
-			8 : 0b011,
-		}[element_size]
+		# Request every chunk in one go
+		for chunk_address, _, chunk_length in chunks:
+			self.write(MEMORY_REQUEST.pack(command, chunk_address, chunk_length))
+		yield
 		
-		self.write(byte(BackEnd.MEMORY_READ | memory_type | element_size_field))
-		self.write(word(address))
-		self.write(half(length))
-		self.flush()
+		# Read the chunks straight into the buffer
+		if buf is None:
+			buf = bytearray(length * element_size)
+		view = memoryview(buf)
+		for _, offset, chunk_length in chunks:
+			start = offset * element_size
+			self.read_into(view[start : start + chunk_length*element_size])
 		
-		return self.read_exactly(length * element_size)
+		yield buf
 	
 	
 	def periph_download(self, num, data):
 		"""
-		Download some data into a peripheral (aka feature).
+		Download some data into a peripheral (aka feature). The data may be a string
+		(or other buffer) or a file object (see periph_download_).
 		"""
 		for _ in self.periph_download_(num, data):
 			pass
@@ -612,14 +786,39 @@ class BackEnd(object):
 	def periph_download_(self, num, data):
 		"""
 		Download some data into a peripheral (aka feature).
-		Yields the amount of data sent every packet.
+		Yields the amount of data acknowledged every packet.
+		
+		The data may be a string or any other sliceable buffer (e.g. a buffer of an
+		mmap) or a file object (in which case everything from the current position
+		to the end of the file is sent). Only one packet's worth of data is copied
+		at a time.
+		
+		Up to download_window packets (at most MAX_DOWNLOAD_WINDOW) are sent before
+		waiting for their acknowledgements. If a packet is not acknowledged, the
+		acknowledgements of the packets still in flight are read (and discarded)
+		before an exception is raised.
+		
+		If True is sent into the generator (rather than calling next()), the
+		acknowledgements of all the packets in flight are collected and the progress
+		yielded again without sending anything more so that other commands may be
+		sent before the download is resumed.
 		"""
 		assert(num >= 0)
 		
+		window = max(1, min(self.download_window, BackEnd.MAX_DOWNLOAD_WINDOW))
+		
+		if hasattr(data, "read"):
+			# A file: send from the current position to the end
+			start = data.tell()
+			data.seek(0, 2)
+			length = data.tell() - start
+			data.seek(start)
+		else:
+			length = len(data)
+		
 		# Send the header
-		self.write(byte(BackEnd.PERIPH_DOWNLOAD_HEADER))
-		self.write(byte(num))
-		self.write(word(len(data)))
+		self.write(PERIPH_DOWNLOAD_HEADER_REQUEST.pack(
+			BackEnd.PERIPH_DOWNLOAD_HEADER, num, length))
 		self.flush()
 		
 		# Get the ack
@@ -627,28 +826,77 @@ class BackEnd(object):
 		if resp != "A":
 			raise BackEndError("Expected 'A', got %s"%(repr(resp)))
 		
+		# Lengths of the packets sent but not yet acknowledged
+		in_flight = deque()
+		
 		# Send the data, packet by packet
-		sent = 0
-		while data:
-			packet = data[:BackEnd.PACKET_LENGTH]
-			data   = data[BackEnd.PACKET_LENGTH:]
-			length = len(packet)
-			sent  += length
+		offset = 0
+		acked  = 0
+		while offset < length or in_flight:
+			# Fill the window
+			if offset < length and len(in_flight) < window:
+				while offset < length and len(in_flight) < window:
+					packet  = self._get_download_packet(data, offset, length)
+					offset += len(packet)
+					
+					self.write(PERIPH_MESSAGE_REQUEST.pack(BackEnd.PERIPH_DOWNLOAD_PACKET,
+					                                       num, len(packet)))
+					self.write(packet)
+					in_flight.append(len(packet))
+				self.flush()
 			
-			# Send a packet
-			self.write(byte(BackEnd.PERIPH_DOWNLOAD_PACKET))
-			self.write(byte(num))
-			self.write(byte(length))
-			self.write(packet)
-			self.flush()
+			# Wait for the oldest packet to be acknowledged
+			acked += self._read_download_ack(in_flight)
 			
-			resp = self.read(1)
-			if resp != "A":
-				raise BackEndError("Expected 'A', got %s"%(repr(resp)))
-			
-			yield sent
+			if (yield acked):
+				# Asked to pause: wait for the rest of the packets in flight
+				while in_flight:
+					acked += self._read_download_ack(in_flight)
+				yield acked
+	
 	
+	def _read_download_ack(self, in_flight):
+		"""
+		Read the acknowledgement of the oldest download packet in flight (a deque of
+		packet lengths) returning its length.
+		"""
+		resp = self.read(1)
+		packet_length = in_flight.popleft()
+		if resp != "A":
+			self._drain_download_acks(len(in_flight))
+			raise BackEndError("Expected 'A', got %s"%(repr(resp)))
+		return packet_length
 	
+	
+	def _get_download_packet(self, data, offset, length):
+		"""
+		Get the packet of download data (a buffer or file, see periph_download_)
+		which starts at the given offset of length bytes.
+		"""
+		packet_length = min(BackEnd.PACKET_LENGTH, length - offset)
+		
+		if hasattr(data, "read"):
+			packet = data.read(packet_length)
+			if len(packet) != packet_length:
+				raise BackEndError("Download data ended %d bytes early."%(
+				                   length - offset - len(packet)))
+			return packet
+		else:
+			return data[offset:offset + packet_length]
+	
+	
+	def _drain_download_acks(self, count):
+		"""
+		Read and discard the acknowledgements of count download packets after a
+		download has failed.
+		"""
+		for _ in range(count):
+			if not self.read(1):
+				# Nothing more is coming
+				break
+	
+	
+	@command
 	def run(self, max_steps = 0,
 	        halt_on_watchpoint = True, halt_on_breakpoint = True,
 	        halt_on_mem_fault = False, step_over_swi = False,
@@ -665,6 +913,5 @@ class BackEnd(object):
 		command |= int(bool(step_over_bl))               << 1
 		command |= int(bool(break_on_first_instruction)) << 0
 		
-		self.write(byte(command))
-		self.write(word(max_steps))
-		self.flush()
+		self.write(RUN_REQUEST.pack(command, max_steps))
+		yield
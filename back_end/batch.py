@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Support for pipelining commands to a back-end.
+
+Each protocol command is implemented as a generator which writes its request to
+the device and then yields. Once the output has been flushed the generator is
+resumed to read and decode the response which it yields as its result. This
+allows a number of commands to be written to the device with a single flush and
+their responses to be collected afterwards, saving a round trip per command.
+"""
+
+from exceptions import BackEndError
+
+
+def command(f):
+	"""
+	Decorator for BackEnd command generators (see above). The decorated method
+	sends the command, flushes and returns the response as usual. The undecorated
+	generator is available as the method's "command" attribute for use by Batch.
+	"""
+	def wrapper(self, *args, **kwargs):
+		return self.run_command(f(self, *args, **kwargs))
+	wrapper.__name__ = f.__name__
+	wrapper.__doc__  = f.__doc__
+	wrapper.command  = f
+	return wrapper
+
+
+class BatchResult(object):
+	"""
+	The result of a command in a Batch. The value is available once the batch has
+	been executed.
+	"""
+	
+	def __init__(self, name = None):
+		self.name  = name
+		self.done  = False
+		self.value = None
+	
+	
+	def set(self, value):
+		self.value = value
+		self.done  = True
+	
+	
+	def get(self):
+		"""
+		Get the result of the command. Raises a BackEndError if the command has not
+		been completed.
+		"""
+		if not self.done:
+			raise BackEndError("Batched command %s was not completed."%(
+			                   self.name or ""))
+		return self.value
+
+
+class Batch(object):
+	"""
+	A queue of commands to be sent to a back-end in one go. Any command method of
+	the back-end may be called on the batch with the usual arguments. This queues
+	the command and returns a BatchResult which receives the response when the
+	batch is executed, for example:
+		
+		batch  = back_end.batch()
+		status = batch.get_status()
+		regs   = batch.register_read(4, 0, 16)
+		batch.execute()
+		print status.get(), regs.get()
+	
+	If used in a with-statement, the batch is executed at the end of the block
+	(unless an exception occurred).
+	
+	If an error occurs while reading the responses, the exception is raised by
+	execute() and the results of the unfinished commands remain incomplete.
+	"""
+	
+	def __init__(self, back_end):
+		self.back_end = back_end
+		
+		# A list of (command generator, BatchResult) tuples
+		self.commands = []
+	
+	
+	def __getattr__(self, name):
+		method = getattr(self.back_end, name)
+		if not hasattr(method, "command"):
+			raise AttributeError("%s cannot be batched"%name)
+		
+		def queue(*args, **kwargs):
+			result = BatchResult(name)
+			self.commands.append((method.command(self.back_end, *args, **kwargs),
+			                      result))
+			return result
+		
+		return queue
+	
+	
+	def __len__(self):
+		return len(self.commands)
+	
+	
+	def execute(self):
+		"""
+		Send all queued commands in one go and then read back their responses.
+		"""
+		commands = self.commands
+		self.commands = []
+		
+		if not commands:
+			return
+		
+		# Send all the requests
+		for cmd, _ in commands:
+			cmd.next()
+		self.back_end.flush()
+		
+		# Collect the responses (in order)
+		for cmd, result in commands:
+			result.set(next(cmd, None))
+	
+	
+	def __enter__(self):
+		return self
+	
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.execute()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""
+Declarative descriptions of the messages of the KMD comms protocol.
+
+Each message is described once as a sequence of (name, format) fields where the
+format is a struct format character (B, H or I for 8, 16 and 32 bit unsigned
+little-endian values). The description is compiled into a struct.Struct so that
+a whole message can be packed, read or unpacked in one go rather than field by
+field.
+"""
+
+import struct
+
+
+class Message(object):
+	
+	def __init__(self, *fields):
+		"""
+		Define a message consisting of the given (name, format) fields.
+		"""
+		self.names   = tuple(name for name, _ in fields)
+		self.formats = "".join(fmt for _, fmt in fields)
+		
+		self.struct = struct.Struct("<" + self.formats)
+		self.size   = self.struct.size
+		
+		# Masks for each field such that out-of-range values are truncated (as is
+		# expected of a fixed-width field) rather than rejected.
+		self.masks = tuple((1 << (8 * struct.calcsize("<" + fmt))) - 1
+		                   for fmt in self.formats)
+		
+		# Compiled structs for arrays of this message, {count: struct}
+		self.arrays = {}
+	
+	
+	def pack(self, *values):
+		"""
+		Pack the given field values into a string.
+		"""
+		return self.struct.pack(*[value & mask
+		                          for value, mask in zip(values, self.masks)])
+	
+	
+	def unpack(self, data):
+		"""
+		Unpack a string containing exactly one message into a tuple of values.
+		"""
+		return self.struct.unpack(data)
+	
+	
+	def unpack_from(self, data, offset = 0):
+		"""
+		Unpack a message from a buffer starting at the given offset.
+		"""
+		return self.struct.unpack_from(data, offset)
+	
+	
+	def read(self, back_end):
+		"""
+		Read and unpack a single message from a back-end.
+		"""
+		return self.struct.unpack(back_end.read_exactly(self.size))
+	
+	
+	def get_array(self, count):
+		"""
+		Get a struct which unpacks count consecutive messages.
+		"""
+		if count not in self.arrays:
+			self.arrays[count] = struct.Struct("<" + (self.formats * count))
+		return self.arrays[count]
+	
+	
+	def unpack_array_from(self, data, count, offset = 0):
+		"""
+		Unpack count consecutive messages from a buffer starting at the given offset.
+		Returns a list of tuples of values.
+		"""
+		values = self.get_array(count).unpack_from(data, offset)
+		fields = len(self.names)
+		return [values[n:n+fields] for n in range(0, len(values), fields)]
+
+
+# Requests
+COMMAND = Message(("command", "B"))
+
+PERIPH_REQUEST = Message(("command", "B"),
+                         ("num",     "B"))
+
+PERIPH_STATUS_REQUEST = Message(("command", "B"),
+                                ("num",     "B"),
+                                ("status",  "I"))
+
+PERIPH_MESSAGE_REQUEST = Message(("command", "B"),
+                                 ("num",     "B"),
+                                 ("length",  "B"))
+
+PERIPH_DOWNLOAD_HEADER_REQUEST = Message(("command", "B"),
+                                         ("num",     "B"),
+                                         ("length",  "I"))
+
+TRAP_DEFINE_REQUEST = Message(("command",    "B"),
+                              ("num",        "B"),
+                              ("conditions", "B"),
+                              ("sizes",      "B"),
+                              ("addr_a",     "I"),
+                              ("addr_b",     "I"),
+                              ("data_a",     "I"),
+                              ("data_b",     "I"))
+
+TRAP_READ_REQUEST = Message(("command", "B"),
+                            ("num",     "B"))
+
+TRAP_SET_STATUS_REQUEST = Message(("command",   "B"),
+                                  ("bitmask_1", "I"),
+                                  ("bitmask_0", "I"))
+
+MEMORY_REQUEST = Message(("command", "B"),
+                         ("address", "I"),
+                         ("length",  "H"))
+
+RUN_REQUEST = Message(("command",   "B"),
+                      ("max_steps", "I"))
+
+
+# Responses
+BYTE_RESPONSE = Message(("value", "B"))
+
+WORD_RESPONSE = Message(("value", "I"))
+
+BOARD_DEFINITION_LENGTH = Message(("length", "H"))
+
+BOARD_DEFINITION_CPU = Message(("cpu_type",      "B"),
+                               ("cpu_sub_type",  "H"),
+                               ("feature_count", "B"))
+
+BOARD_DEFINITION_FEATURE = Message(("feature_id",     "B"),
+                                   ("feature_sub_id", "H"))
+
+BOARD_DEFINITION_SEGMENT_COUNT = Message(("segment_count", "B"))
+
+BOARD_DEFINITION_SEGMENT = Message(("segment_addr",   "I"),
+                                   ("segment_length", "I"))
+
+STATUS_RESPONSE = Message(("status",            "B"),
+                          ("steps_remaining",   "I"),
+                          ("steps_since_reset", "I"))
+
+TRAP_READ_RESPONSE = Message(("conditions", "B"),
+                             ("sizes",      "B"),
+                             ("addr_a",     "I"),
+                             ("addr_b",     "I"),
+                             ("data_a",     "I"),
+                             ("data_b",     "I"))
+
+TRAP_STATUS_RESPONSE = Message(("bitmask_1", "I"),
+                               ("bitmask_0", "I"))
+
+
+# Struct format characters for memory elements of each size (in bytes)
+ELEMENT_FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+def unpack_elements(data, element_size, length, offset = 0):
+	"""
+	Unpack length little-endian elements of element_size bytes from a buffer
+	starting at the given (byte) offset. Returns a tuple of ints.
+	"""
+	return struct.unpack_from("<%d%s"%(length, ELEMENT_FORMATS[element_size]),
+	                          data, offset)
+
+
+def pack_elements(values, element_size):
+	"""
+	Pack a sequence of ints into a string of little-endian elements of
+	element_size bytes. Values are truncated to fit.
+	"""
+	mask = (1 << (8 * element_size)) - 1
+	return struct.pack("<%d%s"%(len(values), ELEMENT_FORMATS[element_size]),
+	                   *[value & mask for value in values])
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+A back-end for the protocol which talks to a simulator running within the same
+process (see the simulator package). No subprocess or hardware is required.
+
+The simulator's memory and registers are also made available directly (see
+BackEnd.memory_buffer) so that they can be accessed without going through the
+protocol at all.
+"""
+
+from contextlib import contextmanager
+
+from base       import BackEnd
+from exceptions import BackEndError
+
+from simulator import SIMULATORS, KMDSlave
+
+
+class InProcessBackEnd(BackEnd):
+	
+	def __init__(self, architecture):
+		"""
+		Starts a simulator of the named architecture (one of the keys of
+		simulator.SIMULATORS, e.g. "MU0").
+		"""
+		BackEnd.__init__(self)
+		
+		if architecture not in SIMULATORS:
+			raise BackEndError("No simulator for %s (available: %s)"%(
+			                   architecture, ", ".join(sorted(SIMULATORS))))
+		
+		self.name = "%s Simulator"%architecture
+		
+		self.simulator = SIMULATORS[architecture]()
+		self.slave     = KMDSlave(self.simulator)
+	
+	
+	def read(self, length):
+		return self.slave.read(length)
+	
+	
+	def write(self, data):
+		self.slave.write(data)
+	
+	
+	def flush(self):
+		self.slave.process()
+	
+	
+	def memory_buffer(self, memory_num):
+		# Only one bank is supported at present
+		return self.simulator.memory if memory_num == 0 else None
+	
+	
+	def register_file(self):
+		return self.simulator.registers
+	
+	
+	@contextmanager
+	def direct_access(self, written = False):
+		with self.simulator.lock:
+			yield
+			if written:
+				self.simulator.registers_written()
+	
+	
+	def close(self):
+		self.slave.close()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""
+Measurement of the traffic between Perentie and a device.
+
+A MeteredBackEnd wraps any other back-end and records, for every command sent,
+the number of bytes sent and received and the time taken for the response to
+arrive (the latency) in a LinkMetrics object. Commands are identified by their
+opcode (e.g. MEMORY_READ, REGISTER_READ, GET_STATUS) and attributed to the
+caller which sent them: the thread they were sent from (threads created by
+RunInBackground are named after the function they run, see also
+set_caller_thread) and the System method which sent them (see
+set_device_caller).
+"""
+
+from time      import time
+from threading import Lock, local, current_thread
+
+from base       import BackEnd
+from batch      import Batch
+from recording  import get_command_name
+
+
+# Per-thread information about who is currently using the device
+_callers = local()
+
+
+def set_device_caller(name):
+	"""
+	Set the name of the System method which is using the device in the current
+	thread (to attribute commands to).
+	"""
+	_callers.device = name
+
+
+def set_caller_thread(name):
+	"""
+	Set the name of the thread on whose behalf the current thread is using the
+	device (e.g. when requests are carried out by a scheduler thread) or None if
+	it is acting for itself.
+	"""
+	_callers.thread = name
+
+
+def get_caller():
+	"""
+	Get a string describing who is using the device in the current thread.
+	"""
+	return "%s / %s"%(getattr(_callers, "thread", None) or current_thread().name,
+	                  getattr(_callers, "device", None) or "-")
+
+
+class CommandStats(object):
+	"""
+	Statistics for commands of one type sent by one caller.
+	"""
+	
+	# Latencies are counted in a histogram where bucket n counts latencies of less
+	# than 2**n microseconds (and more than the previous bucket). The last bucket
+	# counts everything longer.
+	LATENCY_BUCKETS = 24
+	
+	def __init__(self):
+		self.count          = 0
+		self.bytes_sent     = 0
+		self.bytes_received = 0
+		self.total_latency  = 0.0
+		self.histogram      = [0] * CommandStats.LATENCY_BUCKETS
+	
+	
+	def add(self, bytes_sent, bytes_received, latency):
+		self.count          += 1
+		self.bytes_sent     += bytes_sent
+		self.bytes_received += bytes_received
+		self.total_latency  += latency
+		
+		bucket = min(int(latency * 1e6).bit_length(), CommandStats.LATENCY_BUCKETS - 1)
+		self.histogram[bucket] += 1
+	
+	
+	def copy(self):
+		stats = CommandStats()
+		stats.count          = self.count
+		stats.bytes_sent     = self.bytes_sent
+		stats.bytes_received = self.bytes_received
+		stats.total_latency  = self.total_latency
+		stats.histogram      = self.histogram[:]
+		return stats
+	
+	
+	def get_mean_latency(self):
+		return self.total_latency / self.count if self.count else 0.0
+	
+	
+	def get_latency_percentile(self, percentile):
+		"""
+		Get an upper bound on the given percentile (0-100) of latencies in seconds
+		according to the histogram.
+		"""
+		target = self.count * percentile / 100.0
+		seen   = 0
+		for bucket, count in enumerate(self.histogram):
+			seen += count
+			if count and seen >= target:
+				return (1 << bucket) / 1e6
+		return 0.0
+
+
+class LinkMetrics(object):
+	"""
+	A thread-safe collection of CommandStats for each (command, caller) pair.
+	"""
+	
+	def __init__(self):
+		self.lock = Lock()
+		self.reset()
+	
+	
+	def reset(self):
+		"""
+		Discard all the statistics collected so far.
+		"""
+		with self.lock:
+			self.stats      = {}
+			self.start_time = time()
+	
+	
+	def record(self, command, caller, bytes_sent, bytes_received, latency):
+		with self.lock:
+			key = (command, caller)
+			if key not in self.stats:
+				self.stats[key] = CommandStats()
+			self.stats[key].add(bytes_sent, bytes_received, latency)
+	
+	
+	def get_stats(self):
+		"""
+		Get a snapshot of the statistics as a dictionary {(command, caller):
+		CommandStats}.
+		"""
+		with self.lock:
+			return dict((key, stats.copy()) for (key, stats) in self.stats.iteritems())
+	
+	
+	def get_duration(self):
+		"""
+		Get the number of seconds over which the statistics have been collected.
+		"""
+		return time() - self.start_time
+
+
+class MeteredBatch(Batch):
+	"""
+	A Batch whose commands are recorded in the back-end's LinkMetrics. Each
+	command is attributed to the caller which queued it.
+	"""
+	
+	def __init__(self, back_end):
+		Batch.__init__(self, back_end)
+		
+		# The caller of each command queued (see get_caller)
+		self.callers = []
+	
+	
+	def __getattr__(self, name):
+		queue = Batch.__getattr__(self, name)
+		
+		def metered_queue(*args, **kwargs):
+			result = queue(*args, **kwargs)
+			self.callers.append(get_caller())
+			return result
+		
+		return metered_queue
+	
+	
+	def execute(self):
+		commands = self.commands
+		callers  = self.callers
+		self.commands = []
+		self.callers  = []
+		
+		if not commands:
+			return
+		
+		back_end = self.back_end
+		
+		# Send all the requests noting what was sent for each
+		requests = []
+		for cmd, _ in commands:
+			requests.append(back_end._start_request())
+			cmd.next()
+			requests[-1] = back_end._end_request(requests[-1])
+		flush_time = time()
+		back_end.flush()
+		
+		# Collect the responses (in order)
+		for (cmd, result), (command, bytes_sent), caller in zip(commands, requests,
+		                                                        callers):
+			bytes_read = back_end.bytes_read
+			try:
+				result.set(next(cmd, None))
+			finally:
+				back_end.metrics.record(command, caller, bytes_sent,
+				                        back_end.bytes_read - bytes_read,
+				                        time() - flush_time)
+
+
+class MeteredBackEnd(BackEnd):
+	
+	def __init__(self, back_end, metrics = None):
+		"""
+		Wraps the given back-end, recording the commands sent through it in the
+		given LinkMetrics (or a new one if not given, available as .metrics).
+		"""
+		BackEnd.__init__(self)
+		
+		self.back_end = back_end
+		self.name     = back_end.name
+		self.metrics  = metrics if metrics is not None else LinkMetrics()
+		
+		# Total bytes passed through the back-end
+		self.bytes_written = 0
+		self.bytes_read    = 0
+		
+		# The opcode of the first byte written since _start_request (or None)
+		self.request_opcode = None
+	
+	
+	def _start_request(self):
+		"""
+		Called before a command writes its request. Returns a value to be passed to
+		_end_request.
+		"""
+		self.request_opcode = None
+		return self.bytes_written
+	
+	
+	def _end_request(self, bytes_written):
+		"""
+		Called after a command has written its request. Returns (command name,
+		bytes sent).
+		"""
+		if self.request_opcode is None:
+			command = "NONE"
+		else:
+			command = get_command_name(self.request_opcode)
+		return (command, self.bytes_written - bytes_written)
+	
+	
+	def read(self, length):
+		data = self.back_end.read(length)
+		self.bytes_read += len(data)
+		return data
+	
+	
+	def read_into(self, buf):
+		self.back_end.read_into(buf)
+		self.bytes_read += len(buf)
+	
+	
+	def ignore(self, length):
+		# Passed on so that the back-end knows the read may fall short
+		data = self.back_end.ignore(length)
+		self.bytes_read += len(data)
+		return data
+	
+	
+	def write(self, data):
+		if self.request_opcode is None and len(data):
+			self.request_opcode = bytearray(data[:1])[0]
+		self.bytes_written += len(data)
+		self.back_end.write(data)
+	
+	
+	def flush(self):
+		self.back_end.flush()
+	
+	
+	def close(self):
+		self.back_end.close()
+	
+	
+	def run_command(self, cmd):
+		caller = get_caller()
+		
+		request = self._start_request()
+		cmd.next()
+		command, bytes_sent = self._end_request(request)
+		
+		flush_time = time()
+		bytes_read = self.bytes_read
+		try:
+			self.flush()
+			return next(cmd, None)
+		finally:
+			self.metrics.record(command, caller, bytes_sent,
+			                    self.bytes_read - bytes_read, time() - flush_time)
+	
+	
+	def batch(self):
+		return MeteredBatch(self)
+	
+	
+	# Direct access doesn't use the link and so isn't metered
+	def memory_buffer(self, memory_num):
+		return self.back_end.memory_buffer(memory_num)
+	
+	
+	def register_file(self):
+		return self.back_end.register_file()
+	
+	
+	def direct_access(self, written = False):
+		return self.back_end.direct_access(written)
+	
+	
+	def periph_download_(self, num, data):
+		# Each packet is recorded as a command (the first along with the header)
+		caller = get_caller()
+		
+		request    = self._start_request()
+		bytes_read = self.bytes_read
+		start_time = time()
+		
+		download = BackEnd.periph_download_(self, num, data)
+		pause    = None
+		while True:
+			# Pass on any request to pause (see BackEnd.periph_download_)
+			try:
+				progress = download.send(pause)
+			except StopIteration:
+				return
+			
+			# The acknowledgements collected when paused are counted along with the
+			# next packet
+			if pause:
+				carried = self.bytes_read - bytes_read
+			else:
+				carried = 0
+				command, bytes_sent = self._end_request(request)
+				if not bytes_sent:
+					# Only the acknowledgements of packets already sent were read
+					command = "PERIPH_DOWNLOAD_PACKET"
+				self.metrics.record(command, caller, bytes_sent,
+				                    self.bytes_read - bytes_read, time() - start_time)
+			
+			pause = yield progress
+			
+			request    = self._start_request()
+			bytes_read = self.bytes_read - carried
+			start_time = time()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+"""
+Recording and replaying of the traffic between Perentie and a device.
+
+A RecordingBackEnd wraps any other back-end and logs every write, read and
+flush (with a timestamp) to a trace file. A ReplayBackEnd plays the responses
+in a trace back (optionally with their original latencies) so that sessions
+captured from real hardware can be re-run, e.g. for benchmarking, without the
+hardware. The requests made during a replay must match those in the trace
+since the recorded responses would otherwise be meaningless, except that polls
+of the device (whose timing depends on the clock) needn't be made at quite the
+same times (see ReplayBackEnd).
+
+A trace file starts with TRACE_HEADER and is followed by a sequence of records
+each consisting of a TRACE_RECORD followed by the record's data. Times are in
+microseconds since the start of the recording.
+
+A summary of the commands sent in a trace (to compare the command mix of two
+sessions) can be printed using:
+	
+	python -m back_end.recording trace_file [other_trace_file]
+"""
+
+import sys, struct
+
+from time import time, sleep
+
+from base       import BackEnd
+from exceptions import BackEndError
+from codec      import *
+
+
+TRACE_MAGIC   = "KMDTRACE"
+TRACE_VERSION = 1
+
+TRACE_HEADER = struct.Struct("<8sB")
+
+TRACE_RECORD = Message(("type",   "B"),
+                       ("time",   "Q"),
+                       ("length", "I"))
+
+# Record types
+RECORD_WRITE = 0x00
+RECORD_READ  = 0x01
+RECORD_FLUSH = 0x02
+
+
+def read_trace(filename):
+	"""
+	Read a trace file returning a list of (type, time, data) records where time
+	is in seconds.
+	"""
+	try:
+		with open(filename, "rb") as f:
+			trace = f.read()
+	except IOError, e:
+		raise BackEndError("Could not read trace %s: %s"%(filename, e))
+	
+	if len(trace) < TRACE_HEADER.size:
+		raise BackEndError("%s is not a trace file"%filename)
+	magic, version = TRACE_HEADER.unpack_from(trace)
+	if magic != TRACE_MAGIC:
+		raise BackEndError("%s is not a trace file"%filename)
+	if version != TRACE_VERSION:
+		raise BackEndError("Unsupported trace version %d"%version)
+	
+	records = []
+	offset  = TRACE_HEADER.size
+	while offset + TRACE_RECORD.size <= len(trace):
+		record_type, timestamp, length = TRACE_RECORD.unpack_from(trace, offset)
+		offset += TRACE_RECORD.size
+		records.append((record_type, timestamp / 1e6, trace[offset:offset + length]))
+		offset += length
+	
+	return records
+
+
+class RecordingBackEnd(BackEnd):
+	
+	def __init__(self, back_end, filename):
+		"""
+		Wraps the given back-end, recording all traffic to a trace file with the
+		given filename.
+		"""
+		BackEnd.__init__(self)
+		
+		self.back_end = back_end
+		self.name     = back_end.name
+		
+		try:
+			self.trace = open(filename, "wb")
+		except IOError, e:
+			raise BackEndError("Could not create trace %s: %s"%(filename, e))
+		
+		self.trace.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+		self.start_time = time()
+	
+	
+	def _record(self, record_type, data = ""):
+		timestamp = int((time() - self.start_time) * 1e6)
+		self.trace.write(TRACE_RECORD.pack(record_type, timestamp, len(data)))
+		self.trace.write(data)
+	
+	
+	def read(self, length):
+		data = self.back_end.read(length)
+		self._record(RECORD_READ, data)
+		return data
+	
+	
+	def read_into(self, buf):
+		self.back_end.read_into(buf)
+		
+		# Only recorded once read in full: after a failure it isn't known how much of
+		# the buffer was filled
+		self._record(RECORD_READ, buf.tobytes())
+	
+	
+	def ignore(self, length):
+		# Passed on so that the back-end knows the read may fall short
+		data = self.back_end.ignore(length)
+		self._record(RECORD_READ, data)
+		return data
+	
+	
+	def write(self, data):
+		self._record(RECORD_WRITE, str(data))
+		self.back_end.write(data)
+	
+	
+	def flush(self):
+		self._record(RECORD_FLUSH)
+		self.back_end.flush()
+	
+	
+	def close(self):
+		try:
+			self.back_end.close()
+		finally:
+			self.trace.close()
+
+
+class ReplayBackEnd(BackEnd):
+	
+	# Commands which are sent at times which depend on the clock (polls, resyncs and
+	# board definition checks) rather than on what the user does
+	TIMING_COMMANDS = ("NOP", "PING", "GET_STATUS", "GET_BOARD_DEFINITION")
+	
+	def __init__(self, filename, realtime = False):
+		"""
+		Serves the responses recorded in the given trace file. If realtime is True,
+		each response is delayed by (at least) the time it originally took to arrive
+		after the preceding flush.
+		
+		The trace is replayed one exchange (the requests written before a flush and
+		the responses read after it) at a time. The requests sent at each flush are
+		matched with the next exchange in the trace with the same requests, skipping
+		any recorded exchanges made up only of TIMING_COMMANDS. Exchanges made up
+		only of TIMING_COMMANDS which aren't found in order are answered with the
+		nearest recorded exchange with the same requests since polls don't happen
+		at quite the same times in a replay. Anything else which differs from the
+		trace raises a BackEndError.
+		"""
+		BackEnd.__init__(self)
+		
+		self.name     = "Replay"
+		self.realtime = realtime
+		
+		# The recorded exchanges [(requests, delay, responses), ...] where delay is
+		# the time from the flush to the first response. The index of the next
+		# exchange expected.
+		self.exchanges     = []
+		self.next_exchange = 0
+		
+		# The requests written since the last flush
+		self.requests = []
+		
+		# The unread part of the current responses and the time at which they are
+		# due to start arriving (or None once they have)
+		self.pending  = ""
+		self.due_time = None
+		
+		requests   = []
+		exchange   = None
+		flush_time = 0.0
+		for record_type, timestamp, data in read_trace(filename):
+			if record_type == RECORD_WRITE:
+				requests.append(data)
+			elif record_type == RECORD_FLUSH and requests:
+				exchange   = ["".join(requests), None, []]
+				flush_time = timestamp
+				requests   = []
+				self.exchanges.append(exchange)
+			elif record_type == RECORD_READ and data and exchange is not None:
+				if exchange[1] is None:
+					exchange[1] = timestamp - flush_time
+				exchange[2].append(data)
+		
+		self.exchanges = [(requests, delay or 0.0, "".join(responses))
+		                  for (requests, delay, responses) in self.exchanges]
+	
+	
+	def _is_timing_driven(self, requests):
+		"""
+		Does a string of requests consist only of TIMING_COMMANDS?
+		"""
+		offset = 0
+		while offset < len(requests):
+			name = get_command_name(ord(requests[offset]))
+			if name not in ReplayBackEnd.TIMING_COMMANDS:
+				return False
+			length = get_request_length(requests, offset)
+			if length is None:
+				return False
+			offset += length
+		return True
+	
+	
+	def _find_exchange(self, requests):
+		"""
+		Find the recorded exchange to answer the given requests with (see
+		__init__). Returns (delay, responses).
+		"""
+		# The next matching exchange, skipping timing-driven ones
+		index = self.next_exchange
+		while index < len(self.exchanges):
+			if self.exchanges[index][0] == requests:
+				self.next_exchange = index + 1
+				return self.exchanges[index][1:]
+			if not self._is_timing_driven(self.exchanges[index][0]):
+				break
+			index += 1
+		
+		# A timing-driven exchange made at a different time to the original
+		if self._is_timing_driven(requests):
+			for other in (range(self.next_exchange, len(self.exchanges))
+			              + range(self.next_exchange - 1, -1, -1)):
+				if self.exchanges[other][0] == requests:
+					return self.exchanges[other][1:]
+		
+		if index < len(self.exchanges):
+			expected = get_command_names(self.exchanges[index][0])
+		else:
+			expected = "the end of the trace"
+		raise BackEndError("Replay differs from the trace at exchange %d: "
+		                   "expected %s, got %s"%(index, expected,
+		                                          get_command_names(requests)))
+	
+	
+	def read(self, length):
+		if self.realtime and self.due_time is not None:
+			remaining = self.due_time - time()
+			if remaining > 0:
+				sleep(remaining)
+		self.due_time = None
+		
+		data = self.pending[:length]
+		self.pending = self.pending[length:]
+		return data
+	
+	
+	def write(self, data):
+		self.requests.append(str(data))
+	
+	
+	def flush(self):
+		requests = "".join(self.requests)
+		self.requests = []
+		if not requests:
+			return
+		
+		delay, responses = self._find_exchange(requests)
+		self.pending += responses
+		self.due_time = time() + delay
+	
+	
+	def close(self):
+		pass
+
+
+def get_command_name(command):
+	"""
+	Get a human-readable name for a command byte.
+	"""
+	if command & 0xC0 == BackEnd.RUN:
+		return "RUN"
+	elif command & 0xE0 == BackEnd.MEMORY_WRITE:
+		return "%s_%s"%("REGISTER" if command & BackEnd.MEMORY_REGISTER else "MEMORY",
+		                "READ" if command & 0x08 else "WRITE")
+	elif command & 0xF0 == BackEnd.TRAP_DEFINE:
+		return {
+			BackEnd.TRAP_DEFINE:      "TRAP_DEFINE",
+			BackEnd.TRAP_READ:        "TRAP_READ",
+			BackEnd.TRAP_SET_STATUS:  "TRAP_SET_STATUS",
+			BackEnd.TRAP_READ_STATUS: "TRAP_READ_STATUS",
+		}.get(command & 0xF3, "UNKNOWN")
+	else:
+		for name in ("NOP", "PING", "GET_BOARD_DEFINITION", "RESET",
+		             "PERIPH_GET_STATUS", "PERIPH_SET_STATUS",
+		             "PERIPH_SEND_MESSAGE", "PERIPH_GET_MESSAGE",
+		             "PERIPH_DOWNLOAD_HEADER", "PERIPH_DOWNLOAD_PACKET",
+		             "GET_STATUS", "STOP_EXECUTION", "PAUSE_EXECUTION",
+		             "CONTINUE_EXECUTION"):
+			if getattr(BackEnd, name) == command:
+				return name
+		return "UNKNOWN"
+
+
+def get_command_names(requests):
+	"""
+	Get a human-readable list of the commands in a string of requests.
+	"""
+	names  = []
+	offset = 0
+	while offset < len(requests):
+		names.append(get_command_name(ord(requests[offset])))
+		length = get_request_length(requests, offset)
+		if length is None:
+			break
+		offset += length
+	return ", ".join(names)
+
+
+def get_request_length(data, offset):
+	"""
+	Get the length of the request (including any data) at the given offset of a
+	string of requests or None if the request is incomplete.
+	"""
+	command = ord(data[offset])
+	name    = get_command_name(command)
+	
+	if name in ("MEMORY_WRITE", "REGISTER_WRITE"):
+		if offset + MEMORY_REQUEST.size > len(data):
+			return None
+		_, _, length = MEMORY_REQUEST.unpack_from(data, offset)
+		return MEMORY_REQUEST.size + (length << (command & 0b111))
+	elif name in ("PERIPH_SEND_MESSAGE", "PERIPH_DOWNLOAD_PACKET"):
+		if offset + PERIPH_MESSAGE_REQUEST.size > len(data):
+			return None
+		_, _, length = PERIPH_MESSAGE_REQUEST.unpack_from(data, offset)
+		return PERIPH_MESSAGE_REQUEST.size + length
+	else:
+		return {
+			"MEMORY_READ":            MEMORY_REQUEST,
+			"REGISTER_READ":          MEMORY_REQUEST,
+			"RUN":                    RUN_REQUEST,
+			"TRAP_DEFINE":            TRAP_DEFINE_REQUEST,
+			"TRAP_READ":              TRAP_READ_REQUEST,
+			"TRAP_SET_STATUS":        TRAP_SET_STATUS_REQUEST,
+			"PERIPH_GET_STATUS":      PERIPH_REQUEST,
+			"PERIPH_SET_STATUS":      PERIPH_STATUS_REQUEST,
+			"PERIPH_GET_MESSAGE":     PERIPH_MESSAGE_REQUEST,
+			"PERIPH_DOWNLOAD_HEADER": PERIPH_DOWNLOAD_HEADER_REQUEST,
+		}.get(name, COMMAND).size
+
+
+def summarise_trace(filename):
+	"""
+	Produce a summary of a trace file. Returns a tuple (duration, flushes,
+	bytes_written, bytes_read, commands) where commands is a dictionary {name:
+	(count, bytes)} giving the number of each type of command sent and the
+	number of bytes of requests they took up.
+	"""
+	records = read_trace(filename)
+	
+	duration      = records[-1][1] if records else 0.0
+	flushes       = sum(1 for record_type, _, _ in records if record_type == RECORD_FLUSH)
+	bytes_read    = sum(len(data) for record_type, _, data in records
+	                    if record_type == RECORD_READ)
+	requests      = "".join(data for record_type, _, data in records
+	                        if record_type == RECORD_WRITE)
+	
+	commands = {}
+	offset   = 0
+	while offset < len(requests):
+		name   = get_command_name(ord(requests[offset]))
+		length = get_request_length(requests, offset)
+		if length is None or offset + length > len(requests):
+			break
+		
+		count, num_bytes = commands.get(name, (0, 0))
+		commands[name] = (count + 1, num_bytes + length)
+		offset += length
+	
+	return (duration, flushes, len(requests), bytes_read, commands)
+
+
+if __name__=="__main__":
+	if not 2 <= len(sys.argv) <= 3:
+		sys.stderr.write("Usage: python -m back_end.recording trace_file [other_trace_file]\n")
+		sys.exit(1)
+	
+	summaries = map(summarise_trace, sys.argv[1:])
+	
+	print "%-24s"%"" + "".join("%24s"%filename for filename in sys.argv[1:])
+	for num, field in enumerate(("Duration (s)", "Flushes", "Bytes written", "Bytes read")):
+		print "%-24s"%field + "".join("%24s"%summary[num] for summary in summaries)
+	
+	print
+	names = sorted(set(name for summary in summaries for name in summary[4]))
+	for name in names:
+		print "%-24s"%name + "".join("%24s"%("%d (%d bytes)"%summary[4].get(name, (0, 0)))
+		                             for summary in summaries)
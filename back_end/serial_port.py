@@ -2,43 +2,271 @@
 
 """
 A serial-port back-end for the protocol.
+
+Writes are combined until a response is required (i.e. the back-end is flushed)
+and then sent in one go. Reads are made into a read-ahead buffer which takes
+everything the port has received, not just the bytes requested.
+
+Rather than using a fixed read timeout, the round-trip time of the link is
+measured (after each flush) and the timeout derived from it in the same way
+as TCP's retransmission timeout (RFC 6298). A missing response thus fails
+quickly on a fast link while the configured read_timeout bounds the wait on a
+slow one.
+
+Since flushing doesn't wait for the data written to be sent, the time at which
+it will have been sent (at the port's baudrate) is tracked and both the
+round-trip time and the read timeout are measured from then.
 """
 
-from serial import Serial
+from time import time
+from math import ceil
+
+from serial import Serial, SerialException
 
-from base import BackEnd
+from base       import BackEnd
+from exceptions import BackEndError, ReadError
 
 class SerialPortBackEnd(BackEnd):
 	
+	# Bits sent per byte (8 data bits, a start and a stop bit)
+	BITS_PER_BYTE = 10
+	
+	# The shortest read timeout which will be used (seconds)
+	MIN_READ_TIMEOUT = 0.05
+	
+	# Read timeouts are rounded up to a multiple of this (seconds)
+	TIMEOUT_RESOLUTION = 0.01
+	
+	# Gains used to update the smoothed round-trip time and its variation
+	RTT_ALPHA = 0.125
+	RTT_BETA  = 0.25
+	
+	# Maximum number of bytes to read ahead in one go
+	READ_AHEAD_LENGTH = 1<<16
+	
 	def __init__(self, port = None, baudrate = 115200,
 	             read_timeout = 1.0, write_timeout = 0.1):
 		"""
 		Provides a serial-port back-end for the protocol. Timeouts are in seconds.
+		
+		The baudrate may be a single rate or a list of rates to try, fastest first.
+		Each rate which the port supports is tried in turn and the first at which
+		the device responds to a ping is used. If the device doesn't respond at any
+		rate, the last supported rate is used.
 		"""
 		BackEnd.__init__(self)
 		
 		self.name = "Serial"
 		
-		# Start the emulator as a child-process
-		self.serial = Serial(port,
-		                     baudrate     = baudrate,
-		                     timeout      = read_timeout,
-		                     writeTimeout = write_timeout)
+		if isinstance(baudrate, (int, long)):
+			baudrates = [baudrate]
+		else:
+			baudrates = list(baudrate)
+		
+		# The maximum read timeout
+		self.read_timeout = read_timeout
+		
+		# Data written since the last flush. Sent in one go when flushed.
+		self.write_buffer = []
+		
+		# Data read ahead from the port and the offset of the first unread byte
+		self.read_buffer = bytearray()
+		self.read_offset = 0
+		
+		# Smoothed round-trip time, its variation and the resulting timeout (None
+		# until the first measurement).
+		self.srtt   = None
+		self.rttvar = None
+		self.rto    = read_timeout
+		
+		# Time at which the last flushed data will have been sent (None once the
+		# response has started to be read)
+		self.flush_time = None
+		
+		# Time at which all the data written so far will have been sent
+		self.send_end_time = 0.0
+		
+		# Open the port at the first rate and then select the rate
+		try:
+			self.serial = Serial(port,
+			                     baudrate     = baudrates[0],
+			                     timeout      = read_timeout,
+			                     writeTimeout = write_timeout)
+		except (SerialException, ValueError), e:
+			raise BackEndError("Could not open serial port %s: %s"%(port, e))
+		
+		if len(baudrates) > 1:
+			self._negotiate_baudrate(baudrates)
+	
+	
+	def _negotiate_baudrate(self, baudrates):
+		"""
+		Select the first baudrate at which the device responds to a ping.
+		"""
+		supported = None
+		
+		for baudrate in baudrates:
+			try:
+				self.serial.baudrate = baudrate
+			except (SerialException, ValueError):
+				# Not supported by the serial port
+				continue
+			supported = baudrate
+			
+			self._discard_input()
+			try:
+				self.ping()
+				return
+			except BackEndError:
+				pass
+		
+		if supported is None:
+			raise BackEndError("None of the baudrates %s are supported"%(
+			                   ", ".join(map(str, baudrates))))
+		
+		# No response: leave the port at the last supported rate
+		self.serial.baudrate = supported
+		self._discard_input()
+	
+	
+	def _discard_input(self):
+		"""
+		Discard any data received but not yet read.
+		"""
+		self.serial.flushInput()
+		self.read_buffer = bytearray()
+		self.read_offset = 0
+	
+	
+	def _get_transfer_time(self, length):
+		"""
+		Get the time taken to send or receive length bytes at the port's baudrate.
+		"""
+		return (length * SerialPortBackEnd.BITS_PER_BYTE) / float(self.serial.baudrate)
+	
+	
+	def _get_read_timeout(self, length):
+		"""
+		Get the timeout for receiving length bytes, including the time until the
+		data written has been sent. This is rounded up to a multiple of
+		TIMEOUT_RESOLUTION since changing the port's timeout reconfigures it.
+		"""
+		send_time = max(0.0, self.send_end_time - time())
+		timeout = (send_time + min(self.rto, self.read_timeout)
+		           + self._get_transfer_time(length))
+		return ceil(timeout / SerialPortBackEnd.TIMEOUT_RESOLUTION) * SerialPortBackEnd.TIMEOUT_RESOLUTION
+	
+	
+	def _update_rtt(self, rtt):
+		"""
+		Update the round-trip time estimate with a new measurement.
+		"""
+		if self.srtt is None:
+			self.srtt   = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar += SerialPortBackEnd.RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+			self.srtt   += SerialPortBackEnd.RTT_ALPHA * (rtt - self.srtt)
+		
+		self.rto = max(SerialPortBackEnd.MIN_READ_TIMEOUT, self.srtt + 4*self.rttvar)
+	
+	
+	def _fill(self, length, expect_short = False):
+		"""
+		Read from the port until at least length unread bytes are buffered (or the
+		read times out). Returns the number of unread bytes buffered.
+		
+		If expect_short is True, the read is expected to time out (e.g. when
+		absorbing stray data) and so is not used to adjust the timeout.
+		"""
+		available = len(self.read_buffer) - self.read_offset
+		if available >= length:
+			return available
+		
+		# Discard the data already read
+		del self.read_buffer[:self.read_offset]
+		self.read_offset = 0
+		
+		needed  = length - available
+		timeout = self._get_read_timeout(needed)
 		
+		try:
+			# Read what is needed and anything else which has already arrived
+			to_read = min(max(needed, self.serial.inWaiting()),
+			              max(needed, SerialPortBackEnd.READ_AHEAD_LENGTH))
+			
+			if self.serial.timeout != timeout:
+				self.serial.timeout = timeout
+			
+			data = self.serial.read(to_read)
+		except (SerialException, IOError), e:
+			raise BackEndError("Serial port error: %s"%e)
+		self.read_buffer.extend(data)
+		
+		if expect_short:
+			pass
+		elif len(data) < needed:
+			# Timed out: back off in case the link is just slower than measured
+			self.rto = min(self.rto * 2, self.read_timeout)
+			self.flush_time = None
+		elif self.flush_time is not None:
+			# The first response since the flush: measure the round-trip time less the
+			# time taken to transfer the response
+			self._update_rtt(max(0.0, time() - self.flush_time
+			                          - self._get_transfer_time(len(data))))
+			self.flush_time = None
+		
+		return len(self.read_buffer)
 	
 	
 	def read(self, length):
-		return self.serial.read(length)
+		length = min(length, self._fill(length))
+		
+		data = str(self.read_buffer[self.read_offset:self.read_offset + length])
+		self.read_offset += length
+		return data
+	
+	
+	def read_into(self, buf):
+		length = len(buf)
+		available = self._fill(length)
+		if available < length:
+			# Drop the partial response (as a short read would)
+			self.read_offset += available
+			raise ReadError("Got %d bytes, expected %d"%(available, length))
+		
+		buf[:] = self.read_buffer[self.read_offset:self.read_offset + length]
+		self.read_offset += length
+	
+	
+	def ignore(self, length):
+		# Nothing need arrive so a short read doesn't mean the link is slow
+		length = min(length, self._fill(length, expect_short = True))
+		
+		data = str(self.read_buffer[self.read_offset:self.read_offset + length])
+		self.read_offset += length
+		return data
 	
 	
 	def write(self, data):
-		self.serial.write(data)
+		self.write_buffer.append(data)
 	
 	
 	def flush(self):
-		self.serial.flush()
+		data = "".join(map(str, self.write_buffer))
+		self.write_buffer = []
+		
+		# Don't wait for the OS to drain its buffer (the response does that) but
+		# note when it will have been sent
+		if data:
+			try:
+				self.serial.write(data)
+			except SerialException, e:
+				raise BackEndError("Serial port error: %s"%e)
+			self.send_end_time = (max(time(), self.send_end_time)
+			                      + self._get_transfer_time(len(data)))
+			self.flush_time = self.send_end_time
 	
 	
 	def close(self):
 		self.serial.close()
-
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+A socket back-end for the protocol. Connects to an emulator (or other server)
+listening on a TCP port or a Unix-domain socket. Unlike the EmulatorBackEnd
+this allows a long-running emulator to serve many debugging sessions.
+
+(Named sockets to avoid shadowing Python's socket module.)
+"""
+
+import socket
+
+from base       import BackEnd
+from exceptions import BackEndError, ReadError
+
+class SocketBackEnd(BackEnd):
+	
+	# Size of receive buffer to request from the OS
+	RECEIVE_BUFFER_SIZE = 1<<20
+	
+	# Initial size of the buffer reads are made into
+	READ_BUFFER_SIZE = 1<<16
+	
+	def __init__(self, address, read_timeout = 1.0):
+		"""
+		Provides a socket back-end for the protocol. The address is either
+		"host:port" for a TCP connection (the host defaults to localhost) or the path
+		of a Unix-domain socket. Timeouts are in seconds.
+		"""
+		BackEnd.__init__(self)
+		
+		self.name = "Socket"
+		
+		try:
+			self.socket = self._connect(address)
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+			                       SocketBackEnd.RECEIVE_BUFFER_SIZE)
+			self.socket.settimeout(read_timeout)
+		except socket.error, e:
+			raise BackEndError("Could not connect to %s: %s"%(address, e))
+		
+		# Data written since the last flush. Sent in one go when flushed.
+		self.write_buffer = []
+		
+		# A buffer which is reused for every read
+		self.read_buffer = bytearray(SocketBackEnd.READ_BUFFER_SIZE)
+	
+	
+	def _connect(self, address):
+		"""
+		Create a socket connected to the given address.
+		"""
+		host, _, port = address.rpartition(":")
+		
+		if port.isdigit():
+			# A TCP socket. Commands are small and sent one (batch) at a time so don't
+			# wait to fill packets.
+			sock = socket.create_connection((host or "localhost", int(port)))
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		elif hasattr(socket, "AF_UNIX"):
+			# A Unix-domain socket
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.connect(address)
+		else:
+			raise BackEndError("Unix-domain sockets are not supported on this system.")
+		
+		return sock
+	
+	
+	def _recv_into(self, buf):
+		"""
+		Receive data into the given buffer until it is full or a timeout occurs.
+		Returns the number of bytes received.
+		"""
+		length   = len(buf)
+		received = 0
+		
+		try:
+			while received < length:
+				num_bytes = self.socket.recv_into(buf[received:], length - received)
+				
+				# Connection closed
+				if num_bytes == 0:
+					break
+				
+				received += num_bytes
+		except socket.timeout:
+			pass
+		except socket.error, e:
+			raise BackEndError("Socket error: %s"%e)
+		
+		return received
+	
+	
+	def read(self, length):
+		if len(self.read_buffer) < length:
+			self.read_buffer = bytearray(length)
+		
+		received = self._recv_into(memoryview(self.read_buffer)[:length])
+		return str(self.read_buffer[:received])
+	
+	
+	def read_into(self, buf):
+		received = self._recv_into(buf)
+		if received != len(buf):
+			raise ReadError("Got %d bytes, expected %d"%(received, len(buf)))
+	
+	
+	def write(self, data):
+		self.write_buffer.append(data)
+	
+	
+	def flush(self):
+		data = "".join(self.write_buffer)
+		self.write_buffer = []
+		
+		try:
+			self.socket.sendall(data)
+		except socket.error, e:
+			raise BackEndError("Socket error: %s"%e)
+	
+	
+	def close(self):
+		self.socket.close()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+"""
+In-process simulators for some of the processors which can be debugged. Each
+simulator implements the device's side of the KMD comms protocol (see slave.py)
+allowing Perentie to be used without any hardware or external emulator (see
+back_end/in_process.py).
+"""
+
+from mu0   import MU0Simulator
+from stump import STUMPSimulator
+
+from slave import KMDSlave
+
+
+# Simulators available, by name
+SIMULATORS = {
+	"MU0":   MU0Simulator,
+	"STUMP": STUMPSimulator,
+}
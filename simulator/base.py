@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+"""
+The architecture-independent parts of a simulated processor: memory, registers,
+traps and execution control. Processors are simulated by subclasses which
+implement _execute.
+
+Execution takes place in a background thread in slices of SLICE_STEPS
+instructions. The simulator's lock is held during each slice and must be held
+by anything else which accesses the simulator (e.g. the KMDSlave) so that they
+see the state between instructions.
+"""
+
+import sys
+
+from array     import array
+from threading import Thread, Lock, Condition
+
+from back_end.base  import BackEnd
+from back_end.codec import pack_elements, unpack_elements
+
+
+def _get_masked_addresses(addr, mask, num_addresses):
+	"""
+	Get the addresses below num_addresses which match addr in the bits set in
+	mask. Only the matching addresses are visited (rather than the whole address
+	space) by counting through the values of the bits not in the mask.
+	"""
+	free = ((1 << (num_addresses - 1).bit_length()) - 1) & ~mask
+	addr &= mask
+	
+	addresses = []
+	bits = free
+	while True:
+		if addr | bits < num_addresses:
+			addresses.append(addr | bits)
+		if bits == 0:
+			return addresses
+		bits = (bits - 1) & free
+
+
+class Simulator(object):
+	
+	# The board definition, to be defined by subclasses
+	CPU_TYPE    = None
+	CPU_SUBTYPE = 0x0000
+	
+	# Memory dimensions (memory words are 16 bits)
+	ADDR_WIDTH_BITS = None
+	WORD_BYTES      = 2
+	
+	# A mask of the bits of each register which may be set (registers are
+	# indexed by their address)
+	REGISTER_MASKS = []
+	
+	# Number of steps executed while holding the lock
+	SLICE_STEPS = 10000
+	
+	
+	def __init__(self):
+		self.name = None
+		
+		self.memory    = array("H", [0]) * (1<<self.ADDR_WIDTH_BITS)
+		self.registers = array("H", [0]) * len(self.REGISTER_MASKS)
+		
+		self.lock = Lock()
+		
+		# Notified when the simulator starts running or is closed
+		self.wakeup = Condition(self.lock)
+		
+		# Traps, {num: (trap_type, conditions, sizes, addr_a, addr_b, data_a,
+		# data_b)} and the set of trap numbers which are active
+		self.traps        = {}
+		self.active_traps = set()
+		
+		# Addresses which trigger the active breakpoints and (read and write)
+		# watchpoints
+		self.breakpoints       = frozenset()
+		self.read_watchpoints  = frozenset()
+		self.write_watchpoints = frozenset()
+		
+		# Flags of the last run command (see BackEnd.run)
+		self.run_flags = 0
+		
+		# Is the next step the first since execution (re)started?
+		self.first_step = True
+		
+		self.running = False
+		self.closed  = False
+		self.thread  = None
+		
+		self.reset()
+	
+	
+	def reset(self):
+		"""
+		Reset the processor. Memory is left untouched.
+		"""
+		self.running = False
+		
+		for addr in range(len(self.registers)):
+			self.registers[addr] = 0
+		self.registers_written()
+		
+		self.status            = BackEnd.STATUS_RESET
+		self.steps_remaining   = 0
+		self.steps_since_reset = 0
+	
+	
+	def close(self):
+		"""
+		Stop the execution thread.
+		"""
+		with self.lock:
+			self.running = False
+			self.closed  = True
+			self.wakeup.notify()
+	
+	
+	def get_board_definition(self):
+		"""
+		Returns ((cpu_type, cpu_sub_type), features, segments) as
+		BackEnd.get_board_definition.
+		"""
+		return ((self.CPU_TYPE, self.CPU_SUBTYPE), [], [(0, len(self.memory))])
+	
+	
+	def get_status(self):
+		return (self.status, self.steps_remaining, self.steps_since_reset)
+	
+	
+	def run(self, max_steps, run_flags):
+		"""
+		Start executing for max_steps steps (forever if zero). The run_flags are as
+		in the RUN command.
+		"""
+		self.steps_remaining = max_steps
+		self.run_flags       = run_flags
+		self.continue_execution()
+	
+	
+	def stop_execution(self):
+		self.running         = False
+		self.status          = BackEnd.STATUS_STOPPED
+		self.steps_remaining = 0
+	
+	
+	def pause_execution(self):
+		if self.running:
+			self.running = False
+			self.status  = BackEnd.STATUS_STOPPED
+	
+	
+	def continue_execution(self):
+		self.first_step = True
+		self.running    = True
+		self.status     = BackEnd.STATUS_RUNNING
+		
+		if self.thread is None:
+			self.thread = Thread(target = self._run_thread)
+			self.thread.daemon = True
+			self.thread.start()
+		
+		self.wakeup.notify()
+	
+	
+	def _run_thread(self):
+		"""
+		Execute slices while the processor is running.
+		"""
+		with self.lock:
+			while not self.closed:
+				if self.running:
+					self.run_slice()
+					
+					# Let waiting threads at the lock
+					self.lock.release()
+					self.lock.acquire()
+				else:
+					self.wakeup.wait()
+	
+	
+	def run_slice(self):
+		"""
+		Execute up to SLICE_STEPS steps and update the status accordingly. Must be
+		called while holding the lock.
+		"""
+		flags = self.run_flags
+		
+		if self.steps_remaining:
+			max_steps = min(self.steps_remaining, self.SLICE_STEPS)
+		else:
+			max_steps = self.SLICE_STEPS
+		
+		steps, status = self._execute(
+			max_steps,
+			self.breakpoints if flags & (1<<4) else frozenset(),
+			self.read_watchpoints if flags & (1<<5) else frozenset(),
+			self.write_watchpoints if flags & (1<<5) else frozenset(),
+			self.first_step and bool(flags & (1<<0)))
+		self.first_step = False
+		
+		self.steps_since_reset = (self.steps_since_reset + steps) & 0xFFFFFFFF
+		if self.steps_remaining:
+			self.steps_remaining -= steps
+			if self.steps_remaining == 0 and status is None:
+				status = BackEnd.STATUS_STOPPED
+		
+		if status is not None:
+			self.running = False
+			self.status  = status
+	
+	
+	def _execute(self, max_steps, breakpoints, read_watchpoints,
+	             write_watchpoints, break_on_first_instruction):
+		"""
+		Execute up to max_steps instructions stopping early if an instruction at an
+		address in breakpoints is reached (unless it is the first instruction and
+		break_on_first_instruction is False) or if an address in the watchpoint sets
+		is accessed. Returns (steps executed, new status or None if still running).
+		"""
+		raise NotImplementedError()
+	
+	
+	def registers_written(self):
+		"""
+		Called when the registers have been changed by something other than the
+		processor.
+		"""
+		pass
+	
+	
+	def _get_words_per_element(self, element_size):
+		return max(1, element_size / self.WORD_BYTES)
+	
+	
+	def read_memory(self, element_size, address, length):
+		"""
+		Read length elements of element_size bytes starting at the given address.
+		Returns a string of little-endian values.
+		"""
+		memory = self.memory
+		
+		# Fast-path: whole words within memory
+		if (element_size == self.WORD_BYTES
+		    and 0 <= address and address + length <= len(memory)):
+			data = memory[address:address + length]
+			if sys.byteorder != "little":
+				data.byteswap()
+			return data.tostring()
+		
+		words = self._get_words_per_element(element_size)
+		mask  = len(memory) - 1
+		
+		values = []
+		for element in range(length):
+			element_address = address + (element * words)
+			value = 0
+			for word in range(words - 1, -1, -1):
+				value = (value << 16) | memory[(element_address + word) & mask]
+			values.append(value)
+		
+		return pack_elements(values, element_size)
+	
+	
+	def write_memory(self, element_size, address, data):
+		"""
+		Write a string of little-endian elements of element_size bytes starting at
+		the given address.
+		"""
+		memory = self.memory
+		length = len(data) / element_size
+		
+		# Fast-path: whole words within memory
+		if (element_size == self.WORD_BYTES
+		    and 0 <= address and address + length <= len(memory)):
+			words = array("H", str(data))
+			if sys.byteorder != "little":
+				words.byteswap()
+			memory[address:address + length] = words
+			return
+		
+		words = self._get_words_per_element(element_size)
+		mask  = len(memory) - 1
+		
+		values = unpack_elements(data, element_size, length)
+		for element, value in enumerate(values):
+			element_address = address + (element * words)
+			for word in range(words):
+				memory[(element_address + word) & mask] = value & 0xFFFF
+				value >>= 16
+	
+	
+	def read_registers(self, element_size, address, length):
+		"""
+		Read length registers starting at the given address as elements of
+		element_size bytes. Returns a string of little-endian values.
+		"""
+		registers = self.registers
+		return pack_elements([registers[addr] if addr < len(registers) else 0
+		                      for addr in range(address, address + length)],
+		                     element_size)
+	
+	
+	def write_registers(self, element_size, address, data):
+		"""
+		Write a string of little-endian elements of element_size bytes to the
+		registers starting at the given address.
+		"""
+		values = unpack_elements(data, element_size, len(data) / element_size)
+		for addr, value in enumerate(values, address):
+			if addr < len(self.registers):
+				self.registers[addr] = value & self.REGISTER_MASKS[addr]
+		self.registers_written()
+	
+	
+	def define_trap(self, trap_type, num, conditions, sizes,
+	                addr_a, addr_b, data_a, data_b):
+		"""
+		Define (and deactivate) a trap as in the TRAP_DEFINE command.
+		"""
+		self.traps[num] = (trap_type, conditions, sizes,
+		                   addr_a, addr_b, data_a, data_b)
+		self.active_traps.discard(num)
+		self._update_traps()
+	
+	
+	def read_trap(self, trap_type, num):
+		"""
+		Get (conditions, sizes, addr_a, addr_b, data_a, data_b) for a trap.
+		"""
+		if num in self.traps and self.traps[num][0] == trap_type:
+			return self.traps[num][1:]
+		else:
+			return (0, 0, 0, 0, 0, 0)
+	
+	
+	def set_trap_status(self, bitmask_1, bitmask_0):
+		"""
+		Apply the TRAP_SET_STATUS command's bitmasks to the traps.
+		"""
+		for num in range(32):
+			action = (bool(bitmask_0 & (1<<num)), bool(bitmask_1 & (1<<num)))
+			if action == BackEnd.TRAP_DELETE:
+				self.traps.pop(num, None)
+				self.active_traps.discard(num)
+			elif action == BackEnd.TRAP_DEACTIVATE:
+				self.active_traps.discard(num)
+			elif action == BackEnd.TRAP_ACTIVATE and num in self.traps:
+				self.active_traps.add(num)
+		self._update_traps()
+	
+	
+	def get_trap_status(self):
+		"""
+		Get the (bitmask_1, bitmask_0) describing the state of every trap.
+		"""
+		bitmasks = [0, 0]
+		for num in range(32):
+			if num in self.active_traps:
+				state = BackEnd.TRAP_ACTIVE
+			elif num in self.traps:
+				state = BackEnd.TRAP_INACTIVE
+			else:
+				state = BackEnd.TRAP_NOT_DEFINED
+			
+			for bitmask in range(len(bitmasks)):
+				bitmasks[bitmask] |= state[bitmask] << num
+		
+		return tuple(bitmasks[::-1])
+	
+	
+	def _update_traps(self):
+		"""
+		Work out the set of addresses which trigger the active traps. Only the
+		address conditions of traps are supported, data conditions are ignored.
+		"""
+		breakpoints       = set()
+		read_watchpoints  = set()
+		write_watchpoints = set()
+		
+		num_addresses = len(self.memory)
+		for num in self.active_traps:
+			trap_type, conditions, _, addr_a, addr_b, _, _ = self.traps[num]
+			
+			addr_condition = (conditions >> 2) & 0b11
+			if addr_condition == BackEnd.CONDITION_IN_RANGE:
+				trapped = xrange(max(addr_a, 0), min(addr_b + 1, num_addresses))
+			elif addr_condition == BackEnd.CONDITION_IN_MASK:
+				trapped = _get_masked_addresses(addr_a, addr_b, num_addresses)
+			else:
+				trapped = xrange(num_addresses)
+			
+			if trap_type == BackEnd.TRAP_BREAKPOINT:
+				breakpoints.update(trapped)
+			elif trap_type == BackEnd.TRAP_WATCHPOINT:
+				if conditions & (1<<5):
+					read_watchpoints.update(trapped)
+				if conditions & (1<<4):
+					write_watchpoints.update(trapped)
+		
+		self.breakpoints       = frozenset(breakpoints)
+		self.read_watchpoints  = frozenset(read_watchpoints)
+		self.write_watchpoints = frozenset(write_watchpoints)
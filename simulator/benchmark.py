@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Throughput benchmark for the simulators. Run from Perentie's directory with:
+	
+	python -m simulator.benchmark [steps]
+
+For each simulator, reports the number of instructions executed per second
+running a small loop and the speed of commands made via the InProcessBackEnd.
+"""
+
+import sys
+
+from time import time
+
+from back_end.in_process import InProcessBackEnd
+
+from simulator import SIMULATORS
+
+
+# Programs which loop forever, {name: [words]}
+PROGRAMS = {
+	# loop: LDA count; ADD one; STA count; JMP loop
+	"MU0": [0x0010, 0x2011, 0x1010, 0x4000] + [0x0000] * 12 + [0x0000, 0x0001],
+	
+	# loop: ADD R1, R1, #1; LD R2, [R0, #5]; ST R1, [R0, #6]; ADDS R3, R1, R2;
+	#       BAL loop
+	"STUMP": [0x1121, 0xD205, 0xD906, 0x0B28, 0xE0FB, 0x0001],
+}
+
+
+def benchmark_steps(name, steps):
+	"""
+	Returns the number of instructions executed per second by the named
+	simulator.
+	"""
+	simulator = SIMULATORS[name]()
+	simulator.memory[:len(PROGRAMS[name])] = type(simulator.memory)("H", PROGRAMS[name])
+	simulator.steps_remaining = steps
+	simulator.running         = True
+	
+	start = time()
+	while simulator.running:
+		simulator.run_slice()
+	return steps / (time() - start)
+
+
+def benchmark_commands(name, repeats):
+	"""
+	Returns (get_status commands per second, memory words read per second) for
+	the named simulator via an InProcessBackEnd.
+	"""
+	back_end = InProcessBackEnd(name)
+	words    = len(back_end.slave.simulator.memory)
+	
+	start = time()
+	for _ in range(repeats):
+		back_end.get_status()
+	status_rate = repeats / (time() - start)
+	
+	start = time()
+	for _ in range(repeats):
+		back_end.memory_read(0, 2, 0, words, 1)
+	read_rate = (repeats * words) / (time() - start)
+	
+	back_end.close()
+	return (status_rate, read_rate)
+
+
+if __name__=="__main__":
+	steps = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	
+	for name in sorted(SIMULATORS):
+		step_rate = benchmark_steps(name, steps)
+		status_rate, read_rate = benchmark_commands(name, 1000)
+		
+		print "%s: %.0f steps/s, %.0f get_status/s, %.0f words read/s"%(
+			name, step_rate, status_rate, read_rate)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+An MU0 simulator.
+"""
+
+from base import Simulator
+
+from back_end.base import BackEnd
+
+from architecture.disassembler.mu0 import MU0Disassembler
+
+
+# Opcodes, as decoded by the disassembler
+OPCODES = dict((mnemonic, opcode) for (opcode, (mnemonic, _))
+               in MU0Disassembler.INSTRUCTIONS.iteritems())
+
+LDA = OPCODES["LDA"]
+STA = OPCODES["STA"]
+ADD = OPCODES["ADD"]
+SUB = OPCODES["SUB"]
+JMP = OPCODES["JMP"]
+JGE = OPCODES["JGE"]
+JNE = OPCODES["JNE"]
+STP = OPCODES["STP"]
+
+
+class MU0Simulator(Simulator):
+	
+	CPU_TYPE = 4
+	
+	ADDR_WIDTH_BITS = 12
+	
+	# Registers: ACC, PC, Flags
+	REGISTER_MASKS = [0xFFFF, 0x0FFF, 0b11]
+	ACC   = 0
+	PC    = 1
+	FLAGS = 2
+	
+	
+	def __init__(self):
+		Simulator.__init__(self)
+		self.name = "MU0"
+	
+	
+	def registers_written(self):
+		# The flags always reflect the accumulator
+		acc = self.registers[MU0Simulator.ACC]
+		self.registers[MU0Simulator.FLAGS] = int(acc == 0) | ((acc >> 15) << 1)
+	
+	
+	def _execute(self, max_steps, breakpoints, read_watchpoints,
+	             write_watchpoints, break_on_first_instruction):
+		memory    = self.memory
+		registers = self.registers
+		
+		acc = registers[MU0Simulator.ACC]
+		pc  = registers[MU0Simulator.PC]
+		
+		status = None
+		steps  = 0
+		
+		# Don't stop for a breakpoint on the first instruction if not required
+		if pc in breakpoints and not break_on_first_instruction:
+			skip_breakpoint = pc
+		else:
+			skip_breakpoint = None
+		
+		while steps < max_steps:
+			if pc in breakpoints and pc != skip_breakpoint:
+				status = BackEnd.STATUS_STOPPED_BREAKPOINT
+				break
+			skip_breakpoint = None
+			
+			instr  = memory[pc]
+			opcode = instr >> 12
+			addr   = instr & 0x0FFF
+			
+			if opcode == LDA:
+				acc = memory[addr]
+			elif opcode == ADD:
+				acc = (acc + memory[addr]) & 0xFFFF
+			elif opcode == SUB:
+				acc = (acc - memory[addr]) & 0xFFFF
+			elif opcode == STA:
+				memory[addr] = acc
+				if addr in write_watchpoints:
+					status = BackEnd.STATUS_STOPPED_WATCHPOINT
+			elif opcode == JMP:
+				pc = addr
+				steps += 1
+				continue
+			elif opcode == JGE:
+				if not acc & 0x8000:
+					pc = addr
+					steps += 1
+					continue
+			elif opcode == JNE:
+				if acc:
+					pc = addr
+					steps += 1
+					continue
+			elif opcode == STP:
+				status = BackEnd.STATUS_STOPPED_PROG_REQ
+				break
+			
+			if addr in read_watchpoints and opcode in (LDA, ADD, SUB):
+				status = BackEnd.STATUS_STOPPED_WATCHPOINT
+			
+			pc = (pc + 1) & 0x0FFF
+			steps += 1
+			
+			if status is not None:
+				break
+		
+		registers[MU0Simulator.ACC] = acc
+		registers[MU0Simulator.PC]  = pc
+		self.registers_written()
+		
+		return (steps, status)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+The device (slave) side of the KMD comms protocol. Requests written to a
+KMDSlave are decoded and carried out on a Simulator and the responses made
+available to be read back.
+
+Spec: http://www.cs.manchester.ac.uk/resources/software/komodo/comms.html
+"""
+
+from back_end.base  import BackEnd
+from back_end.codec import *
+
+
+class Incomplete(Exception):
+	"""
+	Raised internally when the input does not yet contain a whole command.
+	"""
+	pass
+
+
+class KMDSlave(object):
+	
+	# The software version reported in response to a ping
+	VERSION = 1
+	
+	
+	def __init__(self, simulator):
+		self.simulator = simulator
+		
+		# Requests not yet processed and responses not yet read
+		self.input  = bytearray()
+		self.output = bytearray()
+	
+	
+	def write(self, data):
+		self.input.extend(data)
+	
+	
+	def read(self, length):
+		data = str(self.output[:length])
+		del self.output[:length]
+		return data
+	
+	
+	def close(self):
+		self.simulator.close()
+	
+	
+	def process(self):
+		"""
+		Carry out all the complete commands which have been written.
+		"""
+		offset = 0
+		with self.simulator.lock:
+			try:
+				while offset < len(self.input):
+					offset = self._process_command(offset)
+			except Incomplete:
+				pass
+		del self.input[:offset]
+	
+	
+	def _get(self, message, offset):
+		"""
+		Unpack a message from the input at the given offset.
+		"""
+		if offset + message.size > len(self.input):
+			raise Incomplete()
+		return message.unpack_from(self.input, offset)
+	
+	
+	def _get_data(self, offset, length):
+		"""
+		Get length bytes of data from the input at the given offset.
+		"""
+		if offset + length > len(self.input):
+			raise Incomplete()
+		return str(self.input[offset:offset + length])
+	
+	
+	def _process_command(self, offset):
+		"""
+		Carry out the command at the given offset of the input and write its
+		response. Returns the offset of the next command.
+		"""
+		simulator = self.simulator
+		command,  = self._get(COMMAND, offset)
+		
+		if command == BackEnd.PING:
+			self.output.extend("OK%02d"%KMDSlave.VERSION)
+		
+		elif command == BackEnd.GET_BOARD_DEFINITION:
+			self._write_board_definition()
+		
+		elif command == BackEnd.RESET:
+			simulator.reset()
+		
+		elif command == BackEnd.GET_STATUS:
+			self.output.extend(STATUS_RESPONSE.pack(*simulator.get_status()))
+		
+		elif command == BackEnd.STOP_EXECUTION:
+			simulator.stop_execution()
+		
+		elif command == BackEnd.PAUSE_EXECUTION:
+			simulator.pause_execution()
+		
+		elif command == BackEnd.CONTINUE_EXECUTION:
+			simulator.continue_execution()
+		
+		elif command & 0xC0 == BackEnd.RUN:
+			_, max_steps = self._get(RUN_REQUEST, offset)
+			simulator.run(max_steps, command & 0x3F)
+			return offset + RUN_REQUEST.size
+		
+		elif command & 0xE0 == BackEnd.MEMORY_WRITE:
+			return self._process_memory_command(command, offset)
+		
+		elif command & 0xF0 == BackEnd.TRAP_DEFINE:
+			return self._process_trap_command(command, offset)
+		
+		elif command & 0xF0 == BackEnd.PERIPH_GET_STATUS:
+			return self._process_periph_command(command, offset)
+		
+		# Anything else (including NOPs) is ignored
+		return offset + COMMAND.size
+	
+	
+	def _write_board_definition(self):
+		(cpu_type, cpu_sub_type), features, segments = \
+			self.simulator.get_board_definition()
+		
+		message = BOARD_DEFINITION_CPU.pack(cpu_type, cpu_sub_type, len(features))
+		for feature in features:
+			message += BOARD_DEFINITION_FEATURE.pack(*feature)
+		message += BOARD_DEFINITION_SEGMENT_COUNT.pack(len(segments))
+		for segment in segments:
+			message += BOARD_DEFINITION_SEGMENT.pack(*segment)
+		
+		self.output.extend(BOARD_DEFINITION_LENGTH.pack(len(message)))
+		self.output.extend(message)
+	
+	
+	def _process_memory_command(self, command, offset):
+		simulator = self.simulator
+		_, address, length = self._get(MEMORY_REQUEST, offset)
+		offset += MEMORY_REQUEST.size
+		
+		element_size = 1 << (command & 0b111)
+		registers    = (command & BackEnd.MEMORY_REGISTER) != 0
+		
+		if command & (BackEnd.MEMORY_READ ^ BackEnd.MEMORY_WRITE):
+			if registers:
+				self.output.extend(simulator.read_registers(element_size, address, length))
+			else:
+				self.output.extend(simulator.read_memory(element_size, address, length))
+		else:
+			data = self._get_data(offset, length * element_size)
+			offset += len(data)
+			if registers:
+				simulator.write_registers(element_size, address, data)
+			else:
+				simulator.write_memory(element_size, address, data)
+		
+		return offset
+	
+	
+	def _process_trap_command(self, command, offset):
+		simulator = self.simulator
+		operation = command & 0b11
+		trap_type = command & 0b1100
+		
+		if command == BackEnd.TRAP_SET_STATUS:
+			_, bitmask_1, bitmask_0 = self._get(TRAP_SET_STATUS_REQUEST, offset)
+			simulator.set_trap_status(bitmask_1, bitmask_0)
+			return offset + TRAP_SET_STATUS_REQUEST.size
+		
+		elif command == BackEnd.TRAP_READ_STATUS:
+			self.output.extend(TRAP_STATUS_RESPONSE.pack(*simulator.get_trap_status()))
+			return offset + COMMAND.size
+		
+		elif operation == BackEnd.TRAP_DEFINE & 0b11:
+			fields = self._get(TRAP_DEFINE_REQUEST, offset)
+			simulator.define_trap(trap_type, *fields[1:])
+			return offset + TRAP_DEFINE_REQUEST.size
+		
+		elif operation == BackEnd.TRAP_READ & 0b11:
+			_, num = self._get(TRAP_READ_REQUEST, offset)
+			self.output.extend(TRAP_READ_RESPONSE.pack(*simulator.read_trap(trap_type,
+			                                                                 num)))
+			return offset + TRAP_READ_REQUEST.size
+		
+		else:
+			# Unknown command
+			return offset + COMMAND.size
+	
+	
+	def _process_periph_command(self, command, offset):
+		"""
+		No peripherals are simulated: requests are answered as if by a board
+		without the peripheral (i.e. rejected).
+		"""
+		if command == BackEnd.PERIPH_GET_STATUS:
+			self._get(PERIPH_REQUEST, offset)
+			self.output.extend(WORD_RESPONSE.pack(0))
+			return offset + PERIPH_REQUEST.size
+		
+		elif command == BackEnd.PERIPH_SET_STATUS:
+			self._get(PERIPH_STATUS_REQUEST, offset)
+			return offset + PERIPH_STATUS_REQUEST.size
+		
+		elif command == BackEnd.PERIPH_DOWNLOAD_HEADER:
+			self._get(PERIPH_DOWNLOAD_HEADER_REQUEST, offset)
+			self.output.extend("N")
+			return offset + PERIPH_DOWNLOAD_HEADER_REQUEST.size
+		
+		else:
+			_, _, length = self._get(PERIPH_MESSAGE_REQUEST, offset)
+			offset += PERIPH_MESSAGE_REQUEST.size
+			
+			if command == BackEnd.PERIPH_SEND_MESSAGE:
+				self._get_data(offset, length)
+				self.output.extend(BYTE_RESPONSE.pack(0))
+				return offset + length
+			elif command == BackEnd.PERIPH_DOWNLOAD_PACKET:
+				self._get_data(offset, length)
+				self.output.extend("N")
+				return offset + length
+			else:
+				# PERIPH_GET_MESSAGE: an empty message
+				self.output.extend(BYTE_RESPONSE.pack(0))
+				return offset
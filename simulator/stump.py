@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+A STUMP simulator.
+"""
+
+from base import Simulator
+
+from back_end.base import BackEnd
+
+from architecture.disassembler.stump import STUMPDisassembler, sign_extend
+
+
+# Instruction encodings, as decoded by the disassembler
+OPCODES = dict((name, opcode) for (opcode, name)
+               in STUMPDisassembler.INSTR_NAMES.iteritems())
+
+ADD    = OPCODES["ADD"]
+ADC    = OPCODES["ADC"]
+SUB    = OPCODES["SUB"]
+SBC    = OPCODES["SBC"]
+AND    = OPCODES["AND"]
+OR     = OPCODES["OR"]
+LD_ST  = OPCODES[""]
+BRANCH = OPCODES["B"]
+
+CONDITIONS = dict((name, condition) for (condition, name)
+                  in STUMPDisassembler.BRANCH_TYPES.iteritems())
+
+SHIFTS = dict((name.strip(", "), shift) for (shift, name)
+              in STUMPDisassembler.SHIFTS.iteritems())
+
+ASR = SHIFTS["ASR"]
+ROR = SHIFTS["ROR"]
+RRC = SHIFTS["RRC"]
+
+# Bits of the condition code register
+FLAG_N = 1<<3
+FLAG_Z = 1<<2
+FLAG_V = 1<<1
+FLAG_C = 1<<0
+
+
+def condition_holds(condition, cc):
+	"""
+	Does the named branch condition hold given the condition code register?
+	"""
+	n = bool(cc & FLAG_N)
+	z = bool(cc & FLAG_Z)
+	v = bool(cc & FLAG_V)
+	c = bool(cc & FLAG_C)
+	
+	return {
+		"AL": True,                    "NV": False,
+		"HI": c and not z,             "LS": not c or z,
+		"CC": not c,                   "CS": c,
+		"NE": not z,                   "EQ": z,
+		"VC": not v,                   "VS": v,
+		"PL": not n,                   "MI": n,
+		"GE": n == v,                  "LT": n != v,
+		"GT": not z and n == v,        "LE": z or n != v,
+	}[condition]
+
+
+# BRANCH_TAKEN[condition][cc] is True if the branch is taken
+BRANCH_TAKEN = [[condition_holds(STUMPDisassembler.BRANCH_TYPES[condition], cc)
+                 for cc in range(16)]
+                for condition in range(16)]
+
+
+class STUMPSimulator(Simulator):
+	
+	CPU_TYPE = 3
+	
+	ADDR_WIDTH_BITS = 16
+	
+	# Registers: R0 (always zero), R1-R6, PC (R7), CC
+	REGISTER_MASKS = [0x0000] + [0xFFFF] * 7 + [0b1111]
+	PC = 7
+	CC = 8
+	
+	
+	def __init__(self):
+		Simulator.__init__(self)
+		self.name = "STUMP"
+		
+		# Decoded instructions {instr: decoded} (see _decode)
+		self.decoded = {}
+	
+	
+	def _decode(self, instr):
+		"""
+		Decode an instruction into a tuple (opcode, set_flags/store, dest, src_a,
+		immediate or None, src_b, shift) or (BRANCH, condition, offset).
+		"""
+		opcode = instr >> 13
+		
+		if opcode == BRANCH:
+			return (BRANCH, (instr >> 8) & 0xF, sign_extend(instr & 0xFF, 8))
+		
+		if (instr >> 12) & 0b1:
+			immediate = sign_extend(instr & 0b11111, 5) & 0xFFFF
+		else:
+			immediate = None
+		
+		return (opcode,
+		        bool((instr >> 11) & 0b1),
+		        (instr >> 8) & 0b111,
+		        (instr >> 5) & 0b111,
+		        immediate,
+		        (instr >> 2) & 0b111,
+		        instr & 0b11)
+	
+	
+	def _execute(self, max_steps, breakpoints, read_watchpoints,
+	             write_watchpoints, break_on_first_instruction):
+		memory    = self.memory
+		registers = self.registers
+		decoded   = self.decoded
+		decode    = self._decode
+		
+		PC = STUMPSimulator.PC
+		CC = STUMPSimulator.CC
+		
+		status = None
+		steps  = 0
+		
+		# Don't stop for a breakpoint on the first instruction if not required
+		if registers[PC] in breakpoints and not break_on_first_instruction:
+			skip_breakpoint = registers[PC]
+		else:
+			skip_breakpoint = None
+		
+		while steps < max_steps:
+			pc = registers[PC]
+			if pc in breakpoints and pc != skip_breakpoint:
+				status = BackEnd.STATUS_STOPPED_BREAKPOINT
+				break
+			skip_breakpoint = None
+			
+			# Fetch (the PC is incremented before execution)
+			instr = memory[pc]
+			registers[PC] = (pc + 1) & 0xFFFF
+			steps += 1
+			
+			try:
+				fields = decoded[instr]
+			except KeyError:
+				fields = decoded[instr] = decode(instr)
+			
+			opcode = fields[0]
+			
+			if opcode == BRANCH:
+				_, condition, offset = fields
+				if BRANCH_TAKEN[condition][registers[CC]]:
+					registers[PC] = (registers[PC] + offset) & 0xFFFF
+				continue
+			
+			_, flag, dest, src_a, immediate, src_b, shift = fields
+			
+			# Second operand, from the immediate or (shifted) register
+			carry = 0
+			if immediate is not None:
+				b = immediate
+			else:
+				b = registers[src_b]
+				if shift:
+					carry = b & 1
+					if shift == ASR:
+						b = (b >> 1) | (b & 0x8000)
+					elif shift == ROR:
+						b = (b >> 1) | (carry << 15)
+					elif shift == RRC:
+						b = (b >> 1) | ((registers[CC] & FLAG_C) << 15)
+			
+			a = registers[src_a]
+			
+			if opcode == LD_ST:
+				addr = (a + b) & 0xFFFF
+				if flag:
+					memory[addr] = registers[dest]
+					if addr in write_watchpoints:
+						status = BackEnd.STATUS_STOPPED_WATCHPOINT
+						break
+				else:
+					if dest:
+						registers[dest] = memory[addr]
+					if addr in read_watchpoints:
+						status = BackEnd.STATUS_STOPPED_WATCHPOINT
+						break
+				continue
+			
+			if opcode <= SBC:
+				# Arithmetic
+				if opcode == ADD:
+					carry_in = 0
+				elif opcode == ADC:
+					carry_in = registers[CC] & FLAG_C
+				elif opcode == SUB:
+					b = b ^ 0xFFFF
+					carry_in = 1
+				else:
+					b = b ^ 0xFFFF
+					carry_in = registers[CC] & FLAG_C
+				
+				total  = a + b + carry_in
+				result = total & 0xFFFF
+				
+				if flag:
+					registers[CC] = ((FLAG_N if result & 0x8000 else 0)
+					                 | (FLAG_Z if not result else 0)
+					                 | (FLAG_V if (a ^ result) & (b ^ result) & 0x8000 else 0)
+					                 | (FLAG_C if total >> 16 else 0))
+			else:
+				# Logical
+				if opcode == AND:
+					result = a & b
+				else:
+					result = a | b
+				
+				if flag:
+					registers[CC] = ((FLAG_N if result & 0x8000 else 0)
+					                 | (FLAG_Z if not result else 0)
+					                 | (FLAG_C if carry else 0))
+			
+			if dest:
+				registers[dest] = result
+		
+		return (steps, status)
@@ -6,6 +6,11 @@ Assembler and loader functions provided as a mixin for the System.
 The reason filenames are specified in the slightly odd way they are is to allow
 assemblers to set the loader file name in a simple way. Its not ideal but it
 works.
+
+Images are loaded by parsing them into a list of segments of words which are
+then sorted and merged into as few large writes ("bursts") as possible (see
+_plan_load) so that loading is limited by the speed of the link rather than
+the time taken for each exchange with the device.
 """
 
 import os
@@ -15,9 +20,18 @@ from math import ceil
 
 from collections import defaultdict
 
+from util.num_utils import split_words
+
+from memory_block import MemoryBlock
+
 
 class AssemblerLoaderMixin(object):
 	
+	# Maximum number of words written to the device at once while loading an
+	# image. Progress is reported after each burst.
+	LOAD_BURST_WORDS = 1024
+	
+	
 	def __init__(self):
 		self.source_filename = None
 		self.image_filename  = None
@@ -75,27 +89,72 @@ class AssemblerLoaderMixin(object):
 			self.log(e, True, "Assemble File")
 	
 	
+	def _plan_load(self, memory, segments):
+		"""
+		Plan the writes required to load an image into the given memory. segments
+		is a list of (addr, words) pairs giving the sequence of words to be written
+		starting at each address. Returns a list of MemoryBlocks of words to be
+		written in address order: contiguous segments are merged and the result
+		split into bursts of at most LOAD_BURST_WORDS words.
+		"""
+		# Merge contiguous segments into runs [addr, words]
+		runs = []
+		for addr, words in sorted(segments, key = (lambda segment: segment[0])):
+			if runs and addr == runs[-1][0] + len(runs[-1][1]):
+				runs[-1][1].extend(words)
+			else:
+				runs.append([addr, MemoryBlock.new_words(memory.word_width_bits, words)])
+		
+		# Split the runs into bursts
+		burst_words = AssemblerLoaderMixin.LOAD_BURST_WORDS
+		return [MemoryBlock(addr + offset, 1, memory.word_width_bits,
+		                    words[offset:offset + burst_words])
+		        for addr, words in runs
+		        for offset in xrange(0, len(words), burst_words)]
+	
+	
+	def _write_image(self, memory, segments):
+		"""
+		Write an image, given as a list of segments (see _plan_load), into the given
+		memory. Returns a generator that yields tuples (words_written, total)
+		indicating progress after each burst.
+		"""
+		bursts  = self._plan_load(memory, segments)
+		total   = sum(len(burst) for burst in bursts)
+		written = 0
+		for burst in bursts:
+			self.write_memory(memory, 1, burst.addr, burst)
+			written += len(burst)
+			yield (written, total)
+	
+	
 	def _load_bin(self, memory, data):
 		"""
 		Load a raw binary data file into the given memory. Returns a generator that
 		yields tuples (amount_read, total) indicating progress.
 		"""
 		try:
-			to_write = []
-			while data:
-				word = data[:memory.word_width_bits / 8]
-				data = data[memory.word_width_bits / 8:]
-				num = 0
-				for byte in word[::-1]:
-					num <<= 8
-					num  |= ord(byte)
-				to_write.append(num)
+			word_bytes = memory.word_width_bits / 8
+			
+			# Pad any partial word at the end of the file
+			data += "\0" * (-len(data) % word_bytes)
+			
+			if word_bytes in (1, 2, 4, 8):
+				# Decode the words in one go
+				words = MemoryBlock.from_string(0, 1, memory.word_width_bits, data,
+				                                word_bytes).words
+			else:
+				words = []
+				for offset in xrange(0, len(data), word_bytes):
+					num = 0
+					for byte in data[offset:offset + word_bytes][::-1]:
+						num <<= 8
+						num  |= ord(byte)
+					words.append(num)
 			
 			# Write the data to the memory
-			length = len(to_write)
-			for addr, word in enumerate(to_write):
-				self.write_memory(memory, 1, addr, [word])
-				yield (addr, length)
+			for progress in self._write_image(memory, [(0, words)]):
+				yield progress
 			
 		except Exception, e:
 			self.log(e, True, "Load Binary File")
@@ -178,10 +237,10 @@ class AssemblerLoaderMixin(object):
 			self.image_symbols[memory] = {}
 			
 			# Write the data to the memory
-			length = len(to_write)
-			for num, (addr, (words, data)) in enumerate(to_write.iteritems()):
-				self.write_memory(memory, words, addr, [data])
-				yield (num, length)
+			segments = [(addr, split_words([data], words, memory.word_width_bits))
+			            for (addr, (words, data)) in to_write.iteritems()]
+			for progress in self._write_image(memory, segments):
+				yield progress
 			
 		except Exception, e:
 			self.log(e, True, "Load LST File")
@@ -236,15 +295,12 @@ class AssemblerLoaderMixin(object):
 				if section["sh_type"] == "SHT_PROGBITS":
 					data_sections[section["sh_addr"]] = section.data()
 			
-			# Write the data to the memory
-			length = sum(map(len, data_sections.itervalues()))
-			num = 0
-			for addr, values in data_sections.iteritems():
-				for byte in values:
-					self.write_memory(memory, 1, addr, [ord(byte)])
-					addr += 1
-					num += 1
-					yield (num, length)
+			# Write the data to the memory (a byte per word)
+			segments = [(addr, MemoryBlock.from_string(addr, 1, memory.word_width_bits,
+			                                           values, 1).words)
+			            for (addr, values) in data_sections.iteritems()]
+			for progress in self._write_image(memory, segments):
+				yield progress
 			
 		except Exception, e:
 			self.log(e, True, "Load ELF File")
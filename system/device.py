@@ -6,22 +6,45 @@ a cleaner, memoised interface to the device meaning that certain repeated
 requests for the same values are not made.
 
 Unless otherwise stated, all functions are thread-safe and can be used, for
-example within functions decorated by RunInBackground.
+example within functions decorated by RunInBackground. Accesses to the device
+are carried out by a DeviceScheduler thread in order of priority (see
+system/scheduler.py and the scheduled decorator below).
 
 If an error occurs when accessing a feature, it should be logged and a valid
 "default" value returned instead (e.g. -1).
 
+Values read from the device are cached until the "state epoch" advances. The
+epoch advances whenever the device is changed through this interface (e.g.
+running, resetting or writing memory) and whenever poll_status() finds the
+board running or with a changed status. As a result a stopped board can be
+refreshed repeatedly without re-reading anything but its status. The values
+cached while the board was stopped are kept when the epoch advances so that
+viewers can show what changed between one stop and the next. Values in the
+cache are returned straight away: only values which must be fetched from the
+device wait for it (e.g. behind a long download).
+
 This interface is not complete and is being added to as required. The back-end
 should only be accessed within the program via this interface so if a feature
 you need isn't available, please add it.
 """
 
+import sys, time
+
+from array     import array
 from threading import Lock
 
-from back_end.exceptions import BackEndError
-from util.num_utils      import i2b, b2i, bits_to_bytes
+from back_end.exceptions import BackEndError, MalformedResponseError
+from back_end.codec      import unpack_elements, pack_elements
+from util.num_utils      import bits_to_bytes
+
+from memory_map   import MemoryMap
+from memory_block import MemoryBlock
+from scheduler  import DeviceScheduler, \
+                       PRIORITY_CONTROL, PRIORITY_EDIT, PRIORITY_REFRESH, \
+                       PRIORITY_BACKGROUND
 
-# XXX Bodges for the back-end's limitations
+# XXX Bodges for the back-end's limitations. Only registers and memory words are
+# padded: elements are assembled from words (see DeviceMixin._read_memory_pages)
 from back_end.bodge import xxx_pad_width
 
 
@@ -33,6 +56,93 @@ class DeviceKilled(Exception):
 	pass
 
 
+class DeviceOffline(BackEndError):
+	"""
+	Exception raised when the device is not accessed because it has stopped
+	responding (see DeviceMixin._sync).
+	"""
+	pass
+
+
+class _Download(object):
+	"""
+	A peripheral download in progress (see DeviceMixin.periph_download_).
+	"""
+	
+	def __init__(self, generator):
+		# The back-end's download generator
+		self.generator = generator
+		
+		# An error which occurred while pausing the download (to be raised by its
+		# next step) or None
+		self.error = None
+
+
+def _get_request_key(f, args, kwargs):
+	"""
+	Get a key identifying a call of f with the given arguments (lists are compared
+	by their contents) or None if the arguments can't be compared.
+	"""
+	key = (f,
+	       tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args),
+	       tuple(sorted(kwargs.iteritems())))
+	try:
+		hash(key)
+		return key
+	except TypeError:
+		return None
+
+
+def _get_changed_offsets(old, new, start, end, block_size = 16):
+	"""
+	Get the list of offsets from start to end at which the sequences old and new
+	differ. The sequences are compared in blocks of block_size elements so
+	unchanged regions are skipped without comparing each element.
+	"""
+	changed = []
+	for block in xrange(start, end, block_size):
+		block_end = min(end, block + block_size)
+		if old[block:block_end] != new[block:block_end]:
+			changed.extend(offset for offset in xrange(block, block_end)
+			               if old[offset] != new[offset])
+	return changed
+
+
+def _get_public_caller(frame):
+	"""
+	Get the name of the first public function in the stack starting from the
+	given frame (to attribute device accesses to, see back_end.metrics).
+	"""
+	while frame.f_back is not None and frame.f_code.co_name.startswith("_"):
+		frame = frame.f_back
+	return frame.f_code.co_name
+
+
+def scheduled(priority, coalesce = False):
+	"""
+	Decorator for DeviceMixin methods which access the device. The method is
+	carried out by the system's DeviceScheduler with the given priority. If
+	coalesce is True (for methods which only read), a call made while an
+	identical call is still waiting shares the result of the waiting call.
+	
+	The commands sent are attributed to the method (or, for private methods, to
+	the first public function in the caller's stack) in the link metrics.
+	"""
+	def decorator(f):
+		def wrapper(self, *args, **kwargs):
+			device_caller = f.__name__
+			if device_caller.startswith("_"):
+				device_caller = _get_public_caller(sys._getframe(1))
+			
+			key = _get_request_key(f, args, kwargs) if coalesce else None
+			return self.scheduler.call(priority, f, (self,) + args, kwargs, key,
+			                           device_caller)
+		wrapper.__name__ = f.__name__
+		wrapper.__doc__  = f.__doc__
+		return wrapper
+	return decorator
+
+
 
 class DeviceMixin(object):
 	"""
@@ -58,19 +168,95 @@ class DeviceMixin(object):
 	STATUS_RUNNING            = 0x80
 	STATUS_RUNNING_SWI        = 0x81
 	
+	# Statuses in which the state of the board may change on its own
+	VOLATILE_STATUSES = (STATUS_ERROR, STATUS_BUSY,
+	                     STATUS_RUNNING, STATUS_RUNNING_SWI)
+	
+	# Number of words in each block of memory held in the cache. Memory is always
+	# read (and cached) in whole, aligned, pages.
+	CACHE_PAGE_WORDS = 64
+	
+	# Number of seconds the device may be left idle before the link is
+	# resynchronised before its next use.
+	RESYNC_IDLE_PERIOD = 5.0
+	
+	# Range of intervals (in seconds) between attempts to contact a device which
+	# has gone offline. The interval doubles after every failed attempt.
+	OFFLINE_PROBE_INTERVAL_MIN = 0.5
+	OFFLINE_PROBE_INTERVAL_MAX = 10.0
+	
+	# Number of seconds for which the board definition is assumed not to have
+	# changed. It is always re-fetched after a reset or resync.
+	BOARD_CHECK_INTERVAL = 10.0
+	
+	# Maximum number of words written by a single request to the scheduler. Larger
+	# writes are split so that more urgent requests (e.g. stop) needn't wait for
+	# the whole write.
+	WRITE_CHUNK_WORDS = 1024
+	
 	
 	def __init__(self):
 		self.device_lock = Lock()
+		
+		# Protects the cache. Never held while waiting for the device so cached
+		# values can always be fetched without delay.
 		self.cache_lock = Lock()
 		
+		# Carries out all accesses to the device (see scheduled)
+		self.scheduler = DeviceScheduler()
+		
 		# Trigger to cause device access functions to fail
 		self.kill_device_lock = Lock()
 		self.kill_device      = False
 		
-		# The board definition which is currently in use by the system
+		# The board definition which is currently in use by the system is
+		# identified by old_board_hash. The most recently fetched definition (and its
+		# hash) is kept until it is stale or BOARD_CHECK_INTERVAL has elapsed.
 		self.board_changed_lock = Lock()
 		self.cur_board_definition = None
-		self.old_board_definition = None
+		self.cur_board_hash       = None
+		self.old_board_hash       = None
+		self.board_check_time     = 0.0
+		
+		# The state epoch, advanced every time the cache is emptied. Values read in
+		# one epoch are not cached if the epoch has since advanced.
+		self.state_epoch = 0
+		
+		# The status seen by the last poll_status()
+		self.polled_status = None
+		
+		# The state epoch in which poll_status() last found the board stopped along
+		# with copies, taken then, of the memories and register file accessed
+		# directly as compact arrays ({memory index: array} and array or None).
+		self.stopped_epoch         = None
+		self.stopped_buffers       = {}
+		self.stopped_register_file = None
+		
+		# The values seen when the board was last stopped (see _take_snapshot)
+		self.previous_registers     = {}
+		self.previous_memory        = {}
+		self.previous_buffers       = {}
+		self.previous_register_file = None
+		
+		# Indices of memories which have been accessed directly
+		self.direct_memories = set()
+		
+		# The MemoryMap of the device, updated whenever the board definition is
+		# fetched. Until then, all of the memory is assumed to be present.
+		self.memory_map = MemoryMap([])
+		
+		# Is the link to the device known to be synchronised? Set by _sync() and
+		# cleared when an error occurs. Along with the time the device was last
+		# accessed, this decides when a resync is required.
+		self.link_synced      = False
+		self.last_access_time = 0.0
+		
+		# Set when the device stops responding. While offline, accesses to the device
+		# fail immediately (with DeviceOffline) except for an occasional probe at
+		# next_probe_time to see if it has returned.
+		self.device_offline         = False
+		self.offline_probe_interval = DeviceMixin.OFFLINE_PROBE_INTERVAL_MIN
+		self.next_probe_time        = 0.0
 		
 		self.clear_cache()
 	
@@ -81,6 +267,8 @@ class DeviceMixin(object):
 		"""
 		with self.kill_device_lock:
 			self.kill_device = True
+		
+		self.scheduler.close()
 	
 	
 	def assert_not_killed(self):
@@ -95,11 +283,96 @@ class DeviceMixin(object):
 	
 	def clear_cache(self):
 		"""
-		Empties the cache of board responses
+		Empties the cache of board responses and advances the state epoch.
 		"""
 		with self.cache_lock:
 			self.assert_not_killed()
+			
+			if self.stopped_epoch == self.state_epoch:
+				self._take_snapshot()
+			
+			self.state_epoch += 1
 			self.cached_registers = {}
+			self.cached_status    = None
+			
+			# Pages of memory, {(memory index, page): MemoryBlock of words}. See
+			# _read_memory_pages.
+			self.cached_memory = {}
+	
+	
+	def _take_snapshot(self):
+		"""
+		Keep the values fetched while the board was stopped to compare with those
+		fetched when it is next stopped (see get_changed_registers and
+		get_changed_words). Only the values fetched during this epoch are kept:
+		anything else is unknown (and so never shown as changed) rather than being
+		compared with a value from an earlier stop. If nothing was fetched at all
+		(e.g. the board was changed before being refreshed) the previous snapshot
+		is kept instead. The cached pages are kept as they are (they are never
+		modified) along with the copies of the memories and register file accessed
+		directly taken when the board was found stopped (see _copy_direct_state).
+		
+		Must be called holding cache_lock.
+		"""
+		if self.cached_registers or self.cached_memory:
+			self.previous_registers = self.cached_registers
+			self.previous_memory    = self.cached_memory
+		
+		self.previous_buffers       = self.stopped_buffers
+		self.previous_register_file = self.stopped_register_file
+	
+	
+	def _copy_direct_state(self):
+		"""
+		Copy the memories and register file accessed directly (which, unlike the
+		cache, change along with the device) for _take_snapshot.
+		
+		Must be called holding cache_lock.
+		"""
+		register_file = self.back_end.register_file()
+		if register_file is None and not self.direct_memories:
+			return
+		
+		with self.back_end.direct_access():
+			if register_file is not None:
+				self.stopped_register_file = register_file[:]
+			self.stopped_buffers = dict((index, self.back_end.memory_buffer(index)[:])
+			                            for index in self.direct_memories)
+	
+	
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
+	def poll_status(self):
+		"""
+		Get the status of the board (as get_status()), advancing the state epoch if
+		the board's status has changed since the last poll or if the board may be
+		changing by itself (e.g. it is running). This should be called regularly
+		(e.g. before each GUI refresh) to detect changes made by the board.
+		"""
+		with self.device_lock:
+			self.assert_not_killed()
+			
+			try:
+				self._sync()
+				status = self.back_end.get_status()
+			except BackEndError, e:
+				self._on_device_error(e)
+				status = (DeviceMixin.STATUS_ERROR, -1, -1)
+			
+			if (status != self.polled_status
+			    or status[0] in DeviceMixin.VOLATILE_STATUSES):
+				self.clear_cache()
+			self.polled_status = status
+			
+			with self.cache_lock:
+				self.cached_status = status
+				
+				# Keep the values seen in this epoch once the board changes
+				if (status[0] not in DeviceMixin.VOLATILE_STATUSES
+				    and self.stopped_epoch != self.state_epoch):
+					self.stopped_epoch = self.state_epoch
+					self._copy_direct_state()
+			
+			return status
 	
 	
 	def resync(self):
@@ -126,18 +399,157 @@ class DeviceMixin(object):
 			self.back_end.ping()
 	
 	
+	def _sync(self):
+		"""
+		Make sure the link to the device is synchronised before it is used. The link
+		is only resynchronised (see resync()) if it has not been synchronised since
+		the last error or has been idle for more than RESYNC_IDLE_PERIOD; otherwise
+		commands are sent straight away.
+		
+		If the link cannot be resynchronised the device is marked as offline and
+		DeviceOffline is raised. Until the device is found again (see _probe()),
+		DeviceOffline is raised without accessing the device.
+		
+		Warning: this method is not thread safe!
+		"""
+		now = time.time()
+		if self.device_offline:
+			if now < self.next_probe_time:
+				raise DeviceOffline("Device offline.")
+			self._probe()
+		
+		elif (not self.link_synced
+		      or now - self.last_access_time > DeviceMixin.RESYNC_IDLE_PERIOD):
+			self.link_synced = False
+			self._set_board_definition_stale()
+			try:
+				self.resync()
+			except BackEndError, e:
+				self._set_offline(e)
+				raise DeviceOffline("Device offline.")
+			self.link_synced = True
+		
+		self.last_access_time = now
+	
+	
+	def _set_offline(self, e):
+		"""
+		Mark the device as offline after it failed to respond with the given
+		BackEndError. Logs the change.
+		
+		Warning: this method is not thread safe!
+		"""
+		self.device_offline         = True
+		self.link_synced            = False
+		self.offline_probe_interval = DeviceMixin.OFFLINE_PROBE_INTERVAL_MIN
+		self.next_probe_time        = time.time() + self.offline_probe_interval
+		
+		self.clear_cache()
+		self.log(DeviceOffline("Device not responding (%s), "%e
+		                       + "will keep trying to reconnect."),
+		         source = "Device Communication")
+	
+	
+	def _probe(self):
+		"""
+		Check to see if an offline device has returned using a ping. If there is no
+		response, the interval until the next probe is doubled and DeviceOffline is
+		raised. A full resync is only attempted if something responds.
+		
+		Warning: this method is not thread safe!
+		"""
+		try:
+			try:
+				self.back_end.ping()
+			except MalformedResponseError:
+				# Something is there but the link is out of sync
+				self.resync()
+		except BackEndError:
+			self.offline_probe_interval = min(self.offline_probe_interval * 2,
+			                                  DeviceMixin.OFFLINE_PROBE_INTERVAL_MAX)
+			self.next_probe_time = time.time() + self.offline_probe_interval
+			raise DeviceOffline("Device offline.")
+		
+		# Back online. The device may have been reset/replaced in the mean time.
+		self.device_offline = False
+		self.link_synced    = True
+		self._set_board_definition_stale()
+		self.clear_cache()
+	
+	
+	def is_device_offline(self):
+		"""
+		Returns True if the device has stopped responding. While offline, all
+		accesses to the device give their default values.
+		"""
+		return self.device_offline
+	
+	
+	def get_link_metrics(self):
+		"""
+		Returns the back_end.metrics.LinkMetrics recording the traffic to the device
+		or None if the back-end is not metered (see MeteredBackEnd).
+		"""
+		return getattr(self.back_end, "metrics", None)
+	
+	
+	def _on_device_error(self, e):
+		"""
+		Handle a BackEndError raised while accessing the device: the link may no
+		longer be in sync and so is resynchronised before its next use. The error
+		is logged unless the device is already known to be offline.
+		
+		Warning: this method is not thread safe!
+		"""
+		self.link_synced = False
+		if not isinstance(e, DeviceOffline):
+			self.log(e, source = "Device Communication")
+	
+	
+	def _set_board_definition_stale(self):
+		"""
+		Cause the board definition to be re-fetched when next used (e.g. because
+		the device may have been reset or replaced).
+		"""
+		with self.board_changed_lock:
+			self.cur_board_definition = None
+	
+	
 	def _get_board_definition(self):
 		"""
-		Get the board definition. An internal-use-only wrapper which stores the
-		baord definition if it hasn't been before.
+		Get the board definition. An internal-use-only wrapper which only fetches
+		the board definition from the device if the last one fetched is stale and
+		stores the hash of the board definition if it hasn't been before.
 		
 		Warning: this method is not thread safe!
 		"""
+		with self.board_changed_lock:
+			if (self.cur_board_definition is not None
+			    and time.time() - self.board_check_time < DeviceMixin.BOARD_CHECK_INTERVAL):
+				return self.cur_board_definition
+		
+		self._sync()
 		board_def = self.back_end.get_board_definition()
+		
+		# A compact summary of the board definition for comparisons
+		cpu_type, peripheral_ids, segments = board_def
+		board_hash = hash((cpu_type, tuple(peripheral_ids), tuple(segments)))
+		memory_map = MemoryMap(segments)
+		
 		with self.board_changed_lock:
-			if self.old_board_definition is None:
-				self.old_board_definition = board_def
+			if self.old_board_hash is None:
+				self.old_board_hash = board_hash
 			self.cur_board_definition = board_def
+			self.cur_board_hash       = board_hash
+			self.board_check_time     = time.time()
+			
+			memory_map_changed = memory_map != self.memory_map
+			self.memory_map    = memory_map
+		
+		# Unmapped locations may have been cached as unreadable
+		if memory_map_changed:
+			self.clear_cache()
+		
 		return board_def
 	
 	
@@ -145,23 +557,24 @@ class DeviceMixin(object):
 		"""
 		Check whether the board definition has changed. Clears the flag.
 		"""
-		# Call something which causes the board definition to be fetched
+		# Call something which causes the board definition to be fetched (if it is
+		# stale)
 		self.get_cpu_type()
 		
 		# Check if it changed
 		changed = False
 		with self.board_changed_lock:
-			if self.old_board_definition is not None:
-				changed = self.old_board_definition != self.cur_board_definition
+			if self.old_board_hash is not None and self.cur_board_hash is not None:
+				changed = self.old_board_hash != self.cur_board_hash
 			
 			# Clear the flag if its been changed
 			if changed:
-				self.old_board_definition = None
-				self.cur_board_definition = None
+				self.old_board_hash = self.cur_board_hash
 		
 		return changed
 	
 	
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
 	def get_cpu_type(self):
 		"""
 		Get the processor (type, sub_type). If there is an error, returns (-1,-1)
@@ -170,14 +583,14 @@ class DeviceMixin(object):
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
 				cpu_type, _, _ = self._get_board_definition()
 				return cpu_type
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
 				return (-1, -1)
 	
 	
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
 	def get_peripheral_ids(self):
 		"""
 		Get a list of peripheral IDs as (id, sub_id) for all peripherals.
@@ -186,150 +599,666 @@ class DeviceMixin(object):
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
 				_, peripheral_ids, _ = self._get_board_definition()
 				return peripheral_ids
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
 				return []
 	
 	
-	def read_register(self, register):
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
+	def get_memory_map(self):
 		"""
-		Read a register as given in the Architecture. Returns -1 on error.
+		Get the MemoryMap listing the parts of the device's memory which are
+		present. If there is an error, the last map fetched is returned.
+		"""
+		with self.device_lock:
+			self.assert_not_killed()
+			
+			try:
+				self._get_board_definition()
+			except BackEndError, e:
+				self._on_device_error(e)
+			
+			return self.memory_map
+	
+	
+	def _cache_register(self, register, value, epoch):
+		"""
+		Store the value of a register read during the given state epoch in the
+		cache. Returns the value.
+		"""
+		with self.cache_lock:
+			if epoch == self.state_epoch:
+				self.cached_registers[register] = value
+			return value
+	
+	
+	def _get_register_runs(self, registers):
+		"""
+		Group a list of registers into runs which can each be accessed with a single
+		command, that is, registers with contiguous addresses and the same (padded)
+		width. Returns a list of (width_bytes, addr, length, registers) tuples.
+		"""
+		runs = []
+		for register in sorted(registers, key = (lambda r: r.addr)):
+			width_bytes = bits_to_bytes(xxx_pad_width(register.width_bits))
+			
+			# Extend an existing run if the register immediately follows it (or shares
+			# an address with its last register).
+			for run in runs:
+				run_width_bytes, run_addr, run_registers = run
+				if (run_width_bytes == width_bytes
+				    and run_registers[-1].addr <= register.addr <= run_registers[-1].addr + 1):
+					run_registers.append(register)
+					break
+			else:
+				runs.append((width_bytes, register.addr, [register]))
+		
+		return [(width_bytes, addr, run_registers[-1].addr - addr + 1, run_registers)
+		        for (width_bytes, addr, run_registers) in runs]
+	
+	
+	def read_registers(self, registers):
+		"""
+		Read a list of registers as given in the Architecture in a single exchange
+		with the device. Returns a list of the values of the registers. Registers
+		which cannot be read are given as -1.
+		"""
+		self.assert_not_killed()
+		
+		# Use the cached values if they're all available (without waiting for the
+		# device)
+		with self.cache_lock:
+			if all(register in self.cached_registers for register in registers):
+				return [self.cached_registers[register] for register in registers]
+		
+		return self._read_registers(registers)
+	
+	
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
+	def _read_registers(self, registers):
+		"""
+		Read a list of registers (see read_registers) fetching those not in the
+		cache from the device.
 		"""
 		with self.device_lock:
 			self.assert_not_killed()
 			
-			# Get the value from the cache if possible
+			# Read the registers directly if possible (bypassing the cache)
+			register_file = self.back_end.register_file()
+			if register_file is not None:
+				with self.back_end.direct_access():
+					return [register_file[register.addr]
+					        if register.addr < len(register_file) else -1
+					        for register in registers]
+			
+			# Get the values from the cache where possible
 			with self.cache_lock:
-				if register in self.cached_registers:
-					return self.cached_registers[register]
+				values = dict((register, self.cached_registers[register])
+				              for register in registers
+				              if register in self.cached_registers)
+			
+			missing = [register for register in registers if register not in values]
+			if missing:
+				try:
+					self._sync()
+					epoch = self.state_epoch
+					
+					# Read each run of contiguous registers with one command
+					batch = self.back_end.batch()
+					responses = [(width_bytes, addr, length, run_registers,
+					              batch.register_read(width_bytes, addr, length))
+					             for (width_bytes, addr, length, run_registers)
+					             in self._get_register_runs(missing)]
+					batch.execute()
+					
+					# Decode and cache the values
+					for width_bytes, addr, length, run_registers, response in responses:
+						data = unpack_elements(response.get(), width_bytes, length)
+						for register in run_registers:
+							values[register] = self._cache_register(register,
+							                                        data[register.addr - addr],
+							                                        epoch)
+				
+				except BackEndError, e:
+					self._on_device_error(e)
+			
+			return [values.get(register, -1) for register in registers]
+	
+	
+	def read_register_bank(self, register_bank):
+		"""
+		Read all the registers in a register bank as given in the Architecture.
+		Returns a dictionary {register: value}. Registers which cannot be read are
+		given as -1.
+		"""
+		registers = register_bank.registers
+		return dict(zip(registers, self.read_registers(registers)))
+	
+	
+	def read_register(self, register):
+		"""
+		Read a register as given in the Architecture. Returns -1 on error.
+		"""
+		return self.read_registers([register])[0]
+	
+	
+	@scheduled(PRIORITY_EDIT)
+	def write_registers(self, values):
+		"""
+		Write a number of registers as given in the Architecture in a single
+		exchange with the device. values is a list of (register, value) pairs.
+		"""
+		values = dict(values)
+		
+		with self.device_lock:
+			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				
-				# Read the register
-				width_bytes = bits_to_bytes(xxx_pad_width(register.width_bits))
-				addr        = register.addr
-				length      = 1
-				value = b2i(self.back_end.register_read(width_bytes, addr, length))
+				# Write the registers directly if possible
+				register_file = self.back_end.register_file()
+				if register_file is not None:
+					with self.back_end.direct_access(written = True):
+						for register, value in values.iteritems():
+							if register.addr < len(register_file):
+								mask = (1 << register.width_bits) - 1
+								register_file[register.addr] = value & mask
+					return
 				
-				# Cache and return the value
-				with self.cache_lock:
-					self.cached_registers[register] = value
-					return value
+				# Write each run of contiguous registers with one command
+				batch = self.back_end.batch()
+				for width_bytes, addr, length, run_registers \
+				    in self._get_register_runs(values.keys()):
+					data = [0] * length
+					for register in run_registers:
+						data[register.addr - addr] = values[register]
+					batch.register_write(width_bytes, addr,
+					                     pack_elements(data, width_bytes))
+				batch.execute()
 			
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
-				return -1
+				self._on_device_error(e)
+			
+			finally:
+				# Re-read everything from the device in-case anything else is changed by
+				# the write.
+				self.clear_cache()
 	
 	
 	def write_register(self, register, value):
 		"""
 		Write a register as given in the Architecture.
 		"""
+		self.write_registers([(register, value)])
+	
+	
+	def get_changed_registers(self, registers):
+		"""
+		Returns a list of bools indicating which of the given registers have changed
+		since the board was last stopped. Only the values already read are compared
+		so the device is never accessed: registers not read in both places are
+		given as unchanged.
+		"""
+		register_file = self.back_end.register_file()
+		
+		with self.cache_lock:
+			if register_file is None:
+				return [(register in self.previous_registers
+				         and register in self.cached_registers
+				         and self.previous_registers[register] != self.cached_registers[register])
+				        for register in registers]
+			
+			previous = self.previous_register_file
+		
+		if previous is None:
+			return [False] * len(registers)
+		
+		with self.back_end.direct_access():
+			return [(register.addr < len(previous)
+			         and previous[register.addr] != register_file[register.addr])
+			        for register in registers]
+	
+	
+	def _get_word_width_bytes(self, memory):
+		"""
+		Get the number of bytes used to transfer each word of the given memory.
+		"""
+		return bits_to_bytes(xxx_pad_width(memory.word_width_bits))
+	
+	
+	def _get_memory_map(self):
+		"""
+		Get the MemoryMap, fetching the board definition if it is stale.
+		
+		Warning: this method is not thread safe!
+		"""
+		self._get_board_definition()
+		return self.memory_map
+	
+	
+	def _join_pages(self, memory, elem_size_words, addr, length, page_blocks):
+		"""
+		Get a MemoryBlock of length elements starting at addr from the list of
+		consecutive cache pages (see _read_memory_pages) which contain them.
+		"""
+		page_words = DeviceMixin.CACHE_PAGE_WORDS
+		num_words  = length * elem_size_words
+		offset     = addr - page_blocks[0].addr
+		
+		if len(page_blocks) == 1:
+			block = page_blocks[0].get_block(offset, num_words)
+			return MemoryBlock(addr, elem_size_words, memory.word_width_bits,
+			                   block.words, block.valid)
+		
+		words = MemoryBlock.new_words(memory.word_width_bits)
+		for page_block in page_blocks:
+			words.extend(page_block.words)
+		
+		valid = None
+		if not all(page_block.valid is None for page_block in page_blocks):
+			valid = bytearray()
+			for page_block in page_blocks:
+				valid.extend(page_block.valid or ("\x01" * page_words))
+			valid = valid[offset:offset + num_words]
+		
+		return MemoryBlock(addr, elem_size_words, memory.word_width_bits,
+		                   words[offset:offset + num_words], valid)
+	
+	
+	def _get_cached_block(self, memory, elem_size_words, addr, length):
+		"""
+		Get a MemoryBlock of length elements starting at addr from the cache without
+		waiting for the device. Returns None if they're not all cached.
+		"""
+		# Memories accessed directly are never cached
+		if self.back_end.memory_buffer(memory.index) is not None:
+			return None
+		
+		page_words = DeviceMixin.CACHE_PAGE_WORDS
+		num_words  = length * elem_size_words
+		pages = range(addr // page_words, ((addr + num_words - 1) // page_words) + 1)
+		
+		with self.cache_lock:
+			if not all((memory.index, page) in self.cached_memory for page in pages):
+				return None
+			page_blocks = [self.cached_memory[(memory.index, page)] for page in pages]
+		
+		return self._join_pages(memory, elem_size_words, addr, length, page_blocks)
+	
+	
+	def _get_buffer_ranges(self, buf, memory_map, addr, num_words):
+		"""
+		Get the parts of the num_words words starting at addr which can be accessed
+		in a buffer given by BackEnd.memory_buffer as a list of (offset, buffer
+		address, length) where offset is relative to addr.
+		
+		Only the parts within the memory map (and the buffer) are given. If the
+		board lists no memory map, addresses past the end of the buffer wrap around
+		(as they do in the simulators) just as they would when accessed through the
+		protocol.
+		"""
+		ranges = []
+		
+		if not memory_map.is_known():
+			offset = 0
+			while offset < num_words:
+				buf_addr = (addr + offset) % len(buf)
+				length   = min(num_words - offset, len(buf) - buf_addr)
+				ranges.append((offset, buf_addr, length))
+				offset += length
+			return ranges
+		
+		for range_addr, range_length in memory_map.get_mapped_ranges(addr, num_words):
+			range_end = min(range_addr + range_length, len(buf))
+			if range_addr < range_end:
+				ranges.append((range_addr - addr, range_addr, range_end - range_addr))
+		return ranges
+	
+	
+	def _read_memory_buffer(self, buf, memory_map, addr, num_words):
+		"""
+		Read num_words words starting at addr from a buffer given by
+		BackEnd.memory_buffer. Returns (words, valid) as for a MemoryBlock: words
+		which can't be accessed (see _get_buffer_ranges) are marked as unreadable.
+		
+		Warning: this method is not thread safe!
+		"""
+		with self.back_end.direct_access():
+			ranges = self._get_buffer_ranges(buf, memory_map, addr, num_words)
+			if ranges == [(0, addr, num_words)]:
+				return (buf[addr:addr + num_words], None)
+			
+			words = array(buf.typecode, [0]) * num_words
+			valid = bytearray(num_words)
+			for offset, buf_addr, length in ranges:
+				words[offset:offset + length] = buf[buf_addr:buf_addr + length]
+				valid[offset:offset + length] = "\x01" * length
+			return (words, valid if 0 in valid else None)
+	
+	
+	def _read_memory_pages(self, memory, pages):
+		"""
+		Get the words in the given list of cache pages, reading any pages not in the
+		cache from the device in a single batch. Returns a dictionary {page:
+		MemoryBlock of words}.
+		
+		Page n of a memory contains the CACHE_PAGE_WORDS words starting at address
+		n * CACHE_PAGE_WORDS. Memories are always transferred (and cached) as words
+		of their native width: elements of any number of words are assembled from
+		these by the host (see read_memory) rather than each being padded to a size
+		the back-end can transfer.
+		
+		Runs of consecutive missing pages are read together and only the parts of
+		each run within the memory map are read from the device (those outside are
+		marked as unreadable) so pages entirely outside the map are produced without
+		accessing the device at all.
+		
+		Warning: this method is not thread safe!
+		"""
+		page_words = DeviceMixin.CACHE_PAGE_WORDS
+		word_bytes = self._get_word_width_bytes(memory)
+		epoch      = self.state_epoch
+		
+		values  = {}
+		missing = []
+		with self.cache_lock:
+			for page in pages:
+				key = (memory.index, page)
+				if key in self.cached_memory:
+					values[page] = self.cached_memory[key]
+				else:
+					missing.append(page)
+		
+		if not missing:
+			return values
+		
+		# Group the missing pages into runs of consecutive pages [first page, number
+		# of pages]
+		runs = []
+		for page in sorted(set(missing)):
+			if runs and page == runs[-1][0] + runs[-1][1]:
+				runs[-1][1] += 1
+			else:
+				runs.append([page, 1])
+		
+		# The mapped parts of each run
+		run_ranges = [(first_page, num_pages,
+		               self.memory_map.get_mapped_ranges(first_page * page_words,
+		                                                 num_pages * page_words))
+		              for (first_page, num_pages) in runs]
+		
+		# Read all the mapped parts of the runs in one go
+		responses = []
+		if any(ranges for (_, _, ranges) in run_ranges):
+			self._sync()
+			
+			batch = self.back_end.batch()
+			responses = [[(addr, length,
+			               batch.memory_read(memory.index, word_bytes, addr, length, 1))
+			              for (addr, length) in ranges]
+			             for (_, _, ranges) in run_ranges]
+			batch.execute()
+		
+		for num, (first_page, num_pages, ranges) in enumerate(run_ranges):
+			run_addr  = first_page * page_words
+			run_block = MemoryBlock.unreadable(run_addr, 1, memory.word_width_bits,
+			                                   num_pages * page_words)
+			for addr, length, response in (responses[num] if responses else []):
+				offset = addr - run_addr
+				run_block.words[offset:offset + length] = MemoryBlock.from_string(
+					addr, 1, memory.word_width_bits, response.get(), word_bytes).words
+				run_block.valid[offset:offset + length] = "\x01" * length
+			
+			# Split the run back into pages
+			for page in range(first_page, first_page + num_pages):
+				values[page] = run_block.get_block((page - first_page) * page_words,
+				                                   page_words)
+				if values[page].is_valid():
+					values[page].valid = None
+		
+		with self.cache_lock:
+			if epoch == self.state_epoch:
+				for page in missing:
+					self.cached_memory[(memory.index, page)] = values[page]
+		
+		return values
+	
+	
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
+	def prefetch(self, memory_ranges = [], registers = []):
+		"""
+		Read everything a refresh of the display needs from the device in as few
+		exchanges as possible so that the reads made by the individual viewers can
+		be served from the cache.
+		
+		memory_ranges is a list of (memory, addr, num_words) ranges of memory words
+		and registers is a list of registers as given in the Architecture.
+		Overlapping and adjacent ranges are merged and read together, as are the
+		registers (see read_registers). Nothing is returned: errors are dealt with
+		when the values are actually read.
+		"""
+		if registers:
+			self.read_registers(registers)
+		
+		if not memory_ranges:
+			return
+		
 		with self.device_lock:
 			self.assert_not_killed()
 			
-			# Remove the value from the cache (when re-reading read the value from the
-			# device in-case the register is changed on write.
-			with self.cache_lock:
-				if register in self.cached_registers:
-					del self.cached_registers[register]
-			
 			try:
-				self.resync()
+				self._get_memory_map()
 				
-				# Write the register
-				width_bytes = bits_to_bytes(xxx_pad_width(register.width_bits))
-				addr        = register.addr
-				length      = 1
-				data        = i2b(value, width_bytes)
-				self.back_end.register_write(width_bytes, addr, data)
+				# The pages of each memory covered by the ranges {index: (memory, pages)}
+				page_words = DeviceMixin.CACHE_PAGE_WORDS
+				pages = {}
+				for memory, addr, num_words in memory_ranges:
+					# Memories accessed directly are never cached
+					if num_words <= 0 or self.back_end.memory_buffer(memory.index) is not None:
+						continue
+					
+					pages.setdefault(memory.index, (memory, set()))[1].update(
+						range(addr // page_words, ((addr + num_words - 1) // page_words) + 1))
+				
+				for memory, memory_pages in pages.itervalues():
+					self._read_memory_pages(memory, sorted(memory_pages))
 			
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
-
+				self._on_device_error(e)
+	
 	
 	def read_memory(self, memory, elem_size_words, addr, length):
 		"""
-		Read from a memory as given in the Architecture. Returns a list of elements
-		as integers of the number of words specified. If a location cannot be read,
-		-1s are returned.
+		Read from a memory as given in the Architecture. Returns a MemoryBlock of
+		elements of the number of words specified (least-significant word at the
+		lowest address) which can be used as a list of ints. If a location cannot be
+		read or lies outside the memory map (see get_memory_map), its element is
+		given as -1.
 		"""
 		assert (elem_size_words > 0)
 		assert (length > 0)
 		
+		self.assert_not_killed()
+		
+		# Use the cached words if they're all available (without waiting for the
+		# device)
+		block = self._get_cached_block(memory, elem_size_words, addr, length)
+		if block is not None:
+			return block
+		
+		return self._read_memory(memory, elem_size_words, addr, length)
+	
+	
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
+	def _read_memory(self, memory, elem_size_words, addr, length):
+		"""
+		Read from a memory (see read_memory) fetching the pages not in the cache
+		from the device.
+		"""
 		with self.device_lock:
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
-				
-				# Size of elements to read
-				elem_size_bits = elem_size_words * memory.word_width_bits
-				width_bytes = bits_to_bytes(xxx_pad_width(elem_size_bits))
+				memory_map = self._get_memory_map()
+				num_words  = length * elem_size_words
 				
-				# Read the data from memory
-				data = self.back_end.memory_read(memory.index, width_bytes, addr, length)
-				
-				# Decode into ints
-				out = []
-				for element in range(length):
-					out.append(b2i(data[:width_bytes]))
-					data = data[width_bytes:]
-				
-				# Return the value
-				return out
+				buf = self.back_end.memory_buffer(memory.index)
+				if buf is not None:
+					# Copy the words straight out of the target's memory
+					words, valid = self._read_memory_buffer(buf, memory_map, addr, num_words)
+					
+					# Include the memory in the copies taken when the board stops (taking
+					# one now if it is stopped)
+					with self.cache_lock:
+						if memory.index not in self.direct_memories:
+							self.direct_memories.add(memory.index)
+							if self.stopped_epoch == self.state_epoch:
+								self._copy_direct_state()
+					
+					return MemoryBlock(addr, elem_size_words, memory.word_width_bits,
+					                   words, valid)
+				else:
+					# Pages containing the words requested
+					page_words = DeviceMixin.CACHE_PAGE_WORDS
+					pages = range(addr // page_words,
+					              ((addr + num_words - 1) // page_words) + 1)
+					
+					# Read the words from the cache/memory
+					values = self._read_memory_pages(memory, pages)
+					return self._join_pages(memory, elem_size_words, addr, length,
+					                        [values[page] for page in pages])
 			
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
-				return [-1] * length
+				self._on_device_error(e)
+				return MemoryBlock.unreadable(addr, elem_size_words,
+				                              memory.word_width_bits, length)
 	
 	
 	def write_memory(self, memory, elem_size_words, addr, data):
 		"""
-		Write to a memory as given in the Architecture.
+		Write to a memory as given in the Architecture. The data is either a
+		MemoryBlock or a list of elements of the number of words specified.
+		Locations outside the memory map (see get_memory_map) are not written.
+		
+		Writes of more than WRITE_CHUNK_WORDS words are made as a sequence of
+		requests so that more urgent accesses are made between them.
 		"""
 		assert (elem_size_words > 0)
 		assert (len(data) > 0)
 		
+		# Split the elements into words
+		if not isinstance(data, MemoryBlock):
+			data = MemoryBlock.from_elements(addr, elem_size_words,
+			                                 memory.word_width_bits, data)
+		
+		for offset in xrange(0, len(data.words), DeviceMixin.WRITE_CHUNK_WORDS):
+			words = data.words[offset:offset + DeviceMixin.WRITE_CHUNK_WORDS]
+			self._write_memory_words(memory, addr + offset,
+			                         MemoryBlock(addr + offset, 1,
+			                                     memory.word_width_bits, words))
+	
+	
+	@scheduled(PRIORITY_EDIT)
+	def _write_memory_words(self, memory, addr, data):
+		"""
+		Write a MemoryBlock of words to a memory starting at addr (see
+		write_memory).
+		"""
+		words = data.words
+		
 		with self.device_lock:
 			self.assert_not_killed()
 			
-			# Remove the value from the cache (when re-reading read the value from the
-			# device in-case the register is changed on write.
 			try:
-				self.resync()
-				
-				# Size of elements to write
-				elem_size_bits = elem_size_words * memory.word_width_bits
-				width_bytes = bits_to_bytes(xxx_pad_width(elem_size_bits))
+				self._sync()
 				
-				# Decode from ints
-				out = ""
-				for element in data:
-					out += i2b(element, width_bytes)
+				word_bytes = self._get_word_width_bytes(memory)
 				
-				# Write the data from memory
-				self.back_end.memory_write(memory.index, width_bytes, addr, out)
+				# Write the words within the memory map
+				memory_map = self._get_memory_map()
+				buf        = self.back_end.memory_buffer(memory.index)
+				if buf is not None:
+					# Copy the words straight into the target's memory
+					ranges = self._get_buffer_ranges(buf, memory_map, addr, len(words))
+					with self.back_end.direct_access(written = True):
+						for offset, buf_addr, length in ranges:
+							buf[buf_addr:buf_addr + length] = array(
+								buf.typecode, words[offset:offset + length])
+				else:
+					ranges = memory_map.get_mapped_ranges(addr, len(words))
+					for range_addr, range_length in ranges:
+						offset = range_addr - addr
+						out = data.tostring(word_bytes, offset, range_length)
+						self.back_end.memory_write(memory.index, word_bytes, range_addr, out, 1)
 			
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
+			
+			finally:
+				# Re-read everything from the device in-case anything else is changed by
+				# the write.
+				self.clear_cache()
 	
 	
+	def get_changed_words(self, memory, addr, num_words):
+		"""
+		Returns the set of addresses of the num_words words starting at addr which
+		have changed since the board was last stopped. As with
+		get_changed_registers, only the words already read are compared and the
+		device is never accessed.
+		"""
+		changed = set()
+		end     = addr + num_words
+		
+		buf = self.back_end.memory_buffer(memory.index)
+		if buf is not None:
+			with self.cache_lock:
+				previous = self.previous_buffers.get(memory.index)
+			
+			if previous is not None:
+				with self.back_end.direct_access():
+					changed.update(_get_changed_offsets(previous, buf, addr,
+					                                    min(end, len(buf), len(previous))))
+			return changed
+		
+		page_words = DeviceMixin.CACHE_PAGE_WORDS
+		with self.cache_lock:
+			for page in range(addr // page_words, ((end - 1) // page_words) + 1):
+				old = self.previous_memory.get((memory.index, page))
+				new = self.cached_memory.get((memory.index, page))
+				
+				# Pages re-read with the same contents are compared in one go
+				if old is None or new is None or old.words == new.words:
+					continue
+				
+				page_addr = page * page_words
+				changed.update(page_addr + offset
+				               for offset in _get_changed_offsets(old.words, new.words,
+				                                                  0, page_words)
+				               if addr <= page_addr + offset < end)
+		
+		return changed
+	
+	
+	@scheduled(PRIORITY_CONTROL)
 	def reset(self):
 		with self.device_lock:
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				self.back_end.reset()
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
+			finally:
+				self._set_board_definition_stale()
+				self.clear_cache()
 	
 	
+	@scheduled(PRIORITY_CONTROL)
 	def run(self, max_steps = 0,
 	        halt_on_watchpoint = True, halt_on_breakpoint = True,
 	        halt_on_mem_fault = False, step_over_swi = False,
@@ -338,46 +1267,57 @@ class DeviceMixin(object):
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				self.back_end.run(max_steps,
 				                  halt_on_watchpoint, halt_on_breakpoint, halt_on_mem_fault,
 				                  step_over_swi, step_over_bl,
 				                  break_on_first_instruction)
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
+			finally:
+				self.clear_cache()
 	
 	
+	@scheduled(PRIORITY_CONTROL)
 	def stop(self):
 		with self.device_lock:
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				self.back_end.stop_execution()
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
+			finally:
+				self.clear_cache()
 	
 	
+	@scheduled(PRIORITY_CONTROL)
 	def pause_execution(self):
 		with self.device_lock:
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				self.back_end.pause_execution()
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
+			finally:
+				self.clear_cache()
 	
 	
+	@scheduled(PRIORITY_CONTROL)
 	def continue_execution(self):
 		with self.device_lock:
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				self.back_end.continue_execution()
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
+			finally:
+				self.clear_cache()
 	
 	
 	def get_status(self):
@@ -385,17 +1325,46 @@ class DeviceMixin(object):
 		Get the status of the board. Returns a tuple
 		(status, steps_remaining, steps_since_reset).
 		"""
+		self.assert_not_killed()
+		
+		# Use the status from the last poll if it is still valid (without waiting
+		# for the device)
+		with self.cache_lock:
+			if self.cached_status is not None:
+				return self.cached_status
+		
+		return self._get_status()
+	
+	
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
+	def _get_status(self):
+		"""
+		Fetch the status of the board (see get_status) from the device.
+		"""
 		with self.device_lock:
 			self.assert_not_killed()
 			
+			# The status may have been fetched while waiting
+			with self.cache_lock:
+				if self.cached_status is not None:
+					return self.cached_status
+			
 			try:
-				self.resync()
-				return self.back_end.get_status()
+				self._sync()
+				epoch  = self.state_epoch
+				status = self.back_end.get_status()
+				
+				with self.cache_lock:
+					if epoch == self.state_epoch:
+						self.cached_status = status
+				
+				return status
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
 				return (DeviceMixin.STATUS_ERROR, -1, -1)
 	
 	
+	@scheduled(PRIORITY_REFRESH, coalesce = True)
 	def periph_get_status(self, periph_num):
 		"""
 		Get the status of the peripheral as a 32-bit integer.
@@ -404,13 +1373,14 @@ class DeviceMixin(object):
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				return self.back_end.periph_get_status(periph_num)
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
 				return -1
 	
 	
+	@scheduled(PRIORITY_EDIT)
 	def periph_set_status(self, periph_num, new_status):
 		"""
 		Get the status of the peripheral as a 32-bit integer.
@@ -419,12 +1389,15 @@ class DeviceMixin(object):
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				self.back_end.periph_set_status(periph_num, new_status)
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
+			finally:
+				self.clear_cache()
 	
 	
+	@scheduled(PRIORITY_EDIT)
 	def periph_send_message(self, periph_num, message):
 		"""
 		Send a short message to the device. Returns the number of bytes accepted.
@@ -433,13 +1406,16 @@ class DeviceMixin(object):
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				return self.back_end.periph_send_message(periph_num, message)
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
 				return 0
+			finally:
+				self.clear_cache()
 	
 	
+	@scheduled(PRIORITY_REFRESH)
 	def periph_get_message(self, periph_num, max_length):
 		"""
 		Request a short message from the device of up to max_length bytes long.
@@ -449,38 +1425,117 @@ class DeviceMixin(object):
 			self.assert_not_killed()
 			
 			try:
-				self.resync()
+				self._sync()
 				return self.back_end.periph_get_message(periph_num, max_length)
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				self._on_device_error(e)
 				return ""
 	
 	
-	def periph_download_(self, num, data):
+	def _start_download(self, num, data):
 		"""
-		Download some data into a peripheral.
-		Yields the amount of data sent every time a packet is sent. Raises an
-		exception if an error occurs.
+		Start a download (see periph_download_) returning a _Download.
 		
-		WARNING: Does not fail transparently!
+		Warning: this method is not thread safe!
 		"""
 		with self.device_lock:
 			self.assert_not_killed()
-			self.resync()
-			
-			for progress in self.back_end.periph_download_(num, data):
-				yield progress
+			self._sync()
+			return _Download(self.back_end.periph_download_(num, data))
 	
 	
-	def periph_download(self, num, data):
+	def _step_download(self, download):
 		"""
-		Download some data into a peripheral all in one go.
+		Send the next packet(s) of a download started by _start_download returning
+		the progress made. Packets may be left in flight for the next step but,
+		should another request use the device first, their acknowledgements are
+		collected beforehand (see _pause_download).
+		
+		Warning: this method is not thread safe!
 		"""
 		with self.device_lock:
 			self.assert_not_killed()
-			self.resync()
 			
+			if download.error is not None:
+				raise download.error
+			
+			# The download counts as using the link (see _sync)
+			self.last_access_time = time.time()
+			
+			progress = download.generator.next()
+			self.scheduler.on_interrupt(download, self._pause_download, download)
+			return progress
+	
+	
+	def _pause_download(self, download):
+		"""
+		Collect the acknowledgements of the download's packets in flight so that
+		other commands can be sent. Any error is raised by the next step.
+		
+		Warning: this method is not thread safe!
+		"""
+		with self.device_lock:
 			try:
-				self.back_end.periph_download(num, data)
+				download.generator.send(True)
 			except BackEndError, e:
-				self.log(e, source = "Device Communication")
+				download.error = e
+			except StopIteration:
+				pass
+	
+	
+	def _abandon_download(self, download):
+		"""
+		Stop a download part-way through.
+		
+		Warning: this method is not thread safe!
+		"""
+		with self.device_lock:
+			# The device is left part-way through the download
+			self.link_synced = False
+			download.generator.close()
+	
+	
+	def periph_download_(self, num, data):
+		"""
+		Download some data into a peripheral.
+		Yields the amount of data sent every time a packet is sent. Raises an
+		exception if an error occurs. The download may be abandoned (cancelled) by
+		closing the generator.
+		
+		Each packet is sent as a separate background request to the scheduler so
+		other accesses to the device are made between packets rather than waiting
+		for the whole download.
+		
+		WARNING: Does not fail transparently!
+		"""
+		call = (lambda priority, f, download, *args:
+		          self.scheduler.call(priority, f, args,
+		                              device_caller = "periph_download_",
+		                              tag = download))
+		
+		download = call(PRIORITY_BACKGROUND, self._start_download, None, num, data)
+		try:
+			while True:
+				try:
+					progress = call(PRIORITY_BACKGROUND, self._step_download, download,
+					                download)
+				except StopIteration:
+					break
+				yield progress
+		except (BackEndError, GeneratorExit):
+			call(PRIORITY_CONTROL, self._abandon_download, download, download)
+			raise
+		finally:
+			self.clear_cache()
+	
+	
+	def periph_download(self, num, data):
+		"""
+		Download some data into a peripheral all in one go.
+		"""
+		try:
+			for progress in self.periph_download_(num, data):
+				pass
+		except BackEndError, e:
+			self.scheduler.call(PRIORITY_BACKGROUND, self._on_device_error, (e,),
+			                    device_caller = "periph_download")
@@ -163,14 +163,11 @@ class EvaluatorMixin(object):
 			
 			assert(start < end)
 			length = (end - start) / elem_size
-			words = self.system.read_memory(self.memory, elem_size, start, length)
+			block = self.system.read_memory(self.memory, elem_size, start, length)
 			
-			# Concatenate the returned words
-			out = 0
-			for word in words[::-1]:
-				out <<= self.memory.word_width_bits
-				out  |= word
-			return out
+			# Concatenate the returned words (-1 if any couldn't be read or lies outside
+			# the memory map)
+			return block.to_int()
 	
 	
 	def _add_memory_accessors(self):
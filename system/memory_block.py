@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+A block of memory read from, or to be written to, a device.
+
+Memories are always transferred as words of their native width (see
+system/device.py). A MemoryBlock holds these words compactly (in an array with
+one item per word where the platform has a suitable type) along with a mask of
+the words which could not be read. The words are only assembled into elements
+of the block's element size (least-significant word first) when they're asked
+for and then, where possible, in bulk using struct.
+
+Python 2's arrays don't support memoryview so sub-blocks (see get_block) are
+copied. Since this is done by the array itself (not element by element) it is
+still cheap.
+"""
+
+import sys, struct
+
+from array    import array
+from binascii import hexlify
+
+from back_end.codec import unpack_elements, pack_elements
+from util.num_utils import join_words, split_words
+
+
+# Typecodes of the array items able to hold words of each number of bytes, where
+# the platform has one {num_bytes: typecode}
+_TYPECODES = dict((array(typecode).itemsize, typecode) for typecode in "LIHB")
+
+# Struct formats for little-endian values of each number of bytes
+_FORMATS = {1:"B", 2:"H", 4:"I", 8:"Q"}
+
+
+class MemoryBlock(object):
+	
+	def __init__(self, addr, elem_size_words, word_width_bits, words, valid = None):
+		"""
+		A block of memory starting at addr made up of elements of elem_size_words
+		words of word_width_bits bits.
+		
+		words is the sequence of words in the block (see new_words), least
+		significant word of each element first. Its length must be a multiple of
+		elem_size_words.
+		
+		valid is None if all the words could be read. Otherwise it is a bytearray
+		with an entry for each word which is zero if the word couldn't be read (such
+		words are held as 0 in words).
+		"""
+		self.addr            = addr
+		self.elem_size_words = elem_size_words
+		self.word_width_bits = word_width_bits
+		self.words           = words
+		self.valid           = valid
+	
+	
+	@classmethod
+	def new_words(cls, word_width_bits, words = ()):
+		"""
+		Get a compact sequence containing the given words of word_width_bits bits:
+		an array if the platform has a type large enough or a list otherwise.
+		"""
+		for num_bytes in sorted(_TYPECODES):
+			if num_bytes * 8 >= word_width_bits:
+				return array(_TYPECODES[num_bytes], words)
+		return list(words)
+	
+	
+	@classmethod
+	def from_string(cls, addr, elem_size_words, word_width_bits, data, word_bytes):
+		"""
+		Create a block from a string (or bytearray) of little-endian words of
+		word_bytes bytes, as transferred by the back-end.
+		"""
+		words = cls.new_words(word_width_bits)
+		if isinstance(words, array) and words.itemsize == word_bytes:
+			words.fromstring(buffer(data))
+			if sys.byteorder != "little":
+				words.byteswap()
+		else:
+			words.extend(unpack_elements(data, word_bytes, len(data) // word_bytes))
+		
+		return cls(addr, elem_size_words, word_width_bits, words)
+	
+	
+	@classmethod
+	def from_elements(cls, addr, elem_size_words, word_width_bits, values):
+		"""
+		Create a block from a sequence of elements (ints). Values are truncated to
+		fit.
+		"""
+		word_mask = (1 << word_width_bits) - 1
+		if elem_size_words == 1:
+			words = [value & word_mask for value in values]
+		else:
+			words = split_words(values, elem_size_words, word_width_bits)
+		
+		return cls(addr, elem_size_words, word_width_bits,
+		           cls.new_words(word_width_bits, words))
+	
+	
+	@classmethod
+	def unreadable(cls, addr, elem_size_words, word_width_bits, length):
+		"""
+		Create a block of length elements none of which could be read.
+		"""
+		num_words = length * elem_size_words
+		return cls(addr, elem_size_words, word_width_bits,
+		           cls.new_words(word_width_bits, [0]) * num_words,
+		           bytearray(num_words))
+	
+	
+	def __len__(self):
+		return len(self.words) // self.elem_size_words
+	
+	
+	def __iter__(self):
+		return iter(self.tolist())
+	
+	
+	def __getitem__(self, index):
+		"""
+		Get an element (-1 if it couldn't be read) or, given a slice, a list of
+		elements.
+		"""
+		if isinstance(index, slice):
+			return self.tolist()[index]
+		
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError("MemoryBlock index out of range")
+		
+		return self.get_block(index, 1).tolist()[0]
+	
+	
+	def __repr__(self):
+		return "MemoryBlock(0x%X, %r)"%(self.addr, self.tolist())
+	
+	
+	def is_valid(self):
+		"""
+		Returns True if all the words in the block could be read.
+		"""
+		return self.valid is None or 0 not in self.valid
+	
+	
+	def get_block(self, start, length):
+		"""
+		Get a MemoryBlock of length elements starting with element start.
+		"""
+		start_word = start * self.elem_size_words
+		end_word   = start_word + (length * self.elem_size_words)
+		
+		valid = self.valid
+		if valid is not None:
+			valid = valid[start_word:end_word]
+		
+		return MemoryBlock(self.addr + start_word, self.elem_size_words,
+		                   self.word_width_bits, self.words[start_word:end_word],
+		                   valid)
+	
+	
+	def _get_native_bytes(self):
+		"""
+		Returns the number of bytes in each item of the words if they're held in an
+		array with items exactly the width of a word or None otherwise.
+		"""
+		if (isinstance(self.words, array)
+		    and self.words.itemsize * 8 == self.word_width_bits):
+			return self.words.itemsize
+		else:
+			return None
+	
+	
+	def _get_little_endian_string(self):
+		"""
+		Get the words (which must be in an array) as a string of little-endian
+		items.
+		"""
+		if sys.byteorder == "little":
+			return self.words.tostring()
+		
+		words = array(self.words.typecode, self.words)
+		words.byteswap()
+		return words.tostring()
+	
+	
+	def tolist(self):
+		"""
+		Get a list of the elements as ints. Elements containing words which couldn't
+		be read are given as -1.
+		"""
+		native_bytes = self._get_native_bytes()
+		elem_bytes   = (native_bytes or 0) * self.elem_size_words
+		
+		if self.elem_size_words == 1:
+			values = list(self.words)
+		elif elem_bytes in _FORMATS:
+			# The elements can be decoded in one go
+			values = list(struct.unpack("<%d%s"%(len(self), _FORMATS[elem_bytes]),
+			                            self._get_little_endian_string()))
+		else:
+			values = join_words(self.words, self.elem_size_words,
+			                    self.word_width_bits)
+		
+		if not self.is_valid():
+			for num in xrange(len(values)):
+				offset = num * self.elem_size_words
+				if 0 in self.valid[offset:offset + self.elem_size_words]:
+					values[num] = -1
+		
+		return values
+	
+	
+	def to_int(self):
+		"""
+		Get the whole block as a single int (least-significant word first) or -1 if
+		any of its words couldn't be read.
+		"""
+		if not self.is_valid():
+			return -1
+		
+		if not self.words:
+			return 0
+		elif self._get_native_bytes():
+			return int(hexlify(self._get_little_endian_string()[::-1]), 16)
+		else:
+			return join_words(self.words, len(self.words), self.word_width_bits)[0]
+	
+	
+	def tostring(self, word_bytes, start = 0, length = None):
+		"""
+		Get length words (or all the words) starting with word start as a string of
+		little-endian words of word_bytes bytes, as transferred by the back-end.
+		"""
+		if length is None:
+			length = len(self.words) - start
+		
+		if isinstance(self.words, array) and self.words.itemsize == word_bytes:
+			block = MemoryBlock(self.addr + start, 1, word_bytes * 8,
+			                    self.words[start:start + length])
+			return block._get_little_endian_string()
+		else:
+			return pack_elements(self.words[start:start + length], word_bytes)
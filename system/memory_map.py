@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+A map of the parts of a device's memory which are actually present.
+
+The board definition lists the memory's segments as (address, length) pairs.
+Accesses to addresses outside these segments may be slow (e.g. they fault or
+time-out on the device) and yield nothing of value, so the DeviceMixin uses a
+MemoryMap to avoid making them at all.
+
+A board which doesn't list any segments is assumed to have all of its memory
+present.
+"""
+
+from bisect import bisect_right
+
+
+class MemoryMap(object):
+	
+	def __init__(self, segments):
+		"""
+		A map of the memory made up of the given list of (address, length)
+		segments. Overlapping and adjacent segments are merged.
+		"""
+		ranges = []
+		for addr, length in sorted(segments):
+			if length <= 0:
+				continue
+			if ranges and addr <= ranges[-1][1]:
+				ranges[-1][1] = max(ranges[-1][1], addr + length)
+			else:
+				ranges.append([addr, addr + length])
+		
+		# Sorted, non-overlapping lists of the start and end (exclusive) addresses of
+		# each segment
+		self.starts = [start for start, end in ranges]
+		self.ends   = [end for start, end in ranges]
+	
+	
+	def __iter__(self):
+		"""
+		Iterate over the (merged) segments as (address, length) pairs.
+		"""
+		for start, end in zip(self.starts, self.ends):
+			yield (start, end - start)
+	
+	
+	def __len__(self):
+		return len(self.starts)
+	
+	
+	def __eq__(self, other):
+		return (isinstance(other, MemoryMap)
+		        and self.starts == other.starts and self.ends == other.ends)
+	
+	
+	def __ne__(self, other):
+		return not (self == other)
+	
+	
+	def is_known(self):
+		"""
+		Returns True if the map lists any segments. If not, all of the memory is
+		assumed to be present.
+		"""
+		return bool(self.starts)
+	
+	
+	def is_mapped(self, addr, length = 1):
+		"""
+		Returns True if all of the length addresses starting at addr are present.
+		"""
+		if not self.starts:
+			return True
+		
+		segment = bisect_right(self.starts, addr) - 1
+		return segment >= 0 and addr + length <= self.ends[segment]
+	
+	
+	def get_mapped_ranges(self, addr, length):
+		"""
+		Get the parts of the length addresses starting at addr which are present as
+		a list of (address, length) pairs in address order.
+		"""
+		if not self.starts:
+			return [(addr, length)]
+		
+		end    = addr + length
+		ranges = []
+		
+		segment = max(0, bisect_right(self.starts, addr) - 1)
+		while segment < len(self.starts) and self.starts[segment] < end:
+			range_start = max(addr, self.starts[segment])
+			range_end   = min(end, self.ends[segment])
+			if range_start < range_end:
+				ranges.append((range_start, range_end - range_start))
+			segment += 1
+		
+		return ranges
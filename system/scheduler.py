@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+A scheduler which carries out requests to use the device in order of priority.
+
+A single DeviceScheduler thread owns the back-end: every other thread asks it
+to make its accesses (see DeviceMixin) and waits for the result. Waiting
+requests are served highest priority first (and in the order they were made
+within a priority) so that, for example, a user pressing stop doesn't wait
+behind a queue of refreshes. Long operations such as peripheral downloads are
+carried out as a sequence of requests (one per packet) so that more urgent
+requests can be served in between (see on_interrupt).
+
+A request made with a key while an identical (same key) request is still
+waiting is not queued again: the caller simply waits for (and shares) the result
+of the request already queued. This stops repeated refreshes from piling up.
+"""
+
+import sys
+
+from heapq     import heappush, heappop
+from itertools import count
+from threading import Thread, Lock, Condition, Event, current_thread
+
+from back_end.metrics import set_caller_thread, set_device_caller
+
+
+# Request priorities, most urgent first
+PRIORITY_CONTROL    = 0 # Execution control by the user (e.g. stop)
+PRIORITY_EDIT       = 1 # Changes made by the user (e.g. writing memory)
+PRIORITY_REFRESH    = 2 # Reading the device's state for display
+PRIORITY_BACKGROUND = 3 # Long-running operations (e.g. downloads)
+
+
+class _Request(object):
+	"""
+	A function call to be made by the scheduler.
+	"""
+	
+	def __init__(self, function, args, kwargs, key, device_caller, tag):
+		self.function = function
+		self.args     = args
+		self.kwargs   = kwargs
+		self.key      = key
+		self.tag      = tag
+		
+		# The name of the System method the request is for (see
+		# back_end.metrics.set_device_caller)
+		self.device_caller = device_caller
+		
+		# The name of the thread the request was made from
+		self.caller = current_thread().name
+		
+		# Set once the request has been carried out. The result is either in value
+		# or, if an exception was raised, exc_info.
+		self.done     = Event()
+		self.value    = None
+		self.exc_info = None
+	
+	
+	def run(self):
+		set_caller_thread(self.caller)
+		set_device_caller(self.device_caller)
+		try:
+			self.value = self.function(*self.args, **self.kwargs)
+		except:
+			self.exc_info = sys.exc_info()
+		finally:
+			set_caller_thread(None)
+			set_device_caller(None)
+			self.done.set()
+	
+	
+	def get(self):
+		"""
+		Wait for the request to be carried out and return its result (or re-raise its
+		exception).
+		"""
+		self.done.wait()
+		if self.exc_info is not None:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.value
+
+
+class DeviceScheduler(object):
+	
+	def __init__(self, name = "Device Scheduler"):
+		"""
+		Start a scheduler thread with the given name.
+		"""
+		self.lock  = Lock()
+		self.ready = Condition(self.lock)
+		
+		# Heap of waiting requests (priority, sequence number, request) and the
+		# waiting requests which have keys {key: request}
+		self.queue    = []
+		self.keyed    = {}
+		self.sequence = count()
+		
+		# A function to call before carrying out the next request not made with a
+		# given tag, (tag, function, args) or None. See on_interrupt.
+		self.interruption = None
+		
+		self.closed = False
+		
+		self.thread = Thread(target = self._run, name = name)
+		self.thread.daemon = True
+		self.thread.start()
+	
+	
+	def call(self, priority, function, args = (), kwargs = {}, key = None,
+	         device_caller = None, tag = None):
+		"""
+		Call function(*args, **kwargs) in the scheduler thread with the given
+		priority and return its result (or raise its exception). If a key is given
+		and a request with the same key is already waiting, that request's result
+		is given instead. The device_caller names the System method the commands
+		sent are attributed to (see back_end.metrics). The tag identifies the
+		long-running operation the request is part of, if any (see on_interrupt).
+		
+		Calls made from the scheduler thread itself (or once the scheduler has been
+		closed) are carried out immediately.
+		"""
+		if current_thread() is self.thread:
+			return function(*args, **kwargs)
+		
+		with self.lock:
+			closed = self.closed
+			if not closed:
+				request = self.keyed.get(key) if key is not None else None
+				if request is None:
+					request = _Request(function, args, kwargs, key, device_caller, tag)
+					heappush(self.queue, (priority, self.sequence.next(), request))
+					if key is not None:
+						self.keyed[key] = request
+					self.ready.notify()
+		
+		if closed:
+			return function(*args, **kwargs)
+		
+		return request.get()
+	
+	
+	def on_interrupt(self, tag, function, *args):
+		"""
+		Call function(*args) in the scheduler thread before the next request is
+		carried out unless it was made with the given tag. Only applies until the
+		next request is carried out.
+		
+		This allows a long-running operation made up of a sequence of requests (all
+		made with the tag) to leave the device in a state where it can only be used
+		by its next request (e.g. with download packets in flight) but to put
+		things in order should something else need the device first. The function
+		must not raise an exception.
+		"""
+		with self.lock:
+			self.interruption = (tag, function, args)
+	
+	
+	def close(self):
+		"""
+		Stop the scheduler thread once the requests already waiting have been
+		carried out.
+		"""
+		with self.lock:
+			self.closed = True
+			self.ready.notify()
+	
+	
+	def _run(self):
+		while True:
+			with self.lock:
+				while not self.queue and not self.closed:
+					self.ready.wait()
+				if not self.queue:
+					return
+				
+				_, _, request = heappop(self.queue)
+				if request.key is not None:
+					del self.keyed[request.key]
+				
+				interruption, self.interruption = self.interruption, None
+			
+			if interruption is not None:
+				tag, function, args = interruption
+				if request.tag is not tag:
+					function(*args)
+			
+			request.run()
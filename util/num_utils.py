@@ -42,3 +42,38 @@ def bits_to_bytes(bits):
 	"""
 	return (bits + 7) / 8
 
+
+def join_words(words, words_per_value, word_width_bits):
+	"""
+	Combine a sequence of words into values each made up of words_per_value
+	words, least-significant word first. Returns a list of ints.
+	"""
+	if words_per_value == 1:
+		return list(words)
+	
+	word_mask = (1 << word_width_bits) - 1
+	values = []
+	for offset in xrange(0, len(words) - words_per_value + 1, words_per_value):
+		value = 0
+		for word in reversed(words[offset:offset + words_per_value]):
+			value = (value << word_width_bits) | (word & word_mask)
+		values.append(value)
+	return values
+
+
+def split_words(values, words_per_value, word_width_bits):
+	"""
+	Split a sequence of values into words_per_value words each,
+	least-significant word first (the inverse of join_words). Returns a list of
+	ints.
+	"""
+	if words_per_value == 1:
+		return list(values)
+	
+	word_mask = (1 << word_width_bits) - 1
+	words = []
+	for value in values:
+		for word in xrange(words_per_value):
+			words.append(value & word_mask)
+			value >>= word_width_bits
+	return words
@@ -32,6 +32,23 @@ class MemoryTable(object):
 		return addr & ((1<<self.memory.addr_width_bits) - 1)
 	
 	
+	def split_range(self, addr, num_words):
+		"""
+		Returns the num_words words starting at addr as a list of (addr, num_words)
+		ranges of masked addresses: a range which runs past the top of the address
+		space is split in two with the second part starting at zero.
+		"""
+		addr_space = 1<<self.memory.addr_width_bits
+		addr       = self.mask_addr(addr)
+		num_words  = min(num_words, addr_space)
+		
+		first_length = min(num_words, addr_space - addr)
+		if first_length == num_words:
+			return [(addr, num_words)]
+		else:
+			return [(addr, first_length), (0, num_words - first_length)]
+	
+	
 	def set_align(self, align):
 		self.align = align
 	def get_align(self):
@@ -70,6 +87,15 @@ class MemoryTable(object):
 		names returned by get_columns().
 		"""
 		raise NotImplementedError()
+	
+	
+	def get_ranges(self, addr, num_rows):
+		"""
+		Returns the list of (addr, num_words) ranges of memory get_data will read
+		for the given rows (see split_range) or None if this isn't known in advance
+		(e.g. because the length of each row depends on the memory's contents).
+		"""
+		return None
 
 
 
@@ -105,6 +131,13 @@ class MemoryWordTable(MemoryTable):
 		return data_columns + [("ASCII", False, False)]
 	
 	
+	def get_ranges(self, addr, num_rows):
+		if self.align:
+			addr -= addr%(self.num_words * self.num_elems)
+		
+		return self.split_range(addr, num_rows * self.num_elems * self.num_words)
+	
+	
 	def set_cell(self, addr, row, column, new_data):
 		if column < self.num_elems:
 			# Calculate address the cell represents
@@ -128,12 +161,26 @@ class MemoryWordTable(MemoryTable):
 			# Jump to the next aligned address
 			addr -= addr%(self.num_words * self.num_elems)
 		
-		# Read the data from the board
+		# Read the data from the board (decoding all the elements on each side of
+		# the wrap at the top of the address space in one go)
 		out = []
-		data = iter(self.system.read_memory(self.memory,
-		                                    self.num_words,
-		                                    addr,
-		                                    num_rows * self.num_elems))
+		data = []
+		num_elems = num_rows * self.num_elems
+		elem_addr = addr
+		while len(data) < num_elems:
+			elem_addr = self.mask_addr(elem_addr)
+			
+			# The elements which start before the top of the address space
+			addr_space = 1<<self.memory.addr_width_bits
+			length = min(num_elems - len(data),
+			             (addr_space - elem_addr + self.num_words - 1) // self.num_words)
+			
+			data.extend(self.system.read_memory(self.memory,
+			                                    self.num_words,
+			                                    elem_addr,
+			                                    length).tolist())
+			elem_addr += length * self.num_words
+		data = iter(data)
 		
 		for row in range(num_rows):
 			addr = self.mask_addr(addr)
@@ -205,7 +252,7 @@ class DisassemblyTable(MemoryTable):
 		addr = self.mask_addr(addr)
 		
 		def memory_read(addr, num_words):
-			return self.system.read_memory(self.memory, num_words, addr, 1)
+			return self.system.read_memory(self.memory, num_words, addr, 1).tolist()
 		
 		# XXX: This should at some point be extended to support areas of
 		# memory/starting disassembly from a certain address.
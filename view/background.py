@@ -15,6 +15,11 @@ calls once a certain number of outstanding calls have built up.
 
 Uncaught exceptions arising within a function call are displayed on stderr.
 
+A call running in the background can be cancelled cooperatively: the next time
+it reports its progress a Cancelled exception is raised at the yield. The
+function may catch this to clean up (e.g. returning to the GTK thread to reset
+its widgets). Calls which have not yet started are simply discarded.
+
 To cope with the fact that the main-loop may be killed while there are still
 idle events waiting to occur, this system automatically kills all function calls
 waiting to execute in the main loop when the main-loop is exited by injecting a
@@ -43,6 +48,13 @@ class MainloopTerminated(Exception):
 	pass
 
 
+class Cancelled(Exception):
+	"""
+	Thrown into a function when it reports its progress after being cancelled.
+	"""
+	pass
+
+
 class RunInBackground(object):
 	"""
 	Decorator to wrap around a function which may take some time to execute but
@@ -72,6 +84,9 @@ class RunInBackground(object):
 	If start_in_gtk is True, the function wrapped starts executing in the GTK
 	thread and, after yielding, is transferred to a background thread where
 	execution should continue as-per-usual.
+	
+	Calls may be cancelled using cancel(). The call currently running has a
+	Cancelled exception raised at its next progress yield.
 	"""
 	
 	def __init__(self, max_queue_length = 1, method = True, start_in_gtk = False):
@@ -95,14 +110,17 @@ class RunInBackground(object):
 		self.max_queue_length = max_queue_length
 		self.start_in_gtk     = start_in_gtk
 		
-		# A dictionary mapping objects to a tuple (lock, queue, adjustment) for each
-		# object which a method call has occurred in. If method == False, only one
-		# entry is present, None, which represents the single entry for this
-		# function.
+		# A dictionary mapping objects to a tuple (lock, queue, adjustment,
+		# cancelled) for each object which a method call has occurred in. If
+		# method == False, only one entry is present, None, which represents the
+		# single entry for this function.
 		#
 		# Each queue is a list of tuples (args, kwargs) of calls to be made to the
 		# function. A special case is when kwargs is None, in this case args is a
 		# generator of a call which has already started execution.
+		#
+		# cancelled is an Event which is set when the running call should be
+		# cancelled.
 		self.calls = {}
 		
 		# A lock on access to the calls dictionary
@@ -189,6 +207,22 @@ class RunInBackground(object):
 			return (None, None)
 	
 	
+	def generator_cancel(self, gen):
+		"""
+		Raise a Cancelled exception in a generator at its current yield. Returns
+		(generator, gen_value) as for generator_step. A generator which doesn't
+		catch the exception is finished silently.
+		"""
+		try:
+			gen_value = gen.throw(Cancelled("Cancelled by user"))
+			return (gen, gen_value)
+		except (StopIteration, Cancelled):
+			return (None, None)
+		except Exception, e:
+			sys.stderr.write("Error:\n" + traceback.format_exc())
+			return (None, None)
+	
+	
 	def start_function(self, args, kwargs):
 		"""
 		Runs the first step of the program given the argument and kwargs. Returns
@@ -198,7 +232,7 @@ class RunInBackground(object):
 		return self.generator_step(gen)[0]
 	
 	
-	def process_queue(self, lock, queue, adjustment):
+	def process_queue(self, lock, queue, adjustment, cancelled):
 		"""
 		Call processing thread.
 		
@@ -289,6 +323,11 @@ class RunInBackground(object):
 			while gen is not None:
 				gen, progress = self.generator_step(gen)
 				
+				# Cancel the call at its progress yield if requested
+				while gen is not None and progress is not None and cancelled.is_set():
+					cancelled.clear()
+					gen, progress = self.generator_cancel(gen)
+				
 				if progress is None:
 					# Requested to continue in GTK thread or the function crashed
 					break
@@ -327,9 +366,11 @@ class RunInBackground(object):
 				# Resume in GTK thread and wait for it to finish
 				run_in_gtk(finish_off, gen)
 				
-				# Remove the processed element from the queue
+				# Remove the processed element from the queue (a cancellation which
+				# arrived too late to take effect does not apply to the next call)
 				with lock:
 					queue.pop(0)
+					cancelled.clear()
 					queue_empty = len(queue) == 0
 		
 		except MainloopTerminated, e:
@@ -344,15 +385,25 @@ class RunInBackground(object):
 			pass
 	
 	
+	def get_thread_name(self, obj):
+		"""
+		Get the name for threads executing calls for the given object.
+		"""
+		if obj is None:
+			return self.function.__name__
+		else:
+			return "%s.%s"%(type(obj).__name__, self.function.__name__)
+	
+	
 	def get_lock_queue_adjustment(self, obj):
 		"""
-		Return the (lock, queue, adjustment) tuple for the given object. Creates
-		them if they don't yet exist.
+		Return the (lock, queue, adjustment, cancelled) tuple for the given object.
+		Creates them if they don't yet exist.
 		"""
-		# Create an empty queue, new lock and adjustment if needed
+		# Create an empty queue, new lock, adjustment and event if needed
 		with self.calls_lock:
 			if obj not in self.calls:
-				self.calls[obj] = (Lock(), [], gtk.Adjustment())
+				self.calls[obj] = (Lock(), [], gtk.Adjustment(), Event())
 			
 			return self.calls[obj]
 	
@@ -381,7 +432,7 @@ class RunInBackground(object):
 				obj = args[0]
 			
 			# Get the queue and its lock
-			lock, queue, adjustment = self.get_lock_queue_adjustment(obj)
+			lock, queue, adjustment, cancelled = self.get_lock_queue_adjustment(obj)
 			
 			with lock:
 				# If the queue is empty (i.e. execution should start ASAP, not after an
@@ -407,7 +458,10 @@ class RunInBackground(object):
 				if len(queue) == 1:
 					# Start a new thread for the now newly populated queue (if the queue
 					# already had stuff in, a thread exists to process it already)
-					t = Thread(target = self.process_queue, args = (lock, queue, adjustment))
+					# The thread is named after the function (see back_end.metrics)
+					t = Thread(target = self.process_queue,
+					           args = (lock, queue, adjustment, cancelled),
+					           name = self.get_thread_name(obj))
 					t.start()
 				
 				# Remove excess queued items
@@ -427,4 +481,20 @@ class RunInBackground(object):
 		required for is.
 		"""
 		return self.get_lock_queue_adjustment(obj)[2]
+	
+	
+	def cancel(self, obj = None):
+		"""
+		Cancel the running call (and discard any queued calls) of the function. If
+		the function is a method, takes the object whose calls are to be
+		cancelled.
+		"""
+		lock, queue, adjustment, cancelled = self.get_lock_queue_adjustment(obj)
+		
+		with lock:
+			# Discard calls which haven't started
+			del queue[1:]
+			
+			if queue:
+				cancelled.set()
 
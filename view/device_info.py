@@ -20,6 +20,10 @@ class DeviceInfoViewer(gtk.VBox):
 		'dismissed': (gobject.SIGNAL_RUN_FIRST, gobject.TYPE_NONE, tuple()),
 	}
 	
+	# Pages which may be added once the device has responded, in the order they
+	# appear (after all the other pages)
+	LATE_PAGES = ("Memory Map", "Peripherals", "Link Statistics")
+	
 	def __init__(self, system):
 		"""
 		A GTK widget that displays all known information about the connected system.
@@ -54,8 +58,7 @@ class DeviceInfoViewer(gtk.VBox):
 		"""
 		Refreshes information in the widget.
 		"""
-		# Nothing to update
-		pass
+		self._refresh_link_stats()
 	
 	
 	def table_add_row(self, table, row, title, value):
@@ -70,6 +73,24 @@ class DeviceInfoViewer(gtk.VBox):
 		             xoptions=gtk.FILL|gtk.EXPAND, yoptions=gtk.FILL)
 	
 	
+	def _add_late_page(self, page, title):
+		"""
+		Add one of the LATE_PAGES to the notebook in its place, regardless of the
+		order in which they are added.
+		"""
+		rank = DeviceInfoViewer.LATE_PAGES.index(title)
+		
+		position = -1
+		for num in range(self.notebook.get_n_pages()):
+			other = self.notebook.get_tab_label_text(self.notebook.get_nth_page(num))
+			if (other in DeviceInfoViewer.LATE_PAGES
+			    and DeviceInfoViewer.LATE_PAGES.index(other) > rank):
+				position = num
+				break
+		
+		self.notebook.insert_page(page, gtk.Label(title), position)
+	
+	
 	def _add_basic_info_page(self):
 		"""
 		Adds a page to the notebook showing the system's basic info.
@@ -294,8 +315,7 @@ class DeviceInfoViewer(gtk.VBox):
 		cell_renderer = gtk.CellRendererText()
 		
 		# Add the tab and make sure its visible as this is happening late
-		label = gtk.Label("Peripherals")
-		self.notebook.append_page(scroller, label)
+		self._add_late_page(scroller, "Peripherals")
 		self.show_all()
 		
 		column = gtk.TreeViewColumn("Number")
@@ -324,6 +344,145 @@ class DeviceInfoViewer(gtk.VBox):
 		treeview.append_column(column)
 	
 	
+	@RunInBackground()
+	def _add_memory_map_page(self):
+		"""
+		Adds a page to the notebook showing the segments of memory present on the
+		device.
+		"""
+		# Request the memory map from the system
+		memory_map = self.system.get_memory_map()
+		
+		# Display it in the GUI thread
+		yield
+		
+		# Don't add if the device doesn't list its segments
+		if not memory_map.is_known():
+			return
+		
+		# Table of (Start, End, Length)
+		segment_list = gtk.ListStore(str, str, str)
+		for addr, length in memory_map:
+			segment_list.append(("0x%08X"%addr,
+			                     "0x%08X"%(addr + length - 1),
+			                     "%d"%length))
+		
+		# Create the TreeView to display the table
+		treeview = gtk.TreeView(segment_list)
+		scroller = gtk.ScrolledWindow()
+		scroller.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+		scroller.add(treeview)
+		cell_renderer = gtk.CellRendererText()
+		
+		# Add the tab and make sure its visible as this is happening late
+		self._add_late_page(scroller, "Memory Map")
+		self.show_all()
+		
+		for num, title in enumerate(("Start", "End", "Length")):
+			column = gtk.TreeViewColumn(title)
+			column.pack_start(cell_renderer)
+			column.add_attribute(cell_renderer, "text", num)
+			treeview.append_column(column)
+	
+	
+	def _add_link_stats_page(self):
+		"""
+		Adds a page to the notebook showing the statistics of the commands sent to
+		the device (if available) which is updated on every refresh.
+		"""
+		self.link_stats_list = None
+		
+		# The row of link_stats_list for each (command, caller)
+		self.link_stats_rows = {}
+		
+		if self.system.get_link_metrics() is None:
+			return
+		
+		vbox = gtk.VBox(spacing = 5)
+		vbox.set_border_width(5)
+		self._add_late_page(vbox, "Link Statistics")
+		
+		# Totals
+		hbox = gtk.HBox(spacing = 5)
+		vbox.pack_start(hbox, fill = True, expand = False)
+		
+		self.link_stats_label = gtk.Label()
+		self.link_stats_label.set_alignment(0, 0.5)
+		hbox.pack_start(self.link_stats_label, fill = True, expand = True)
+		
+		reset_btn = gtk.Button("Reset")
+		reset_btn.connect("clicked", self._on_link_stats_reset_clicked)
+		hbox.pack_start(reset_btn, fill = False, expand = False)
+		
+		# Table of (Command, Caller, Count, Sent, Received, Mean Latency,
+		# 95% Latency). The counts are 64-bit as a long session may send more than
+		# 2GB.
+		self.link_stats_list = gtk.ListStore(str, str, gobject.TYPE_UINT64,
+		                                     gobject.TYPE_UINT64,
+		                                     gobject.TYPE_UINT64, str, str)
+		
+		# Create the TreeView to display the table
+		treeview = gtk.TreeView(self.link_stats_list)
+		scroller = gtk.ScrolledWindow()
+		scroller.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+		scroller.add(treeview)
+		vbox.pack_start(scroller, fill = True, expand = True)
+		cell_renderer = gtk.CellRendererText()
+		
+		for num, title in enumerate(("Command", "Caller", "Count",
+		                             "Bytes Sent", "Bytes Received",
+		                             "Mean Latency", "95% Latency")):
+			column = gtk.TreeViewColumn(title)
+			column.pack_start(cell_renderer)
+			column.add_attribute(cell_renderer, "text", num)
+			column.set_sort_column_id(num)
+			treeview.append_column(column)
+	
+	
+	def _on_link_stats_reset_clicked(self, btn):
+		self.system.get_link_metrics().reset()
+		self._refresh_link_stats()
+	
+	
+	def _refresh_link_stats(self):
+		"""
+		Update the link statistics page with the latest statistics.
+		"""
+		if self.link_stats_list is None:
+			return
+		
+		metrics  = self.system.get_link_metrics()
+		stats    = metrics.get_stats()
+		duration = max(metrics.get_duration(), 1e-6)
+		
+		# Update the rows in place (rather than rebuilding the table) so that the
+		# selection and scroll position are kept
+		for key in set(self.link_stats_rows) - set(stats):
+			self.link_stats_list.remove(self.link_stats_rows.pop(key))
+		
+		for (command, caller), command_stats in sorted(stats.iteritems()):
+			row = (command, caller, long(command_stats.count),
+			       long(command_stats.bytes_sent),
+			       long(command_stats.bytes_received),
+			       "%.2f ms"%(command_stats.get_mean_latency() * 1000),
+			       "< %.2f ms"%(command_stats.get_latency_percentile(95) * 1000))
+			
+			if (command, caller) in self.link_stats_rows:
+				row_iter = self.link_stats_rows[(command, caller)]
+				for column, value in enumerate(row):
+					if self.link_stats_list.get_value(row_iter, column) != value:
+						self.link_stats_list.set_value(row_iter, column, value)
+			else:
+				self.link_stats_rows[(command, caller)] = \
+					self.link_stats_list.append(row)
+		
+		total_bytes = sum(s.bytes_sent + s.bytes_received for s in stats.itervalues())
+		self.link_stats_label.set_text(
+			"%d commands, %d bytes in %d s (%.0f bytes/s)"%(
+			sum(s.count for s in stats.itervalues()),
+			total_bytes, duration, total_bytes / duration))
+	
+	
 	def architecture_changed(self):
 		"""
 		Called when the architecture changes, deals with all the
@@ -343,7 +502,9 @@ class DeviceInfoViewer(gtk.VBox):
 			for memory in self.system.architecture.memories:
 				self._add_memory_info_page(memory)
 		
+		self._add_memory_map_page()
 		self._add_periph_info_page()
+		self._add_link_stats_page()
 		
 		self.refresh()
 
@@ -14,6 +14,11 @@ format_base = 16
 # Should prefixes be added to represent the base
 format_show_prefix = False
 
+# The colour values are shown in and the colour of those which have changed
+# since the board last stopped
+format_colour         = "#000000"
+format_changed_colour = "#CC0000"
+
 # Call to update the formatting info after changing format_base
 def _base_changed():
 	global format_base, format_digits, format_max_width, format_prefix
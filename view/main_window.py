@@ -85,7 +85,7 @@ class MainWindow(gtk.Window):
 		self.memory_viewer_btm.connect("edited", self._on_device_state_changed)
 		
 		# Calls from the control bar
-		self.control_bar.connect("refresh-clicked", self._on_device_state_changed)
+		self.control_bar.connect("refresh-clicked", self._on_refresh_clicked)
 		self.control_bar.connect("select-target-clicked", self._on_select_target_clicked)
 		self.control_bar.connect("quit-clicked", self._on_quit_clicked)
 		self.control_bar.connect("new-memory-viewer-clicked", self._on_new_viewer_clicked,
@@ -413,6 +413,15 @@ class MainWindow(gtk.Window):
 		self.refresh()
 	
 	
+	def _on_refresh_clicked(self, *args):
+		"""
+		Force everything to be re-read from the device, even if the device does not
+		appear to have changed.
+		"""
+		self.system.clear_cache()
+		self.refresh()
+	
+	
 	def _on_select_target_clicked(self, btn):
 		"""
 		Close this window and re-show the initial target selection window.
@@ -462,18 +471,54 @@ class MainWindow(gtk.Window):
 		viewer_list.append(viewer)
 	
 	
-	@RunInBackground()
+	def _get_refresh_viewers(self):
+		"""
+		Get the list of viewers (other than the control and status bars) to be
+		refreshed.
+		"""
+		viewers = []
+		
+		# Don't update the register windows unless we actually have some
+		if self.system.architecture is not None:
+			if self.system.architecture.memories:
+				viewers.append(self.memory_viewer_top)
+				viewers.append(self.memory_viewer_btm)
+			if self.system.architecture.register_banks:
+				viewers.append(self.register_viewer)
+		
+		return viewers + self.memory_viewers + self.register_viewers + self.periph_viewers
+	
+	
+	@RunInBackground(start_in_gtk = True)
 	def refresh(self):
 		"""
 		Refresh all widgets' data
 		"""
-		self.system.clear_cache()
+		# Find out what the viewers will read so that it can all be fetched in one
+		# go (rather than each viewer making its own, overlapping, reads)
+		memory_ranges = []
+		registers     = []
+		for viewer in self._get_refresh_viewers():
+			if hasattr(viewer, "get_refresh_reads"):
+				viewer_ranges, viewer_registers = viewer.get_refresh_reads()
+				memory_ranges.extend(viewer_ranges)
+				registers.extend(viewer_registers)
+		
+		# Continue in background thread
+		yield
+		
+		# Check for changes in the device's state (anything cached is retained if
+		# the device is stopped and unchanged)
+		self.system.poll_status()
 		
 		# Check to see if the architecture changed
 		board_changed = self.system.get_board_definition_changed()
 		
 		if board_changed:
 			self.system.update_architecture()
+		else:
+			# Fetch everything the viewers need for this refresh
+			self.system.prefetch(memory_ranges, list(set(registers)))
 		
 		# Return to GTK thread
 		yield
@@ -486,16 +531,7 @@ class MainWindow(gtk.Window):
 		self.control_bar.refresh()
 		self.status_bar.refresh()
 		
-		# Don't update the register windows unless we actually have some
-		if self.system.architecture is not None:
-			if self.system.architecture.memories:
-				self.memory_viewer_top.refresh()
-				self.memory_viewer_btm.refresh()
-			if self.system.architecture.register_banks:
-				self.register_viewer.refresh()
-		
-		# Update all viewer widgeglobal-refresh
-		for viewer in self.memory_viewers + self.register_viewers + self.periph_viewers:
+		for viewer in self._get_refresh_viewers():
 			viewer.refresh()
 	
 	
@@ -85,6 +85,19 @@ class MemoryViewer(gtk.Notebook):
 			viewer.refresh()
 	
 	
+	def get_refresh_reads(self):
+		"""
+		Get the (memory_ranges, registers) the next refresh will read (see
+		DeviceMixin.prefetch). Must be called from the GTK thread.
+		"""
+		viewer = self.get_nth_page(self.get_current_page())
+		
+		if not self.showing_placeholder and viewer is not None:
+			return viewer.get_refresh_reads()
+		else:
+			return ([], [])
+	
+	
 	def _show_placeholder(self, title, body):
 		"""
 		We have no memories, add a single page with the given title and message.
@@ -449,6 +462,15 @@ class SingleMemoryViewer(gtk.VBox):
 			self.memory_table_viewer.set_addr(addr)
 		
 		self.memory_table_viewer.refresh()
+	
+	
+	def get_refresh_reads(self):
+		"""
+		Get the (memory_ranges, registers) the next refresh will read (see
+		DeviceMixin.prefetch). If following an address expression, the address
+		currently displayed is assumed.
+		"""
+		return self.memory_table_viewer.get_refresh_reads()
 
 
 
@@ -470,7 +492,8 @@ class MemoryTableViewer(gtk.Table):
 	ADDR_COLUMN     = 3 # The address of the row
 	ADDR_INT_COLUMN = 4 # The address of the row as an int
 	LENGTH_COLUMN   = 5 # The length of the row
-	DATA_COLUMN     = 6 # The first column containing data from the memory table
+	CHANGED_COLUMN  = 6 # The colour of the row's data (marks changed rows)
+	DATA_COLUMN     = 7 # The first column containing data from the memory table
 	
 	
 	# Max scroll speed (scroll 2**MAX_SCROLL_SPEED every 100ms)
@@ -521,7 +544,7 @@ class MemoryTableViewer(gtk.Table):
 		# The TreeModel into which data will be inserted for display by the
 		# treeview. Initially contains a single empty row which is used for
 		# measuring the height of a row in the table.
-		self.list_store = gtk.ListStore(gtk.gdk.Pixbuf, str, str, str, object, object)
+		self.list_store = gtk.ListStore(gtk.gdk.Pixbuf, str, str, str, object, object, str)
 		self._add_empty_row()
 		
 		# The treeview and model used to display memory elements. The size request
@@ -566,7 +589,8 @@ class MemoryTableViewer(gtk.Table):
 		Adds an empty row to the list store.
 		"""
 		cols = [""] * (self.list_store.get_n_columns() - self.DATA_COLUMN)
-		self.list_store.append([POINTER_DEFAULT, "#000000", "Loading...", "", 0,0] + cols)
+		self.list_store.append([POINTER_DEFAULT, "#000000", "Loading...", "", 0,0,
+		                        format_colour] + cols)
 	
 	
 	def _get_row_height(self):
@@ -846,6 +870,7 @@ class MemoryTableViewer(gtk.Table):
 			str,                             # Address
 			object,                          # Address (as int)
 			object,                          # Length
+			str,                             # Data colour
 			] + ([str] * len(columns)))) # Data from the memory table (as strings)
 		
 		# Ensure there is at least one row (for display calculations)
@@ -871,9 +896,9 @@ class MemoryTableViewer(gtk.Table):
 			renderer.connect("editing-canceled", self._on_editing_canceled)
 			renderer.connect("edited",           self._on_edited, num)
 			
-			# Set the column of data to display in the row's colour
+			# Set the column of data to display in the row's data colour
 			col.add_attribute(renderer, "text",       MemoryTableViewer.DATA_COLUMN + num)
-			col.add_attribute(renderer, "foreground", MemoryTableViewer.COLOUR_COLUMN)
+			col.add_attribute(renderer, "foreground", MemoryTableViewer.CHANGED_COLUMN)
 			
 			# Add the column
 			self.tree_view.append_column(col)
@@ -937,9 +962,13 @@ class MemoryTableViewer(gtk.Table):
 		
 		# For each register defined as a pointer into this memory...
 		register_pointers = self.system.get_register_pointers(self.memory)
-		for register_bank, register in register_pointers:
+		
+		# Fetch all the pointers in one go
+		values = self.system.read_registers([register for register_bank, register
+		                                     in register_pointers])
+		
+		for (register_bank, register), value in zip(register_pointers, values):
 			# Place an annotation at the value it points to
-			value = self.system.read_register(register)
 			annotation = RegisterAnnotation(self.system, self.memory,
 			                                value, register_bank, register)
 			self.annotations.setdefault(value,[]).append(annotation)
@@ -1011,6 +1040,32 @@ class MemoryTableViewer(gtk.Table):
 			return (POINTER_DEFAULT, "#000000", "")
 		
 	
+	def get_refresh_reads(self):
+		"""
+		Get the (memory_ranges, registers) the next refresh will read (see
+		DeviceMixin.prefetch): the memory displayed and the registers used to
+		annotate it. Must be called from the GTK thread.
+		"""
+		if self.memory_table is None or self.list_store is None:
+			return ([], [])
+		
+		num_rows = len(self.list_store)
+		memory_ranges = self.memory_table.get_ranges(self.get_addr(), num_rows)
+		if memory_ranges is None:
+			# Assume the rows will cover as many words as they did last time (and at
+			# least one word each)
+			num_words = sum(row[MemoryTableViewer.LENGTH_COLUMN] or 0
+			                for row in self.list_store)
+			memory_ranges = self.memory_table.split_range(self.get_addr(),
+			                                              max(num_rows, num_words))
+		
+		registers = [register for register_bank, register
+		             in self.system.get_register_pointers(self.memory)]
+		
+		return ([(self.memory,) + memory_range for memory_range in memory_ranges],
+		        registers)
+	
+	
 	@RunInBackground()
 	def refresh(self):
 		# Do nothing if no memory table/list store has been set
@@ -1023,6 +1078,15 @@ class MemoryTableViewer(gtk.Table):
 		num_rows = len(self.list_store)
 		memory_table_data = self.memory_table.get_data(self.get_addr(), num_rows)
 		
+		# Find the words shown which have changed since the board last stopped
+		# (the rows wrap around at the top of the address space)
+		changed = set()
+		num_words = sum(length for (_, length, _) in memory_table_data)
+		for range_addr, range_length in self.memory_table.split_range(
+		                                  memory_table_data[0][0], num_words):
+			changed.update(self.system.get_changed_words(self.memory, range_addr,
+			                                             range_length))
+		
 		# Run remainder in GTK thread
 		yield
 		
@@ -1060,6 +1124,13 @@ class MemoryTableViewer(gtk.Table):
 			
 			icon, colour, annotation_tooltips = self.get_annotation(addr, length)
 			
+			# Highlight the data if any of the row's words have changed
+			if any(self.memory_table.mask_addr(a) in changed
+			       for a in range(addr, addr + length)):
+				data_colour = format_changed_colour
+			else:
+				data_colour = colour
+			
 			tooltip = "<b>%s<tt>[%s]</tt></b> — %d Word%s (%d × %d = %d Bits)\n%s"%(
 			                                        self.memory.name,
 			                                        addr_full,
@@ -1077,6 +1148,7 @@ class MemoryTableViewer(gtk.Table):
 			self.list_store[row][MemoryTableViewer.ADDR_COLUMN]     = addr_col
 			self.list_store[row][MemoryTableViewer.ADDR_INT_COLUMN] = addr
 			self.list_store[row][MemoryTableViewer.LENGTH_COLUMN]   = length
+			self.list_store[row][MemoryTableViewer.CHANGED_COLUMN]  = data_colour
 			for num, datum in enumerate(data):
 				self.list_store[row][MemoryTableViewer.DATA_COLUMN + num] = datum
 		
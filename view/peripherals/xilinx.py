@@ -4,10 +4,13 @@
 Peripheral widgets for xilinx devices.
 """
 
-from os.path   import dirname, join
-from threading import Lock
+from os         import fstat
+from os.path    import dirname, join
+from threading  import Lock
+from contextlib import contextmanager
+from mmap       import mmap, ACCESS_READ
 
-from ..background       import RunInBackground
+from ..background       import RunInBackground, Cancelled
 from ..progress_monitor import ProgressMonitor
 
 import gtk, pango, gobject
@@ -19,6 +22,10 @@ def read_bitfile(f):
 	Given a file-object containing a Xilinx FPGA bitfile, return:
 	(design_name, device_name, (datestamp, timestamp), data)
 	
+	If the file-object is an mmap, data is a buffer of the mapped file rather than
+	a copy of the data. Raises an IOError if the file is shorter than its header
+	says.
+	
 	This implementation is based on the fpga_load utility. It contains various
 	unexplained behaviours which just happen to work... Sorry about that.
 	"""
@@ -63,7 +70,19 @@ def read_bitfile(f):
 	for byte in f.read(4):
 		data_length = (data_length << 8) | ord(byte)
 	
-	data = f.read(data_length)
+	# Checked before the buffer is made so that no buffer of the mapping outlives
+	# a failure
+	if isinstance(f, mmap) and len(f) - f.tell() < data_length:
+		raise IOError("Bitfile data truncated: expected %d bytes, got %d."%(
+		              data_length, len(f) - f.tell()))
+	
+	if isinstance(f, mmap):
+		data = buffer(f, f.tell(), data_length)
+	else:
+		data = f.read(data_length)
+		if len(data) != data_length:
+			raise IOError("Bitfile data truncated: expected %d bytes, got %d."%(
+			              data_length, len(data)))
 	
 	return (design_name, device_name, (datestamp, timestamp), data)
 
@@ -132,12 +151,18 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 		
 		# Lock for bit-file data variables access
 		self.data_lock   = Lock()
+		# Set (holding destroy_lock) once the widget has been destroyed, see
+		# _on_destroy
+		self.destroy_lock = Lock()
+		self.destroyed    = False
 		self.filename    = None
 		self.design_name = None
 		self.device_name = None
 		self.datestamp   = None
 		self.timestamp   = None
 		self.data        = None
+		# The mapping of the bitfile which data is a buffer of (or None)
+		self.mapping     = None
 		# Data actually on the FPGA
 		self.fpga_filename    = None
 		self.fpga_design_name = None
@@ -238,8 +263,55 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 		self.erase_btn.connect("clicked", self._on_erase_clicked)
 		self.button_box.pack_start(self.erase_btn)
 		
+		# Add a button to cancel a download
+		self.cancel_btn = gtk.Button("Cancel")
+		self.cancel_btn.set_sensitive(False)
+		self.cancel_btn.connect("clicked", self._on_cancel_clicked)
+		self.button_box.pack_start(self.cancel_btn)
+		
 		# Update all labels
 		self.display_meta_data()
+		
+		# Unmap the bitfile when the widget goes away
+		self.connect("destroy", self._on_destroy)
+	
+	
+	def _on_destroy(self, widget):
+		# A download holds data_lock until it finishes: rather than freezing the GUI
+		# until then, leave it to unmap the bitfile (see _data_access)
+		with self.destroy_lock:
+			self.destroyed = True
+			if self.data_lock.acquire(False):
+				self._close_mapping()
+				self.data_lock.release()
+	
+	
+	@contextmanager
+	def _data_access(self):
+		"""
+		A context manager which holds data_lock. If the widget was destroyed in the
+		meantime, the bitfile is unmapped when the block is left.
+		"""
+		self.data_lock.acquire()
+		try:
+			yield
+		finally:
+			with self.destroy_lock:
+				if self.destroyed:
+					self._close_mapping()
+				self.data_lock.release()
+	
+	
+	def _close_mapping(self):
+		"""
+		Drop the current bitfile data and unmap the file (if mapped). Python 2's
+		buffers don't keep their mmap open so nothing else may still refer to the
+		data: it is only used holding data_lock which must be held here too.
+		"""
+		self.data = None
+		if self.mapping is not None:
+			self.mapping.close()
+			self.mapping = None
 	
 	
 	def _add_heading(self, text, row, col):
@@ -334,26 +406,34 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 	
 	def load_file(self, filename):
 		"""
-		Load a bit file.
+		Load a bit file. The file is memory-mapped rather than read so that large
+		bitfiles can be downloaded without being copied into memory.
 		"""
 		
-		# Try and open the file
+		# Try and open (and map) the file
 		f = None
 		if filename is not None:
 			try:
-				f = open(filename, "rb")
+				with open(filename, "rb") as bitfile:
+					# Empty files can't be mapped
+					if fstat(bitfile.fileno()).st_size == 0:
+						raise IOError("Bitfile %s is empty."%filename)
+					f = mmap(bitfile.fileno(), 0, access = ACCESS_READ)
 			except Exception, e:
 				# Log the error
 				self.system.log(e, True, "Read Bitfile")
 		
 		# Try and load the file
-		with self.data_lock:
+		with self._data_access():
 			self.design_name = None
 			self.device_name = None
 			self.datestamp   = None
 			self.timestamp   = None
 			self.data        = None
 			
+			# The old data is no longer used
+			self._close_mapping()
+			
 			if f is not None:
 				# Try to open the design
 				try:
@@ -364,7 +444,9 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 						self.data,
 					) = read_bitfile(f)
 					self.filename = filename
+					self.mapping  = f
 				except Exception, e:
+					f.close()
 					self.system.log(e, True, "Extract Bitfile")
 	
 	
@@ -372,7 +454,7 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 		"""
 		Display the metadata for the current file and fpga contents.
 		"""
-		with self.data_lock:
+		with self._data_access():
 			fpga_filename_text = self.fpga_filename or "(Unknown)"
 			
 			design_name_text      = self.design_name      or "(None)"
@@ -421,6 +503,7 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 		# something)
 		self.download_btn.set_sensitive(False)
 		self.download_btn.set_label("Downloading...")
+		self.cancel_btn.set_sensitive(True)
 		
 		# Run the downloader in the background
 		yield
@@ -428,16 +511,30 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 		# Reload the file in case it has changed
 		self.load_file(self.filename)
 		
-		with self.data_lock:
+		# Was the download completed?
+		completed = False
+		
+		with self._data_access():
 			data_length = len(self.data)
 			
-			# Make sure the progress is displayed
-			yield (0, 1)
-			
 			try:
-				for progress in self.system.periph_download_(self.periph_num, self.data):
-					# Report progress
-					yield (progress, data_length)
+				# Make sure the progress is displayed
+				yield (0, 1)
+				
+				# Close the download explicitly so that a cancelled download is
+				# abandoned straight away rather than whenever it is collected
+				download = self.system.periph_download_(self.periph_num, self.data)
+				try:
+					for progress in download:
+						# Report progress
+						yield (progress, data_length)
+				finally:
+					download.close()
+				
+				completed = True
+			except Cancelled:
+				# The download was abandoned part-way through
+				pass
 			except Exception, e:
 				# Something bad happened and the download failed.
 				self.system.log(e, True, "Download Bitfile")
@@ -447,16 +544,22 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 		
 		self.download_btn.set_sensitive(True)
 		self.download_btn.set_label("Download onto FPGA")
-		
-		with self.data_lock:
-			self.fpga_filename    = self.filename
-			self.fpga_design_name = self.design_name
-			self.fpga_device_name = self.device_name
-			self.fpga_datestamp   = self.datestamp
-			self.fpga_timestamp   = self.timestamp
+		self.cancel_btn.set_sensitive(False)
+		
+		# A cancelled download leaves the FPGA in an unknown state
+		with self._data_access():
+			self.fpga_filename    = self.filename    if completed else None
+			self.fpga_design_name = self.design_name if completed else None
+			self.fpga_device_name = self.device_name if completed else None
+			self.fpga_datestamp   = self.datestamp   if completed else None
+			self.fpga_timestamp   = self.timestamp   if completed else None
 		self.display_meta_data()
 	
 	
+	def _on_cancel_clicked(self, cancel_btn):
+		Spartan3.downloader_decorator.cancel(self)
+	
+	
 	@RunInBackground(start_in_gtk = True)
 	def _on_erase_clicked(self, erase_btn):
 		# Disable the download button (makes it obvious the system is doing
@@ -467,7 +570,7 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 		# Run the downloader in the background
 		yield
 		
-		with self.data_lock:
+		with self._data_access():
 			try:
 				# Send a blank bit-file to erase the FPGA.
 				for _ in self.system.periph_download_(self.periph_num, ""):
@@ -482,7 +585,7 @@ class Spartan3(gtk.VBox, PeripheralWidget):
 		self.erase_btn.set_sensitive(True)
 		self.erase_btn.set_label("Erase FPGA")
 		
-		with self.data_lock:
+		with self._data_access():
 			self.fpga_filename    = None
 			self.fpga_design_name = None
 			self.fpga_device_name = None
@@ -7,7 +7,7 @@ A GTK+ widget for viewing a system's registers.
 
 from threading import Lock
 
-import gtk, gobject, pango
+import gtk, gobject, glib, pango
 
 from background  import RunInBackground
 from placeholder import Placeholder
@@ -65,6 +65,18 @@ class RegisterViewer(gtk.Notebook):
 			register_bank_viewer.refresh()
 	
 	
+	def get_refresh_reads(self):
+		"""
+		Get the (memory_ranges, registers) the next refresh will read (see
+		DeviceMixin.prefetch). Must be called from the GTK thread.
+		"""
+		register_bank_viewer = self.get_nth_page(self.get_current_page())
+		if not self.showing_placeholder and register_bank_viewer is not None:
+			return ([], register_bank_viewer.register_bank.registers)
+		else:
+			return ([], [])
+	
+	
 	
 	def _show_placeholder(self, title, body):
 		"""
@@ -168,8 +180,8 @@ class RegisterBankViewer(gtk.VBox):
 		"""
 		Add the integer register viewer
 		"""
-		# The list model (reg_name, value, ascii, tooltip)
-		self.register_list_model = gtk.ListStore(str, str, str, str)
+		# The list model (reg_name, value, ascii, tooltip, value colour)
+		self.register_list_model = gtk.ListStore(str, str, str, str, str)
 		
 		# A tree view is used to display the integer registers
 		self.register_list = gtk.TreeView(self.register_list_model)
@@ -209,6 +221,8 @@ class RegisterBankViewer(gtk.VBox):
 			
 			# Render the column column_num from the model in this column
 			column.add_attribute(cell_renderer, "text", column_num)
+			if column_num > 0:
+				column.add_attribute(cell_renderer, "foreground", 4)
 			
 			self.register_list.append_column(column)
 		
@@ -223,7 +237,8 @@ class RegisterBankViewer(gtk.VBox):
 			tooltip = "In expressions: %s"%(
 				", ".join("%s%s"%(prefix, name) for name in register.names))
 			
-			self.register_list_model.append((register.name, "", "", tooltip))
+			self.register_list_model.append((register.name, "", "", tooltip,
+			                                 format_colour))
 		
 		self.register_list_scroller = gtk.ScrolledWindow()
 		self.register_list_scroller.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
@@ -334,10 +349,14 @@ class RegisterBankViewer(gtk.VBox):
 			self.system.log(e, True, "Set Register")
 	
 	
-	def set_register(self, register, value):
+	def set_register(self, register, value, changed = False):
 		"""
-		Set the value of a register in the display given a register object.
+		Set the value of a register in the display given a register object. If
+		changed is True, the register is highlighted as having changed since the
+		board last stopped.
 		"""
+		colour = format_changed_colour if changed else format_colour
+		
 		if register in self.int_registers:
 			# Format the value for display
 			formatted = format_number(value, register.width_bits)
@@ -354,6 +373,7 @@ class RegisterBankViewer(gtk.VBox):
 			it = self.register_list_model.get_iter(row)
 			self.register_list_model.set(it, 1, formatted)
 			self.register_list_model.set(it, 2, ascii)
+			self.register_list_model.set(it, 4, colour)
 			
 			# Update the column sizes
 			self.register_list.columns_autosize()
@@ -372,6 +392,12 @@ class RegisterBankViewer(gtk.VBox):
 			if label.get_tooltip_text() != tt:
 				label.set_tooltip_text(tt)
 			
+			# Colour the label if changed
+			markup = "<span foreground=\"%s\">%s</span>"%(
+				colour, glib.markup_escape_text(register.name))
+			if label.get_label() != markup:
+				label.set_markup(markup)
+			
 			# Pass on the request to the bit-field editor
 			editor.set_value(value)
 	
@@ -381,15 +407,17 @@ class RegisterBankViewer(gtk.VBox):
 		"""
 		Update all registers in this bank.
 		"""
-		value_assignments = {}
-		for register in self.register_bank.registers:
-			value_assignments[register] = self.system.read_register(register)
+		value_assignments = self.system.read_register_bank(self.register_bank)
+		
+		# Find the registers which have changed since the board last stopped
+		registers = value_assignments.keys()
+		changed   = dict(zip(registers, self.system.get_changed_registers(registers)))
 		
 		# Update the widget in the GTK thread
 		yield
 		
 		for register, value in value_assignments.iteritems():
-			self.set_register(register, value)
+			self.set_register(register, value, changed[register])
 
 
 
@@ -82,10 +82,14 @@ class StatusBar(gtk.VBox):
 	@RunInBackground()
 	def refresh(self):
 		status, steps_remaining, steps_since_reset = self.system.get_status()
+		offline = self.system.is_device_offline()
 		
 		yield
 		
-		self.status_label.set_text(StatusBar.STATUS_CODES.get(status, "Device in Unknown State"))
+		if offline:
+			self.status_label.set_text("Device Offline")
+		else:
+			self.status_label.set_text(StatusBar.STATUS_CODES.get(status, "Device in Unknown State"))
 		self.step_count_label.set_text("%s Step%s Since Reset%s"%(
 			steps_since_reset,
 			"s" if steps_since_reset != 1 else "",
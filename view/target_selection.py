@@ -13,7 +13,11 @@ from optparse import OptionParser, OptionGroup
 import gtk, gobject
 
 import about
-from back_end import EmulatorBackEnd, SerialPortBackEnd
+from back_end import EmulatorBackEnd, SerialPortBackEnd, SocketBackEnd
+from back_end import RecordingBackEnd, ReplayBackEnd, MeteredBackEnd
+from back_end.base import BackEnd
+from back_end.in_process import InProcessBackEnd
+from simulator import SIMULATORS
 from system   import System
 
 from background  import RunInBackground
@@ -128,7 +132,9 @@ class SerialTarget(gtk.Table, Target):
 		self.baudrate_entry = gtk.Entry()
 		self.baudrate_entry.set_activates_default(True)
 		self.baudrate_entry.set_text("115200")
-		self.baudrate_entry.set_tooltip_text("Serial port speed (usually 115200)")
+		self.baudrate_entry.set_tooltip_text("Serial port speed (usually 115200). "
+		                                     "A comma-separated list of speeds, "
+		                                     "fastest first, tries each in turn.")
 		self.attach(self.baudrate_entry, 1,2, 1,2,
 		            xoptions = gtk.FILL|gtk.EXPAND, yoptions = gtk.FILL)
 	
@@ -140,15 +146,17 @@ class SerialTarget(gtk.Table, Target):
 		               action="store", type="string", default = None,
 		               help = "Use the specified serial device as the back-end")
 		ser.add_option("-b", "--baud-rate", dest = "baudrate",
-		               action="store", type="int", default = 115200,
-		               help = "Baudrate of the serial connection")
+		               action="store", type="string", default = "115200",
+		               help = "Baudrate of the serial connection (or a "
+		                      "comma-separated list of baudrates to try, fastest "
+		                      "first)")
 		parser.add_option_group(ser)
 	
 	
 	def handle_options(self, options, args):
 		if options.serial_port is not None:
 			self.serial_port_entry.set_text(options.serial_port)
-			self.baudrate_entry.set_text(str(options.baudrate))
+			self.baudrate_entry.set_text(options.baudrate)
 			return True
 		else:
 			return False
@@ -161,14 +169,155 @@ class SerialTarget(gtk.Table, Target):
 		except ValueError:
 			serial_port = self.serial_port_entry.get_text()
 		
-		# Baudrate must be an integer
+		# Baudrates must be integers
 		try:
-			baudrate = int(self.baudrate_entry.get_text())
+			baudrates = map(int, self.baudrate_entry.get_text().split(","))
 		except ValueError:
-			raise ValueError("Invalid baudrate (expected an integer)")
+			raise ValueError("Invalid baudrate (expected an integer or a "
+			                 "comma-separated list of integers)")
 		
-		return SerialPortBackEnd(serial_port, baudrate)
+		return SerialPortBackEnd(serial_port, baudrates)
+
+
+class SocketTarget(gtk.Table, Target):
+	
+	def __init__(self):
+		gtk.Table.__init__(self, rows = 1, columns = 2)
+		Target.__init__(self, "Socket")
+		
+		# Set up the widget
+		self.set_border_width(5)
+		self.set_col_spacing(0, 5)
+		
+		label = gtk.Label("Address")
+		self.attach(label, 0,1, 0,1, xoptions = gtk.FILL, yoptions = gtk.FILL)
+		
+		self.address_entry = gtk.Entry()
+		self.address_entry.set_activates_default(True)
+		self.address_entry.set_text("localhost:")
+		self.address_entry.set_tooltip_text("The host:port or Unix-domain socket path of a running emulator.")
+		self.attach(self.address_entry, 1,2, 0,1,
+		            xoptions = gtk.FILL|gtk.EXPAND, yoptions = gtk.FILL)
+	
+	
+	def add_option_group(self, parser):
+		sock = OptionGroup(parser, "Socket Options",
+		                   "Options relating to the use of a socket back-end.")
+		sock.add_option("-n", "--socket", dest = "socket_address",
+		                action="store", type="string", default = None,
+		                help = "Connect to the emulator at the specified host:port or Unix-domain socket")
+		parser.add_option_group(sock)
+	
+	
+	def handle_options(self, options, args):
+		if options.socket_address is not None:
+			self.address_entry.set_text(options.socket_address)
+			return True
+		else:
+			return False
+	
+	
+	def get_back_end(self):
+		return SocketBackEnd(self.address_entry.get_text())
+
+
+class SimulatorTarget(gtk.Table, Target):
+	
+	def __init__(self):
+		gtk.Table.__init__(self, rows = 1, columns = 2)
+		Target.__init__(self, "Simulator")
+		
+		# Names of the architectures which may be simulated
+		self.architectures = sorted(SIMULATORS)
+		
+		# Set up the widget
+		self.set_border_width(5)
+		self.set_col_spacing(0, 5)
+		
+		label = gtk.Label("Architecture")
+		self.attach(label, 0,1, 0,1, xoptions = gtk.FILL, yoptions = gtk.FILL)
+		
+		self.architecture_combo_box = gtk.combo_box_new_text()
+		map(self.architecture_combo_box.append_text, self.architectures)
+		self.architecture_combo_box.set_active(0)
+		self.architecture_combo_box.set_tooltip_text("The processor to simulate within Perentie.")
+		self.attach(self.architecture_combo_box, 1,2, 0,1,
+		            xoptions = gtk.FILL|gtk.EXPAND, yoptions = gtk.FILL)
+	
+	
+	def add_option_group(self, parser):
+		sim = OptionGroup(parser, "Simulator Options",
+		                  "Options relating to the use of the built-in simulators.")
+		sim.add_option("-m", "--simulator", dest = "simulator",
+		               action="store", type="choice", default = None,
+		               choices = self.architectures,
+		               help = "Simulate the specified architecture (%s)"%(
+		                 ", ".join(self.architectures)))
+		parser.add_option_group(sim)
+	
 	
+	def handle_options(self, options, args):
+		if options.simulator is not None:
+			self.architecture_combo_box.set_active(
+				self.architectures.index(options.simulator))
+			return True
+		else:
+			return False
+	
+	
+	def get_back_end(self):
+		return InProcessBackEnd(self.architecture_combo_box.get_active_text())
+
+
+class ReplayTarget(gtk.Table, Target):
+	
+	def __init__(self):
+		gtk.Table.__init__(self, rows = 2, columns = 2)
+		Target.__init__(self, "Replay")
+		
+		# Set up the widget
+		self.set_border_width(5)
+		self.set_col_spacing(0, 5)
+		
+		label = gtk.Label("Trace File")
+		self.attach(label, 0,1, 0,1, xoptions = gtk.FILL, yoptions = gtk.FILL)
+		
+		self.trace_entry = gtk.Entry()
+		self.trace_entry.set_activates_default(True)
+		self.trace_entry.set_tooltip_text("A trace recorded using --record.")
+		self.attach(self.trace_entry, 1,2, 0,1,
+		            xoptions = gtk.FILL|gtk.EXPAND, yoptions = gtk.FILL)
+		
+		self.realtime_check = gtk.CheckButton("Original timing")
+		self.realtime_check.set_tooltip_text("Delay responses as when the trace was recorded.")
+		self.attach(self.realtime_check, 1,2, 1,2,
+		            xoptions = gtk.FILL|gtk.EXPAND, yoptions = gtk.FILL)
+	
+	
+	def add_option_group(self, parser):
+		replay = OptionGroup(parser, "Replay Options",
+		                     "Options relating to replaying a recorded session.")
+		replay.add_option("--replay", dest = "replay",
+		                  action="store", type="string", default = None,
+		                  help = "Replay the responses recorded in the specified trace file")
+		replay.add_option("--replay-realtime", dest = "replay_realtime",
+		                  action="store_true", default = False,
+		                  help = "Replay responses with their original latencies")
+		parser.add_option_group(replay)
+	
+	
+	def handle_options(self, options, args):
+		if options.replay is not None:
+			self.trace_entry.set_text(options.replay)
+			self.realtime_check.set_active(options.replay_realtime)
+			return True
+		else:
+			return False
+	
+	
+	def get_back_end(self):
+		return ReplayBackEnd(self.trace_entry.get_text(),
+		                     self.realtime_check.get_active())
 
 
 class TargetSelection(gtk.Window):
@@ -176,6 +325,9 @@ class TargetSelection(gtk.Window):
 	TARGETS = [
 		SerialTarget,
 		EmulatorTarget,
+		SocketTarget,
+		SimulatorTarget,
+		ReplayTarget,
 	]
 	
 	def __init__(self, argv = None):
@@ -195,6 +347,25 @@ class TargetSelection(gtk.Window):
 		                       dest = "verbose", action="store_true", default = False,
 		                       help = "Show exceptions on stderr.")
 		
+		self.parser.add_option("-r", "--record",
+		                       dest = "record", action="store", type="string", default = None,
+		                       help = "Record all communication with the target to a trace file.")
+		
+		# Filename to record communication to (or None)
+		self.record_filename = None
+		
+		self.parser.add_option("-w", "--download-window",
+		                       dest = "download_window", action="store", type="int",
+		                       default = BackEnd.DOWNLOAD_WINDOW,
+		                       help = "Number of peripheral download packets to send "
+		                              "before waiting for acknowledgements "
+		                              "(default: %d; 1 waits for each packet; at "
+		                              "most %d)"%(BackEnd.DOWNLOAD_WINDOW,
+		                                          BackEnd.MAX_DOWNLOAD_WINDOW))
+		
+		# Number of download packets to keep in flight
+		self.download_window = BackEnd.DOWNLOAD_WINDOW
+		
 		# The back-end and system which are being debugged
 		self.back_end = None
 		self.system   = None
@@ -289,6 +460,9 @@ class TargetSelection(gtk.Window):
 		# Set the verbosity of the prgoram
 		self.set_verbose(options.verbose)
 		
+		self.record_filename = options.record
+		self.download_window = options.download_window
+		
 		# Deal with the target's options
 		for target in self.targets:
 			if target.handle_options(options, args):
@@ -317,6 +491,10 @@ class TargetSelection(gtk.Window):
 		try:
 			target = self.targets[self.notebook.get_current_page()]
 			self.back_end = target.get_back_end()
+			if self.record_filename is not None:
+				self.back_end = RecordingBackEnd(self.back_end, self.record_filename)
+			self.back_end = MeteredBackEnd(self.back_end)
+			self.back_end.download_window = self.download_window
 			self.system = System(self.back_end)
 		except Exception, e:
 			# Something failed!